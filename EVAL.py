@@ -177,11 +177,42 @@ class FirecrawlMCP:
                 return out[:max_results]
         return []
 
+def load_budget_tracker(run_budget: Union[float, None] = None, fallback_model: Union[str, None] = None) -> Any:
+    # Shares the token/cost accounting in Evaluation-Methods/budget.py when the
+    # package sits next to this script (wherever it is run from); evaluation runs unmetered otherwise.
+    em = Path(__file__).resolve().parent / "Evaluation-Methods"
+    bp = em / "budget.py"
+    if not bp.exists():
+        return None
+    try:
+        if str(em) not in sys.path:
+            sys.path.insert(0, str(em))
+        spec = importlib.util.spec_from_file_location("budget", str(bp))
+        m = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(m)  # type: ignore
+        return m.BudgetTracker(run_budget=run_budget, fallback_model=fallback_model)
+    except Exception as e:
+        logger.warning("Budget tracking unavailable: %s", e)
+        return None
+
 class OpenAIClient:
+    def __init__(self, budget: Any = None) -> None:
+        self.budget = budget
+
+    def _record_usage(self, resp: Any, model: str) -> None:
+        usage = getattr(resp, "usage", None) or (resp.get("usage") if isinstance(resp, dict) else None)
+        if self.budget is None or usage is None:
+            return
+        get = (lambda k: usage.get(k)) if isinstance(usage, dict) else (lambda k: getattr(usage, k, None))
+        self.budget.record("openai", model, get("prompt_tokens") or 0, get("completion_tokens") or 0, "eval_rubric")
+
     def chat(self, system: str, user: str, model: str, max_tokens: int) -> str:
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY not set")
+        if self.budget is not None:
+            self.budget.check()
+            model = self.budget.model_for(model)
         try:
             from openai import OpenAI
             client = OpenAI(api_key=api_key)
@@ -194,6 +225,7 @@ class OpenAIClient:
                 temperature=0.0,
                 max_tokens=max_tokens,
             )
+            self._record_usage(resp, model)
             assistant_text = None
             try:
                 choice0 = resp.choices[0]
@@ -236,6 +268,7 @@ class OpenAIClient:
                     temperature=0.0,
                     max_tokens=max_tokens,
                 )
+                self._record_usage(resp, model)
                 try:
                     return resp.choices[0].message.content.strip()
                 except Exception:
@@ -295,6 +328,10 @@ class Evaluator:
             except Exception as e:
                 scores_out[rk] = 0
                 details_out[rk] = {"error": str(e)}
+                if self.llm.budget is not None and self.llm.budget.exceeded:
+                    # Out of budget: stop here and keep the rubrics already scored.
+                    details_out["budget_exceeded"] = True
+                    break
                 continue
             parsed = None
             for candidate in (assistant_text, JSONUtils.sanitize(assistant_text)):
@@ -364,6 +401,8 @@ def main():
     parser.add_argument("--mcp-timeout", type=int, default=10, help="Timeout in seconds for each Firecrawl command attempt.")
     parser.add_argument("--max-tokens", type=int, default=1500, help="Max tokens for the model response per rubric.")
     parser.add_argument("--fast", action="store_true", help="Use faster defaults (smaller model and fewer tokens).")
+    parser.add_argument("--budget-usd", type=float, default=None, help="Stop once estimated OpenAI spend reaches this many USD (default RUN_BUDGET_USD).")
+    parser.add_argument("--fallback-model", default=None, help="Cheaper model to switch to as spend nears the budget (default BUDGET_FALLBACK_MODEL).")
     args = parser.parse_args()
     if args.input == "-":
         chats = json.load(sys.stdin)
@@ -376,7 +415,8 @@ def main():
             model = "gpt-4o-mini"
         if max_tokens > 900:
             max_tokens = 900
-    evaluator = Evaluator(FirecrawlMCP(timeout=args.mcp_timeout), JudgesRepository(), OpenAIClient())
+    budget = load_budget_tracker(args.budget_usd, args.fallback_model)
+    evaluator = Evaluator(FirecrawlMCP(timeout=args.mcp_timeout), JudgesRepository(), OpenAIClient(budget))
     rubric_arg: Union[str, dict] = args.rubric
     if args.rubrics_include:
         include = [k.strip() for k in args.rubrics_include.split(",") if k.strip()]
@@ -399,6 +439,8 @@ def main():
     except Exception as e:
         logger.error("Evaluation failed: %s", e)
         sys.exit(2)
+    if budget is not None and isinstance(result, dict) and isinstance(result.get("details"), dict):
+        result["details"]["usage"] = budget.summary()
     scores_only = result.get("scores") if isinstance(result, dict) and "scores" in result else result
     with open(args.output, "w", encoding="utf-8") as fh:
         json.dump(scores_only, fh, indent=2)
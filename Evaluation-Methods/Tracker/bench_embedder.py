@@ -0,0 +1,66 @@
+"""Embedding throughput benchmark for Tracker/cluster_engine.Embedder.
+
+Encodes the same texts with each backend (and optionally a multi-process pool)
+and reports texts/sec. Texts come from --file (one per line) or are sampled
+from stored responses, falling back to synthetic sentences of mixed length.
+
+    python Tracker/bench_embedder.py --n 5000 --backends torch,quantized,onnx --processes 0,4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Tracker.cluster_engine import Embedder
+
+WORDS = "i feel so tired and alone lately nothing helps my sleep work family anxiety talk someone better today".split()
+
+def load_texts(n, path=None):
+    if path:
+        with open(path) as f:
+            texts = [line.strip() for line in f if line.strip()]
+        return (texts * (n // max(len(texts), 1) + 1))[:n]
+    try:
+        from db import DatabaseHandler
+        rows = DatabaseHandler().fetch_responses_after(0, n)
+        if rows:
+            texts = [row.text for row in rows]
+            return (texts * (n // len(texts) + 1))[:n]
+    except Exception as e:
+        print(f"Using synthetic texts ({type(e).__name__}: {e})")
+    rng = random.Random(0)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 200))) for _ in range(n)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=2000)
+    parser.add_argument("--file")
+    parser.add_argument("--backends", default="torch,quantized,onnx")
+    parser.add_argument("--processes", default="0", help="Comma-separated pool sizes to try (0 = in-process)")
+    parser.add_argument("--batch-size", type=int, default=None)
+    args = parser.parse_args()
+
+    texts = load_texts(args.n, args.file)
+    print(f"{'backend':<10} {'procs':>5} {'texts/sec':>10} {'load s':>7}")
+    for backend in args.backends.split(","):
+        for processes in (int(p) for p in args.processes.split(",")):
+            start = time.perf_counter()
+            try:
+                embedder = Embedder(backend=backend, batch_size=args.batch_size, processes=processes)
+            except Exception as e:
+                print(f"{backend:<10} {processes:>5}  unavailable: {type(e).__name__}: {e}")
+                continue
+            load_seconds = time.perf_counter() - start
+            # Warm-up; large enough to start the pool when processes > 1.
+            embedder.encode(texts[:embedder.batch_size * max(processes, 1)])
+            start = time.perf_counter()
+            embedder.encode(texts)
+            elapsed = time.perf_counter() - start
+            embedder.close()
+            print(f"{backend:<10} {processes:>5} {len(texts) / elapsed:>10.1f} {load_seconds:>7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,84 @@
 import logging
+import os
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
-import umap.umap_ as umap
-import hdbscan
 from settings import settings
+from Tracker.embedding_store import EmbeddingStore
+from Tracker.cluster_models import IncrementalClusterer
+from Tracker.stream_clusterer import StreamClusterer
+from Tracker.vector_index import IVFIndex
 from sqlalchemy import text
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def embedding_model_key(model_name=None, backend=None, normalize=None):
+    # Everything that changes the vectors themselves (not batch size or process
+    # count), so stored embeddings from different settings are never mixed.
+    model_name = model_name or settings.embeddings_model_name
+    backend = backend or settings.embeddings_backend
+    normalize = settings.embeddings_normalize if normalize is None else normalize
+    return model_name + ("" if backend == "torch" else f"+{backend}") + ("+norm" if normalize else "")
+
 class Embedder:
-    def __init__(self):
-        self.model = SentenceTransformer(settings.embeddings_model_name)
+    """SentenceTransformer wrapper tuned for CPU throughput.
+
+    backend is "torch", "quantized" (torch dynamic int8 on Linear layers),
+    "onnx" or "openvino" (sentence-transformers' exported backends). With
+    processes > 1, encode() fans chunks of similar-length texts out to a
+    multi-process pool.
+    """
+
+    def __init__(self, model_name=None, backend=None, batch_size=None, normalize=None, processes=None):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name or settings.embeddings_model_name
+        self.backend = backend or settings.embeddings_backend
+        self.batch_size = batch_size or settings.embeddings_batch_size
+        self.normalize = settings.embeddings_normalize if normalize is None else normalize
+        self.processes = settings.embeddings_processes if processes is None else processes
+        self.model_key = embedding_model_key(self.model_name, self.backend, self.normalize)
+        if self.backend in ("onnx", "openvino"):
+            self.model = SentenceTransformer(self.model_name, device="cpu", backend=self.backend)
+        else:
+            self.model = SentenceTransformer(self.model_name, device="cpu" if self.backend == "quantized" else None)
+        if self.backend == "quantized":
+            import torch
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._pool = None
 
     def encode(self, texts):
-        return self.model.encode(texts)
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        # Longest first, so every batch pads to roughly its own length.
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+        if self.processes > 1 and len(texts) >= self.batch_size * self.processes:
+            if self._pool is None:
+                self._pool = self.model.start_multi_process_pool(["cpu"] * self.processes)
+            embeddings = self.model.encode_multi_process(sorted_texts, self._pool, batch_size=self.batch_size, normalize_embeddings=self.normalize)
+        else:
+            embeddings = self.model.encode(sorted_texts, batch_size=self.batch_size, normalize_embeddings=self.normalize, convert_to_numpy=True)
+        result = np.empty_like(embeddings)
+        result[order] = embeddings
+        return result
+
+    def close(self):
+        if self._pool is not None:
+            self.model.stop_multi_process_pool(self._pool)
+            self._pool = None
 
 class TemporalClusterer:
     def __init__(self, embedder: Embedder):
         self.embedder = embedder
 
-    def fit_assign(self, df, method='auto'):
-        df['embedding'] = list(self.embedder.encode(df['text'].tolist()))
+    def fit_assign(self, df, method='auto', embeddings=None):
+        # Heavy imports live here so importing this module stays cheap.
+        import umap.umap_ as umap
+        from sklearn.cluster import KMeans
+        if embeddings is None:
+            embeddings = self.embedder.encode(df['text'].tolist())
+        df['embedding'] = list(embeddings)
         
         # Time-decay weighting
         df['timestamp'] = pd.to_datetime(df['created_at'])
@@ -35,6 +90,7 @@ class TemporalClusterer:
         
         if method == 'auto':
             try:
+                import hdbscan
                 clusterer = hdbscan.HDBSCAN(min_cluster_size=settings.clustering_params['min_cluster_size'], min_samples=settings.clustering_params['min_samples'])
                 df['cluster_id'] = clusterer.fit_predict(reduced_embeddings)
                 df['cluster_prob'] = clusterer.probabilities_
@@ -75,26 +131,106 @@ class ConversationTracker:
 class ClusterEngine:
     def __init__(self, db_handler):
         self.db_handler = db_handler
-        self.embedder = Embedder()
-        self.clusterer = TemporalClusterer(self.embedder)
+        self._embedder = None
         self.tracker = ConversationTracker(self.db_handler)
+        self.embedding_store = EmbeddingStore(self.db_handler, lambda: self.embedder, embedding_model_key())
+        self.incremental = IncrementalClusterer(self.db_handler, self.embedding_store)
+        self._stream = None
+        self._vector_index = None
+
+    @property
+    def embedder(self):
+        # Loading the SentenceTransformer takes seconds; do it when first needed.
+        if self._embedder is None:
+            self._embedder = Embedder()
+        return self._embedder
+
+    @property
+    def stream(self):
+        if self._stream is None:
+            self._stream = StreamClusterer()
+        return self._stream
+
+    def _fold(self, response_ids, embeddings, created_at, failed):
+        timestamps = [ts.timestamp() for ts in pd.to_datetime(pd.Series(created_at))]
+        self.stream.fold(embeddings, timestamps, failed, response_ids)
+
+    def fold_responses(self, response_ids, texts, created_at, failed):
+        # Streaming hook: folds freshly inserted responses into the saved
+        # micro-clusters. Embeddings are computed before taking the file lock.
+        embeddings = self.embedding_store.get(texts)
+        with self.stream.locked():
+            self._fold(response_ids, embeddings, created_at, failed)
+
+    def cluster_stream(self, limit=10000, since=None):
+        # Folds up to `limit` responses the stream hasn't seen yet (only those
+        # created since `since`, if given), then builds macro-clusters.
+        with self.stream.locked():
+            settled = self.db_handler.fetch_settled_response_id(self.stream.last_response_id)
+            rows = self.db_handler.fetch_responses_after(self.stream.last_response_id, limit, exclude_ids=self.stream.folded_ids, since=since)
+            if rows:
+                response_ids, texts, created_at, failed = zip(*rows)
+                self._fold(response_ids, self.embedding_store.get(list(texts)), created_at, failed)
+                logger.info(f"Folded {len(rows)} responses into {len(self.stream.weights)} micro-clusters.")
+            # Rows come in id order, so a full page only covers ids up to its last row.
+            self.stream.advance(min(settled, response_ids[-1]) if limit and len(rows) == limit else settled)
+        return self.stream.macro_clusters()
+
+    @property
+    def vector_index(self):
+        if self._vector_index is None:
+            self._vector_index = IVFIndex(os.path.join(settings.output_dir, "vector_index.npz"), self.embedding_store.model_name)
+        return self._vector_index
+
+    def sync_vector_index(self, limit=10000):
+        # Adds every response the index doesn't hold yet, a page of `limit` at a time.
+        added = 0
+        with self.vector_index.locked():
+            settled = self.db_handler.fetch_settled_response_id(self.vector_index.last_response_id)
+            while True:
+                rows = self.db_handler.fetch_responses_after(self.vector_index.last_response_id, limit, exclude_ids=self.vector_index.unsettled_ids())
+                if not rows:
+                    break
+                self.vector_index.add([row.id for row in rows], self.embedding_store.get([row.text for row in rows]))
+                added += len(rows)
+                # Rows come in id order, so the watermark can follow each page.
+                self.vector_index.advance(min(settled, rows[-1].id))
+            self.vector_index.advance(settled)
+        if added:
+            logger.info(f"Added {added} responses to the vector index ({len(self.vector_index)} total).")
+
+    def find_similar(self, response_id=None, text=None, k=10):
+        # Stored responses closest to a response id or to free text, as (id, similarity, text, created_at, failed) rows.
+        if (response_id is None) == (text is None):
+            raise ValueError("Pass exactly one of response_id or text")
+        self.sync_vector_index()
+        if response_id is not None:
+            rows = self.db_handler.fetch_responses_by_id([response_id])
+            if not rows:
+                raise ValueError(f"No response with id {response_id}")
+            text = rows[0].text
+        query = self.embedding_store.get([text])[0]
+        hits = self.vector_index.search(query, k, exclude=() if response_id is None else (response_id,))
+        rows = {row.id: row for row in self.db_handler.fetch_responses_by_id([hit_id for hit_id, _ in hits])}
+        return [(hit_id, score, rows[hit_id].text, rows[hit_id].created_at, rows[hit_id].failed) for hit_id, score in hits if hit_id in rows]
+
+    @property
+    def clusterer(self):
+        return TemporalClusterer(self.embedder)
 
-    def cluster_and_save(self, time_window=None, limit=1000, method='auto'):
-        query = "SELECT id, response_text as text, created_at FROM chatbot_responses ORDER BY created_at DESC LIMIT :limit"
+    def cluster_and_save(self, time_window=None, limit=1000, method='auto', refit=False):
+        if method == IncrementalClusterer.METHOD:
+            return self.incremental.run(time_window, limit, refit=refit)
+        query, params = self.db_handler.build_responses_query(since=time_window, limit=limit)
         with self.db_handler.Session() as session:
-            df = pd.read_sql(text(query), session.connection(), params={"limit": limit})
+            df = pd.read_sql(text(query), session.connection(), params=params)
         
         if not df.empty:
-            df_clustered = self.clusterer.fit_assign(df, method=method)
+            embeddings = self.embedding_store.get(df['text'].tolist())
+            df_clustered = self.clusterer.fit_assign(df, method=method, embeddings=embeddings)
             
-            cluster_assignments = []
-            for _, row in df_clustered.iterrows():
-                cluster_assignments.append({
-                    "response_id": row['id'],
-                    "cluster_id": row['cluster_id'],
-                    "cluster_prob": row['cluster_prob']
-                })
-            self.db_handler.save_cluster_assignments(cluster_assignments)
-            logger.info(f"Saved {len(cluster_assignments)} cluster assignments.")
+            run_id = self.db_handler.start_cluster_run(method, {"time_window": time_window, "limit": limit, "embedding_model": self.embedding_store.model_name})
+            saved = self.db_handler.save_cluster_assignments(run_id, df_clustered['id'].to_numpy(), df_clustered['cluster_id'].to_numpy(), df_clustered['cluster_prob'].to_numpy())
+            logger.info(f"Saved {saved} cluster assignments under run {run_id}.")
             return df_clustered
         return pd.DataFrame()
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import pickle
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from settings import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class IncrementalClusterer:
+    """Cluster assignment against saved UMAP + HDBSCAN models.
+
+    A fit stores the reducer and clusterer as a pickle under
+    output_dir/cluster_models and a row in cluster_models whose id is the model
+    version. Later runs only look at responses with no assignment under that
+    version, project them with UMAP.transform and label them with
+    hdbscan.approximate_predict, so cluster ids stay stable between runs. A
+    full refit happens when the model is older than CLUSTER_REFIT_DAYS, when the
+    embedding model changes, or when the share of new points labelled noise
+    exceeds the fit's own noise rate by more than CLUSTER_DRIFT_THRESHOLD.
+
+    Unlike TemporalClusterer, embeddings are not time-decayed: a transform
+    needs new points in the same space the reducer was fitted on.
+    """
+
+    METHOD = "incremental"
+
+    def __init__(self, db_handler, embedding_store, model_dir=None):
+        self.db_handler = db_handler
+        self.embedding_store = embedding_store
+        self.model_dir = model_dir or os.path.join(settings.output_dir, "cluster_models")
+        self._loaded = {}
+
+    def _load(self, row):
+        if row.id not in self._loaded:
+            with open(row.path, "rb") as f:
+                self._loaded[row.id] = pickle.load(f)
+        return self._loaded[row.id]
+
+    def fit(self, embeddings):
+        import hdbscan
+        import umap.umap_ as umap
+        params = {"n_components": 2, "min_cluster_size": settings.clustering_params["min_cluster_size"], "min_samples": settings.clustering_params["min_samples"], "embedding_model": self.embedding_store.model_name}
+        reducer = umap.UMAP(n_components=params["n_components"], random_state=42).fit(embeddings)
+        reduced = reducer.embedding_
+        clusterer = hdbscan.HDBSCAN(min_cluster_size=params["min_cluster_size"], min_samples=params["min_samples"], prediction_data=True).fit(reduced)
+        noise_rate = float(np.mean(clusterer.labels_ == -1))
+
+        version = self.db_handler.insert_cluster_model(self.METHOD, params, None, len(embeddings), noise_rate)
+        os.makedirs(self.model_dir, exist_ok=True)
+        path = os.path.join(self.model_dir, f"v{version}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump({"reducer": reducer, "clusterer": clusterer}, f)
+        self.db_handler.update_cluster_model_path(version, path)
+        self._loaded[version] = {"reducer": reducer, "clusterer": clusterer}
+        logger.info(f"Fitted cluster model v{version} on {len(embeddings)} responses ({noise_rate:.0%} noise).")
+        return version, clusterer.labels_, clusterer.probabilities_, reduced
+
+    def predict(self, models, embeddings):
+        import hdbscan
+        reduced = models["reducer"].transform(embeddings)
+        labels, strengths = hdbscan.approximate_predict(models["clusterer"], reduced)
+        return labels, strengths, reduced
+
+    def _stale(self, row):
+        # Too old, or fitted on vectors from a different embedding model/backend.
+        if json.loads(row.params or "{}").get("embedding_model") != self.embedding_store.model_name:
+            return True
+        return timedelta(seconds=float(row.age_seconds)) > timedelta(days=settings.cluster_refit_days)
+
+    def _save(self, df, version, params):
+        run_id = self.db_handler.start_cluster_run(self.METHOD, params, model_version=version)
+        saved = self.db_handler.save_cluster_assignments(run_id, df["id"].to_numpy(), df["cluster_id"].to_numpy(), df["cluster_prob"].to_numpy(), model_version=version)
+        logger.info(f"Saved {saved} cluster assignments under model v{version} (run {run_id}).")
+
+    def run(self, time_window=None, limit=1000, refit=False):
+        row = self.db_handler.fetch_latest_cluster_model(self.METHOD)
+        if row is not None and not refit and not self._stale(row):
+            rows = self.db_handler.fetch_unassigned_responses(row.id, since=time_window, limit=limit)
+            if not rows:
+                logger.info(f"No new responses to assign under model v{row.id}.")
+                return pd.DataFrame()
+            df = pd.DataFrame(rows, columns=["id", "text", "created_at"])
+            labels, strengths, reduced = self.predict(self._load(row), self.embedding_store.get(df["text"].tolist()))
+            noise_rate = float(np.mean(labels == -1))
+            if noise_rate - row.noise_rate <= settings.cluster_drift_threshold:
+                df["cluster_id"], df["cluster_prob"] = labels, strengths
+                df["x"], df["y"] = reduced[:, 0], reduced[:, 1]
+                self._save(df, row.id, {"mode": "predict", "time_window": time_window, "limit": limit})
+                return df
+            logger.warning(f"Drift: {noise_rate:.0%} of new responses are noise under model v{row.id} (fit: {row.noise_rate:.0%}); refitting.")
+        elif row is not None:
+            logger.info(f"Refitting cluster model (v{row.id} is {'stale' if self._stale(row) else 'being replaced on request'}).")
+
+        query, params = self.db_handler.build_responses_query(since=time_window, limit=limit)
+        with self.db_handler.Session() as session:
+            df = pd.read_sql(text(query), session.connection(), params=params)
+        if df.empty:
+            return df
+        version, labels, probabilities, reduced = self.fit(self.embedding_store.get(df["text"].tolist()))
+        df["cluster_id"], df["cluster_prob"] = labels, probabilities
+        df["x"], df["y"] = reduced[:, 0], reduced[:, 1]
+        self._save(df, version, {"mode": "fit", "time_window": time_window, "limit": limit, "refit": refit})
+        return df
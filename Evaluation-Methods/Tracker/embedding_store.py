@@ -0,0 +1,50 @@
+import hashlib
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def text_hash(text):
+    # Exact text, not normalized: the embedding depends on case and spacing.
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """Embeddings computed once per (text, model) and kept in the embeddings table.
+
+    Vectors are stored as float16 blobs keyed by the hash of the text, so every
+    response with identical text shares one row. get() loads what exists in bulk
+    and only encodes the texts it has never seen. The embedder is fetched
+    through `embedder_factory` on the first miss, so a fully cached run never
+    loads the model.
+    """
+
+    def __init__(self, db_handler, embedder_factory, model_name):
+        self.db_handler = db_handler
+        self.embedder_factory = embedder_factory
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, texts):
+        texts = list(texts)
+        hashes = [text_hash(text) for text in texts]
+        unique = dict(zip(hashes, texts))
+        stored = self.db_handler.fetch_embeddings(self.model_name, unique)
+        vectors = {h: np.frombuffer(blob, dtype=np.float16, count=dim) for h, (dim, blob) in stored.items()}
+
+        missing = [h for h in unique if h not in vectors]
+        if missing:
+            encoded = np.asarray(self.embedder_factory().encode([unique[h] for h in missing]), dtype=np.float32)
+            records = []
+            for h, vector in zip(missing, encoded):
+                half = vector.astype(np.float16)
+                vectors[h] = half
+                records.append((h, half.shape[0], half.tobytes()))
+            self.db_handler.insert_embeddings(self.model_name, records)
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        logger.info(f"Embeddings: {len(unique) - len(missing)} loaded, {len(missing)} encoded ({len(texts)} texts, {len(unique)} unique).")
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[h] for h in hashes]).astype(np.float32)
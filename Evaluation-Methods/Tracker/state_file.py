@@ -0,0 +1,24 @@
+import fcntl
+import os
+from contextlib import contextmanager
+import numpy as np
+
+@contextmanager
+def locked(path):
+    # Exclusive flock on <path>.lock for the life of the block, so processes
+    # sharing an output_dir take turns at a read-modify-write of the state file.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def savez_atomic(path, **arrays):
+    # Written beside the target and renamed over it, so a reader never opens a
+    # half-written file.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from settings import settings
+from Tracker import state_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TIME_UNITS = {"seconds": 1, "minutes": 60, "hours": 3600, "days": 86400}
+
+class StreamClusterer:
+    """Online clustering over a decaying window of responses.
+
+    Keeps at most `max_micro` micro-clusters, each a summary of centroid,
+    decayed weight, decayed failure weight, creation and last-update time.
+    Weights halve every `half_life` time units, so old traffic fades smoothly
+    instead of underflowing the way exp(-alpha * seconds) does. Each new
+    response joins the most similar micro-cluster above `merge_threshold`
+    (cosine) or starts a new one, evicting the weakest when full. Macro-clusters
+    are built on demand by linking micro-clusters whose centroids are within
+    `macro_threshold` of each other.
+
+    Response ids are tracked as a settled watermark, below which every response
+    has been folded, plus the ids folded above it. Ids are allocated before
+    their transaction commits, so a plain high-water mark would skip a response
+    whose insert committed after a higher id. Several processes may fold into
+    the same file: do it inside `locked()`.
+    """
+
+    def __init__(self, path=None, half_life=None, time_unit=None, merge_threshold=None, macro_threshold=None, max_micro=None, min_weight=None):
+        self.path = path or os.path.join(settings.output_dir, "stream_clusters.npz")
+        self.half_life = (half_life or settings.stream_half_life) * TIME_UNITS[time_unit or settings.stream_time_unit]
+        self.merge_threshold = merge_threshold or settings.stream_merge_threshold
+        self.macro_threshold = macro_threshold or settings.stream_macro_threshold
+        self.max_micro = max_micro or settings.stream_max_micro
+        self.min_weight = settings.stream_min_weight if min_weight is None else min_weight
+        self._lock = threading.Lock()
+        self.centroids = None
+        self.weights = np.zeros(0)
+        self.failure_weights = np.zeros(0)
+        self.created = np.zeros(0)
+        self.updated = np.zeros(0)
+        self.last_response_id = 0
+        self.folded_ids = np.zeros(0, dtype=np.int64)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data, self._lock:
+            self.centroids = data["centroids"] if data["centroids"].size else None
+            self.weights, self.failure_weights = data["weights"], data["failure_weights"]
+            self.created, self.updated = data["created"], data["updated"]
+            self.last_response_id = int(data["last_response_id"])
+            self.folded_ids = data["folded_ids"] if "folded_ids" in data.files else np.zeros(0, dtype=np.int64)
+
+    @contextmanager
+    def locked(self):
+        # Holds the file lock, reloads whatever another process saved since, and
+        # saves on a clean exit, so concurrent folds are never overwritten.
+        with state_file.locked(self.path):
+            self._load()
+            yield self
+            self.save()
+
+    def _decay(self, now):
+        return np.power(0.5, np.maximum(now - self.updated, 0) / self.half_life)
+
+    def decayed_weights(self, now=None):
+        now = time.time() if now is None else now
+        return self.weights * self._decay(now), self.failure_weights * self._decay(now)
+
+    def _add_micro(self, vector, timestamp, failed):
+        if self.centroids is not None and len(self.weights) >= self.max_micro:
+            weakest = int(np.argmin(self.decayed_weights(timestamp)[0]))
+            self.centroids[weakest] = vector
+            self.weights[weakest], self.failure_weights[weakest] = 1.0, float(failed)
+            self.created[weakest] = self.updated[weakest] = timestamp
+            return
+        self.centroids = vector[None, :] if self.centroids is None else np.vstack([self.centroids, vector])
+        self.weights = np.append(self.weights, 1.0)
+        self.failure_weights = np.append(self.failure_weights, float(failed))
+        self.created = np.append(self.created, timestamp)
+        self.updated = np.append(self.updated, timestamp)
+
+    def fold(self, embeddings, timestamps, failed=None, response_ids=None):
+        # embeddings: (n, d); timestamps: epoch seconds; failed: per-response flags.
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        failed = np.zeros(len(embeddings), dtype=bool) if failed is None else np.asarray(failed, dtype=bool)
+        with self._lock:
+            for vector, timestamp, is_failure in zip(embeddings, timestamps, failed):
+                if self.centroids is None:
+                    self._add_micro(vector, timestamp, is_failure)
+                    continue
+                norms = np.maximum(np.linalg.norm(self.centroids, axis=1), 1e-12)
+                similarity = self.centroids @ vector / norms
+                best = int(np.argmax(similarity))
+                if similarity[best] < self.merge_threshold:
+                    self._add_micro(vector, timestamp, is_failure)
+                    continue
+                decay = 0.5 ** (max(timestamp - self.updated[best], 0) / self.half_life)
+                weight = self.weights[best] * decay
+                self.centroids[best] = (self.centroids[best] * weight + vector) / (weight + 1)
+                self.weights[best] = weight + 1
+                self.failure_weights[best] = self.failure_weights[best] * decay + float(is_failure)
+                self.updated[best] = max(self.updated[best], timestamp)
+            if response_ids is not None and len(response_ids):
+                self.folded_ids = np.union1d(self.folded_ids, np.asarray(response_ids, dtype=np.int64))
+
+    def advance(self, settled_id):
+        # Every response up to settled_id has been folded: move the watermark and
+        # forget the individual ids below it.
+        with self._lock:
+            self.last_response_id = max(self.last_response_id, int(settled_id))
+            self.folded_ids = self.folded_ids[self.folded_ids > self.last_response_id]
+
+    def macro_clusters(self, now=None):
+        # Union-find over live micro-clusters whose centroids are close enough.
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.centroids is None:
+                return []
+            weights, failure_weights = self.decayed_weights(now)
+            live = np.flatnonzero(weights >= self.min_weight)
+            centroids = self.centroids[live] / np.maximum(np.linalg.norm(self.centroids[live], axis=1, keepdims=True), 1e-12)
+            created = self.created[live]
+        parent = list(range(len(live)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        similarity = centroids @ centroids.T
+        for i, j in zip(*np.nonzero(np.triu(similarity >= self.macro_threshold, k=1))):
+            parent[find(i)] = find(j)
+
+        groups = {}
+        for position in range(len(live)):
+            groups.setdefault(find(position), []).append(position)
+        macros = []
+        for members in groups.values():
+            index = live[members]
+            weight = float(weights[index].sum())
+            failure_weight = float(failure_weights[index].sum())
+            macros.append({
+                "micro_clusters": [int(i) for i in index],
+                "weight": weight,
+                "failure_weight": failure_weight,
+                "failure_rate": failure_weight / weight if weight else 0.0,
+                # Share of the weight that appeared within the last half-life.
+                "emerging": float(weights[index][created[members] >= now - self.half_life].sum()) / weight if weight else 0.0,
+            })
+        macros.sort(key=lambda macro: macro["failure_weight"], reverse=True)
+        for macro_id, macro in enumerate(macros):
+            macro["macro_id"] = macro_id
+        return macros
+
+    def save(self):
+        with self._lock:
+            centroids = self.centroids if self.centroids is not None else np.zeros((0, 0), dtype=np.float32)
+            state_file.savez_atomic(self.path, centroids=centroids, weights=self.weights, failure_weights=self.failure_weights, created=self.created, updated=self.updated, last_response_id=self.last_response_id, folded_ids=self.folded_ids)
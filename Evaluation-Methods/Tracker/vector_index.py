@@ -0,0 +1,187 @@
+import logging
+import os
+from contextlib import contextmanager
+import numpy as np
+from settings import settings
+from Tracker import state_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def spherical_kmeans(vectors, k, iterations=15, seed=0):
+    # Cosine k-means on unit vectors; empty clusters are re-seeded from random points.
+    # k is capped at the number of vectors.
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+class IVFIndex:
+    """Inverted-file cosine index over response embeddings, in NumPy.
+
+    Vectors are bucketed under the nearest of `nlist` k-means centroids, and a
+    query only scans the `nprobe` buckets whose centroids are closest to it.
+    Vectors are kept as float16 and the index is persisted as one .npz. Adds are
+    incremental; the centroids are retrained once the index has grown
+    `retrain_factor` times past the size they were trained on. Below
+    `min_train` vectors the index is a plain brute-force scan. An index saved
+    under a different `model_name` is discarded rather than mixed with new vectors.
+
+    `last_response_id` is a settled watermark: every response up to it is in
+    the index, and ids above it may be too (see StreamClusterer). Processes
+    sharing the file add to it inside `locked()`.
+    """
+
+    def __init__(self, path, model_name, nlist=None, nprobe=None, retrain_factor=4, min_train=1000):
+        self.path = path
+        self.model_name = model_name
+        self.nlist = nlist or settings.vector_index_nlist
+        self.nprobe = nprobe or settings.vector_index_nprobe
+        self.retrain_factor = retrain_factor
+        self.min_train = min_train
+        self._loaded_from = None
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        self.centroids = None
+        self.trained_size = 0
+        self.last_response_id = 0
+        self.lists = []
+        self._flat_ids = np.zeros(0, dtype=np.int64)
+        self._flat_vectors = None
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load(self):
+        # Only rereads the file when another process has replaced it since.
+        if not os.path.exists(self.path) or self._file_signature() == self._loaded_from:
+            return
+        self._reset()
+        self._loaded_from = self._file_signature()
+        with np.load(self.path) as data:
+            if str(data["model_name"]) != self.model_name:
+                logger.warning(f"Ignoring vector index at {self.path}: built with {data['model_name']}, not {self.model_name}.")
+                return
+            self.trained_size = int(data["trained_size"])
+            self.last_response_id = int(data["last_response_id"])
+            ids, vectors = data["ids"], data["vectors"]
+            if data["centroids"].size:
+                self.centroids = data["centroids"]
+                self._build_lists(ids, vectors, data["assignment"])
+            else:
+                self._flat_ids, self._flat_vectors = ids, vectors if vectors.size else None
+
+    @contextmanager
+    def locked(self):
+        # Holds the file lock, picks up whatever another process saved since, and
+        # saves on a clean exit if anything was added.
+        with state_file.locked(self.path):
+            self._load()
+            before = (len(self), self.last_response_id)
+            yield self
+            if (len(self), self.last_response_id) != before:
+                self.save()
+
+    def __len__(self):
+        if self.centroids is None:
+            return len(self._flat_ids)
+        return sum(len(ids) for ids, _ in self.lists)
+
+    def _all(self):
+        if self.centroids is None:
+            return self._flat_ids, self._flat_vectors
+        ids = np.concatenate([ids for ids, _ in self.lists])
+        vectors = np.concatenate([vectors for _, vectors in self.lists])
+        return ids, vectors
+
+    def _build_lists(self, ids, vectors, assignment):
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        self.lists = [(ids[order[start:end]], vectors[order[start:end]]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def train(self):
+        ids, vectors = self._all()
+        if vectors is None or not len(ids):
+            return
+        # VECTOR_INDEX_NLIST may exceed what a small or fresh database holds.
+        nlist = min(self.nlist or max(1, int(np.sqrt(len(ids)))), len(ids))
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), size=min(len(vectors), 256 * nlist), replace=False)].astype(np.float32)
+        self.centroids = spherical_kmeans(sample, nlist)
+        self._build_lists(ids, vectors, self._assign(vectors))
+        self.trained_size = len(ids)
+        self._flat_ids, self._flat_vectors = np.zeros(0, dtype=np.int64), None
+        logger.info(f"Trained IVF index: {len(ids)} vectors in {nlist} lists.")
+
+    def _assign(self, vectors, chunk_size=65536):
+        return np.concatenate([np.argmax(vectors[i:i + chunk_size].astype(np.float32) @ self.centroids.T, axis=1) for i in range(0, len(vectors), chunk_size)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = _normalize(vectors).astype(np.float16)
+        if self.centroids is None:
+            self._flat_ids = np.concatenate([self._flat_ids, ids])
+            self._flat_vectors = vectors if self._flat_vectors is None else np.concatenate([self._flat_vectors, vectors])
+            if len(self._flat_ids) >= self.min_train:
+                self.train()
+            return
+        assignment = self._assign(vectors)
+        for list_id in np.unique(assignment):
+            mask = assignment == list_id
+            list_ids, list_vectors = self.lists[list_id]
+            self.lists[list_id] = (np.concatenate([list_ids, ids[mask]]), np.concatenate([list_vectors, vectors[mask]]))
+        if len(self) > self.retrain_factor * self.trained_size:
+            self.train()
+
+    def unsettled_ids(self):
+        # Ids already indexed above the watermark, for the next sync to skip.
+        ids = self._all()[0]
+        return ids[ids > self.last_response_id]
+
+    def advance(self, settled_id):
+        self.last_response_id = max(self.last_response_id, int(settled_id))
+
+    def search(self, query, k=10, nprobe=None, exclude=()):
+        # Returns [(id, cosine similarity)], best first.
+        query = _normalize(query)
+        if self.centroids is None:
+            ids, vectors = self._flat_ids, self._flat_vectors
+            if vectors is None:
+                return []
+        else:
+            probe = np.argsort(-(self.centroids @ query))[:nprobe or self.nprobe]
+            ids = np.concatenate([self.lists[i][0] for i in probe])
+            vectors = np.concatenate([self.lists[i][1] for i in probe])
+        scores = vectors.astype(np.float32) @ query
+        if exclude:
+            scores[np.isin(ids, list(exclude))] = -np.inf
+        top = min(k, len(scores))
+        best = np.argpartition(-scores, top - 1)[:top] if top else np.zeros(0, dtype=np.int64)
+        best = best[np.argsort(-scores[best])]
+        return [(int(ids[i]), float(scores[i])) for i in best if np.isfinite(scores[i])]
+
+    def save(self):
+        ids, vectors = self._all()
+        if vectors is None:
+            vectors = np.zeros((0, 0), dtype=np.float16)
+        if self.centroids is None:
+            centroids, assignment = np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        else:
+            centroids = self.centroids
+            assignment = np.concatenate([np.full(len(list_ids), list_id) for list_id, (list_ids, _) in enumerate(self.lists)])
+        state_file.savez_atomic(self.path, model_name=self.model_name, ids=ids, vectors=vectors, centroids=centroids, assignment=assignment, trained_size=self.trained_size, last_response_id=self.last_response_id)
+        self._loaded_from = self._file_signature()
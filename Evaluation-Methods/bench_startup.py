@@ -0,0 +1,75 @@
+"""Startup-time benchmark for cli.py subcommands.
+
+For each subcommand, a fresh interpreter imports cli, builds a UnifiedRunner
+and touches the components that subcommand uses, and reports the median
+time of each phase over --repeat runs. Components that can't be built here
+(no database, no API key) are reported with their error, after the time
+spent getting that far.
+
+    python bench_startup.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+COMPONENTS = {
+    "ingest": ["prompt_ingestor"],
+    "eval": ["bot_api", "evaluator", "router"],
+    "cluster": ["cluster_engine", "visualizer"],
+    "run-tests": ["test_manager"],
+    "export": ["cluster_engine", "visualizer"],
+    "retention": ["db_handler"],
+    "report": ["db_handler"],
+    "enqueue": ["db_handler"],
+    "worker": ["bot_api", "evaluator", "router"],
+    "similar": ["cluster_engine"],
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import cli
+from unified_runner import UnifiedRunner
+timings = {"import": time.perf_counter() - start}
+runner = UnifiedRunner()
+error = None
+for name in sys.argv[1:]:
+    t = time.perf_counter()
+    try:
+        getattr(runner, name)
+    except Exception as e:
+        error = f"{name}: {type(e).__name__}: {e}"
+        break
+    finally:
+        timings[name] = time.perf_counter() - t
+timings["total"] = time.perf_counter() - start
+print(json.dumps({"timings": timings, "modules": len(sys.modules), "error": error}))
+"""
+
+def probe(components):
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, "-c", PROBE, *components], cwd=here, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        return {"timings": {}, "modules": 0, "error": (result.stderr.strip().splitlines() or ["probe failed"])[-1]}
+    return json.loads(lines[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--commands", help="Comma-separated subcommands (default: all)")
+    args = parser.parse_args()
+
+    commands = args.commands.split(",") if args.commands else list(COMPONENTS)
+    print(f"{'command':<10} {'import':>8} {'total':>8} {'modules':>8}  notes")
+    for command in commands:
+        runs = [probe(COMPONENTS[command]) for _ in range(args.repeat)]
+        median = lambda key: statistics.median(run["timings"].get(key, float("nan")) for run in runs)
+        error = runs[-1]["error"] or ""
+        print(f"{command:<10} {median('import'):>7.3f}s {median('total'):>7.3f}s {runs[-1]['modules']:>8}  {error[:80]}")
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,199 @@
+import asyncio
+import random
+import threading
+import time
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import logging
 from settings import settings
+from response_cache import ResponseCache
+from metrics import registry
+from budget import BudgetExceeded, current_stage
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+)
+
+LLM_CALLS = registry.counter("llm_calls_total", "LLM API call attempts by provider and outcome", ("provider", "outcome"))
+LLM_CALL_SECONDS = registry.histogram("llm_call_seconds", "LLM API call latency, including streaming", ("provider",))
+
 class ChatbotAPI:
-    def __init__(self):
+    def __init__(self, max_in_flight=None, timeout=None, max_retries=None, cache=None, budget=None):
         if not settings.gemini_api_key:
             raise ValueError("GOOGLE_API_KEY environment variable not set.")
         genai.configure(api_key=settings.gemini_api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-pro')
+        self.model_name = settings.gemini_model
+        self.model = genai.GenerativeModel(self.model_name)
+        self._active = (self.model_name, self.model)
+        self.budget = budget
+        self.max_in_flight = max_in_flight or settings.gemini_max_in_flight
+        self.timeout = timeout or settings.gemini_timeout
+        self.max_retries = settings.gemini_max_retries if max_retries is None else max_retries
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._semaphore = None
+        self.cache = cache if cache is not None else (ResponseCache() if settings.response_cache_enabled else None)
+
+    def enable_cache(self, bypass=False):
+        if self.cache is None:
+            self.cache = ResponseCache(bypass=bypass)
+        self.cache.bypass = bypass
+
+    def _background_loop(self):
+        # Every Gemini call runs on one event loop owned by this client, so the
+        # in-flight limit holds across all threads and callers sharing it.
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True).start()
+        return self._loop
+
+    def _current_model(self):
+        # The budget tracker may switch us to a cheaper model mid-run, from any
+        # thread, so the name and model are swapped and read as one pair.
+        if self.budget is not None:
+            name = self.budget.model_for(settings.gemini_model)
+            if name != self.model_name:
+                with self._loop_lock:
+                    if name != self.model_name:
+                        self.model = genai.GenerativeModel(name)
+                        self.model_name = name
+                        self._active = (name, self.model)
+        return self._active
+
+    def _build_prompt(self, prompt_text, system_prompt=None, context_snippets=None):
+        full_prompt = []
+        if system_prompt:
+            full_prompt.append(system_prompt)
+        if context_snippets:
+            full_prompt.extend(context_snippets)
+        full_prompt.append(prompt_text)
+        return " ".join(full_prompt)
+
+    async def _call(self, model, contents, on_chunk):
+        # Returns (text, usage_metadata); when streaming, usage arrives on the last chunk.
+        request_options = {"timeout": self.timeout}
+        if on_chunk is None:
+            response = await model.generate_content_async(contents, request_options=request_options)
+            return response.text, getattr(response, "usage_metadata", None)
+        chunks, usage = [], None
+        response = await model.generate_content_async(contents, stream=True, request_options=request_options)
+        async for chunk in response:
+            chunks.append(chunk.text)
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            on_chunk(chunk.text)
+        return "".join(chunks), usage
+
+    def _record_usage(self, model, usage, stage_name):
+        if self.budget is None or usage is None:
+            return
+        self.budget.record("gemini", model.model_name.split("/")[-1], getattr(usage, "prompt_token_count", 0) or 0, getattr(usage, "candidates_token_count", 0) or 0, stage_name)
+
+    def _resumable(self, on_chunk, delivered):
+        # A retried stream starts over from the first token. Only the text past
+        # what on_chunk already received (delivered[0] characters) is passed on,
+        # so callers never see a chunk twice.
+        if on_chunk is None:
+            return None
+        seen = 0
+        def forward(text):
+            nonlocal seen
+            seen += len(text)
+            if seen > delivered[0]:
+                on_chunk(text[len(text) - (seen - delivered[0]):])
+                delivered[0] = seen
+        return forward
 
-    def get_response(self, prompt_text, system_prompt=None, context_snippets=None):
+    async def _generate(self, model, contents, on_chunk=None, stage_name=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        delivered = [0]
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    response_text, usage = await asyncio.wait_for(self._call(model, contents, self._resumable(on_chunk, delivered)), timeout=self.timeout)
+                    LLM_CALLS.inc(provider="gemini", outcome="ok")
+                    self._record_usage(model, usage, stage_name)
+                    return response_text
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        LLM_CALLS.inc(provider="gemini", outcome="error")
+                        raise
+                    LLM_CALLS.inc(provider="gemini", outcome="retry")
+                    # Full jitter keeps concurrent workers from retrying in lockstep.
+                    delay = random.uniform(0, min(settings.gemini_retry_max_delay, settings.gemini_retry_base_delay * 2 ** attempt))
+                    logger.warning(f"Gemini call failed ({type(e).__name__}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                except Exception:
+                    LLM_CALLS.inc(provider="gemini", outcome="error")
+                    raise
+                finally:
+                    LLM_CALL_SECONDS.observe(time.perf_counter() - start, provider="gemini")
+
+    def _submit(self, model, prompt_text, system_prompt, context_snippets, on_chunk):
+        # Budget and stage are resolved here, on the caller's thread.
+        if self.budget is not None:
+            self.budget.check()
+        contents = self._build_prompt(prompt_text, system_prompt, context_snippets)
+        return asyncio.run_coroutine_threadsafe(self._generate(model, contents, on_chunk, current_stage()), self._background_loop())
+
+    def _cache_lookup(self, model, prompt_text, system_prompt, context_snippets, use_cache):
+        if self.cache is None or not use_cache:
+            return None, None
+        key = ResponseCache.make_key(model.model_name, system_prompt, context_snippets, prompt_text)
+        return key, self.cache.get(key)
+
+    async def get_response_async(self, prompt_text, system_prompt=None, context_snippets=None, on_chunk=None, use_cache=True, with_model=False):
+        # With with_model, returns (text, model name) for the model that actually answered.
+        model_name, model = self._current_model()
+        key, cached = self._cache_lookup(model, prompt_text, system_prompt, context_snippets, use_cache)
+        if cached is not None:
+            if on_chunk:
+                on_chunk(cached)
+            return (cached, model_name) if with_model else cached
         try:
-            full_prompt = []
-            if system_prompt:
-                full_prompt.append(system_prompt)
-            if context_snippets:
-                full_prompt.extend(context_snippets)
-            full_prompt.append(prompt_text)
-            
-            response = self.model.generate_content(" ".join(full_prompt))
-            return response.text
+            response_text = await asyncio.wrap_future(self._submit(model, prompt_text, system_prompt, context_snippets, on_chunk))
+        except BudgetExceeded:
+            raise
         except Exception as e:
             logger.error(f"Error calling Gemini API: {e}")
             raise ConnectionError("Failed to get response from Gemini API.") from e
+        if key:
+            self.cache.put(key, response_text)
+        return (response_text, model_name) if with_model else response_text
+
+    def get_response(self, prompt_text, system_prompt=None, context_snippets=None, on_chunk=None, use_cache=True, with_model=False):
+        # With with_model, returns (text, model name) for the model that actually answered.
+        model_name, model = self._current_model()
+        key, cached = self._cache_lookup(model, prompt_text, system_prompt, context_snippets, use_cache)
+        if cached is not None:
+            if on_chunk:
+                on_chunk(cached)
+            return (cached, model_name) if with_model else cached
+        try:
+            response_text = self._submit(model, prompt_text, system_prompt, context_snippets, on_chunk).result()
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logger.error(f"Error calling Gemini API: {e}")
+            raise ConnectionError("Failed to get response from Gemini API.") from e
+        if key:
+            self.cache.put(key, response_text)
+        return (response_text, model_name) if with_model else response_text
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+            self._semaphore = None
+        if self.cache is not None:
+            self.cache.close()
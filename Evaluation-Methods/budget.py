@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date
+from settings import settings
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# USD per 1K tokens as (prompt, completion). Override or extend with PRICE_TABLE,
+# either inline JSON or a path to a JSON file of the same shape.
+DEFAULT_PRICES = {
+    "gemini-1.5-pro": (0.00125, 0.005),
+    "gemini-1.5-flash": (0.000075, 0.0003),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4o": (0.0025, 0.01),
+    "gpt-4o-mini": (0.00015, 0.0006),
+}
+
+LLM_TOKENS = registry.counter("llm_tokens_total", "LLM tokens used by provider, model, stage and direction", ("provider", "model", "stage", "direction"))
+LLM_COST = registry.counter("llm_cost_usd_total", "Estimated LLM spend in USD by provider, model and stage", ("provider", "model", "stage"))
+
+_local = threading.local()
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+def load_price_table(spec=None):
+    spec = settings.price_table if spec is None else spec
+    prices = dict(DEFAULT_PRICES)
+    if spec:
+        if os.path.exists(spec):
+            with open(spec) as f:
+                spec = f.read()
+        prices.update({model: tuple(price) for model, price in json.loads(spec).items()})
+    return prices
+
+@contextmanager
+def stage(name):
+    # Labels LLM calls made by this thread inside the block, e.g. "generate" or "judge".
+    previous = getattr(_local, "stage", None)
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+def current_stage():
+    return getattr(_local, "stage", None) or "other"
+
+class BudgetTracker:
+    """Shared token and cost accounting for LLM calls.
+
+    Callers check() before a call and record() its usage after. Once spend
+    reaches `degrade_at` of the run or daily budget, model_for() switches to the
+    fallback model; at the full budget check() raises BudgetExceeded and
+    on_exceeded (e.g. the pipeline's stop) is called once. Budgets of 0 are
+    unlimited. With a db_handler, usage is written to token_usage and the daily
+    budget counts spend from every process that day: the day's total is re-read
+    at start_run(), on every flush and when the date changes, so a run that
+    starts past either threshold is degraded or refused before its first call.
+    """
+
+    def __init__(self, db_handler=None, run_budget=None, daily_budget=None, fallback_model=None, degrade_at=None, prices=None):
+        self.db_handler = db_handler
+        self.run_budget = settings.run_budget_usd if run_budget is None else run_budget
+        self.daily_budget = settings.daily_budget_usd if daily_budget is None else daily_budget
+        self.fallback_model = settings.budget_fallback_model if fallback_model is None else fallback_model
+        self.degrade_at = settings.budget_degrade_at if degrade_at is None else degrade_at
+        self.prices = prices or load_price_table()
+        self.on_exceeded = None
+        self._lock = threading.Lock()
+        self._unpriced = set()
+        self.start_run()
+
+    def start_run(self, run_id=None):
+        with self._lock:
+            self.run_id = run_id
+            self.totals = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+            self.run_cost = 0.0
+            self.degraded = False
+            self.exceeded = False
+            self._pending = []
+            self._pending_cost = 0.0
+            self._day = date.today()
+            self._day_cost = 0.0
+        self._refresh_day_cost()
+        # Today's spend may already be past the daily budget (or the degrade
+        # point): settle that now, before the run's first call.
+        with self._lock:
+            self._apply_limits()
+
+    def _refresh_day_cost(self):
+        # Today's flushed spend across all processes; unflushed records are in _pending_cost.
+        if not (self.db_handler and self.daily_budget):
+            return
+        day = self._day
+        try:
+            total = self.db_handler.fetch_token_cost_since(day)
+        except Exception as e:
+            logger.warning(f"Could not refresh today's LLM spend: {e}")
+            return
+        with self._lock:
+            if day == self._day:
+                self._day_cost = total
+
+    def _roll_day(self):
+        with self._lock:
+            today = date.today()
+            if today == self._day:
+                return
+            self._day, self._day_cost = today, 0.0
+        logger.info(f"New day {today}; daily LLM budget reset.")
+        self._refresh_day_cost()
+
+    def price(self, model, prompt_tokens, completion_tokens):
+        # Model names may carry a prefix ("models/...") or a version suffix.
+        name = model.split("/")[-1]
+        match = max((known for known in self.prices if name.startswith(known)), key=len, default=None)
+        if match is None:
+            if name not in self._unpriced:
+                self._unpriced.add(name)
+                logger.warning(f"No price for model {name}; counting its tokens at $0.")
+            return 0.0
+        prompt_price, completion_price = self.prices[match]
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def _fraction_used(self):
+        fractions = []
+        if self.run_budget:
+            fractions.append(self.run_cost / self.run_budget)
+        if self.daily_budget:
+            fractions.append((self._day_cost + self._pending_cost) / self.daily_budget)
+        return max(fractions, default=0.0)
+
+    def model_for(self, model):
+        return self.fallback_model if self.degraded and self.fallback_model else model
+
+    def _apply_limits(self):
+        # Caller holds the lock. Returns True the first time the budget runs out.
+        used = self._fraction_used()
+        if not self.degraded and self.fallback_model and used >= self.degrade_at:
+            self.degraded = True
+            logger.warning(f"LLM spend at {used:.0%} of budget; switching to {self.fallback_model}.")
+        if not self.exceeded and used >= 1.0:
+            self.exceeded = True
+            logger.error(f"LLM budget exhausted (run ${self.run_cost:.4f}, today ${self._day_cost + self._pending_cost:.4f}); stopping.")
+            return True
+        return False
+
+    def check(self):
+        # Re-evaluated on every call, so spend other processes flushed since the
+        # last refresh stops this one before it makes another call.
+        with self._lock:
+            notify = self._apply_limits()
+            exceeded = self.exceeded
+        if notify and self.on_exceeded:
+            self.on_exceeded()
+        if exceeded:
+            raise BudgetExceeded(f"LLM budget exhausted (run ${self.run_cost:.4f}).")
+
+    def record(self, provider, model, prompt_tokens, completion_tokens, stage_name=None):
+        stage_name = stage_name or current_stage()
+        if date.today() != self._day:
+            self._roll_day()
+        cost = self.price(model, prompt_tokens, completion_tokens)
+        LLM_TOKENS.inc(prompt_tokens, provider=provider, model=model, stage=stage_name, direction="prompt")
+        LLM_TOKENS.inc(completion_tokens, provider=provider, model=model, stage=stage_name, direction="completion")
+        LLM_COST.inc(cost, provider=provider, model=model, stage=stage_name)
+        with self._lock:
+            totals = self.totals[(provider, model, stage_name)]
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost
+            self.run_cost += cost
+            self._pending.append((self.run_id, provider, model, stage_name, prompt_tokens, completion_tokens, cost))
+            self._pending_cost += cost
+            notify = self._apply_limits()
+            flush = len(self._pending) >= settings.budget_flush_every
+        if flush:
+            self.flush()
+        if notify and self.on_exceeded:
+            self.on_exceeded()
+        return cost
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        flushed_cost = sum(row[-1] for row in pending)
+        if pending and self.db_handler:
+            self.db_handler.insert_token_usage(pending)
+        if self.db_handler and self.daily_budget:
+            self._refresh_day_cost()
+        with self._lock:
+            # Once in token_usage the cost is part of _day_cost; without a
+            # database this process's own spend is all the daily budget sees.
+            self._pending_cost -= flushed_cost
+            if not (self.db_handler and self.daily_budget):
+                self._day_cost += flushed_cost
+
+    def summary(self):
+        with self._lock:
+            prompt_tokens = sum(totals["prompt_tokens"] for totals in self.totals.values())
+            completion_tokens = sum(totals["completion_tokens"] for totals in self.totals.values())
+            return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cost_usd": self.run_cost,
+                    "by_stage": [{"provider": provider, "model": model, "stage": stage_name, **totals} for (provider, model, stage_name), totals in sorted(self.totals.items())]}
@@ -1,45 +1,128 @@
 import argparse
+import os
 from unified_runner import UnifiedRunner
+from worker import run_workers
+from metrics import registry
+from settings import settings
 
 def main():
     parser = argparse.ArgumentParser(description="Mental Health Chatbot Evaluation System")
+    parser.add_argument("--metrics-port", type=int, default=settings.metrics_port, help="Serve Prometheus metrics on this local port (default METRICS_PORT, 0 = off)")
     subparsers = parser.add_subparsers(dest="command")
 
     ingest_parser = subparsers.add_parser("ingest")
-    ingest_parser.add_argument("--source", required=True, help="Path to file or 'db'")
+    ingest_parser.add_argument("--source", required=True, help="Path to a .csv, .json or .jsonl prompt file")
+    ingest_parser.add_argument("--batch-size", type=int, help="Rows per bulk insert (default INGEST_BATCH_SIZE)")
+    ingest_parser.add_argument("--no-dedup", action="store_true", help="Skip duplicate detection for this ingest")
 
     eval_parser = subparsers.add_parser("eval")
     eval_parser.add_argument("--source", default="redteam", help="persona, redteam, or dataset")
     eval_parser.add_argument("--limit", type=int, default=10, help="Number of prompts to evaluate")
+    eval_parser.add_argument("--concurrency", type=int, default=1, help="Workers per pipeline stage")
+    eval_parser.add_argument("--sample", action="store_true", help="Evaluate a stratified sample sized for --margin instead of the first --limit prompts")
+    eval_parser.add_argument("--margin", type=float, default=0.1, help="Target margin of error on mean scores when sampling")
+    eval_parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level for sample size and intervals")
+    eval_parser.add_argument("--seed", type=int, default=0, help="Random seed, for repeatable samples")
+    eval_parser.add_argument("--canonical-only", action="store_true", help="Skip prompts marked as duplicates at ingest")
+    eval_parser.add_argument("--force", action="store_true", help="Re-evaluate prompts already judged under the current configuration")
+    eval_parser.add_argument("--cache", action="store_true", help="Reuse cached Gemini replies for unchanged prompts")
+    eval_parser.add_argument("--refresh-cache", action="store_true", help="Ignore cached replies but store the fresh ones")
 
     cluster_parser = subparsers.add_parser("cluster")
-    cluster_parser.add_argument("--since", help="Timestamp to start clustering from")
-    cluster_parser.add_argument("--method", default="auto", help="auto or fallback")
+    cluster_parser.add_argument("--since", help="Timestamp (ISO) or relative window (e.g. 7d, 12h) to start clustering from")
+    cluster_parser.add_argument("--method", default="auto", help="auto, fallback, incremental (assign new responses with the saved model), or stream (fold new responses into decaying micro-clusters)")
+    cluster_parser.add_argument("--limit", type=int, default=1000, help="Responses to fit on, or to assign or fold per incremental or stream run")
+    cluster_parser.add_argument("--refit", action="store_true", help="With --method incremental, refit the saved model now")
 
     test_parser = subparsers.add_parser("run-tests")
     test_parser.add_argument("--test-ids", required=True, help="Comma-separated list of test IDs")
     test_parser.add_argument("--prompts", default="dataset", help="Source of prompts to run tests on")
+    test_parser.add_argument("--concurrency", type=int, default=4, help="Concurrent web-context fetches and judge calls")
 
     export_parser = subparsers.add_parser("export")
     export_parser.add_argument("--clusters", action="store_true", help="Export cluster data")
     export_parser.add_argument("--path", default="output/export.csv", help="Output path for CSV")
+    export_parser.add_argument("--since", help="Timestamp (ISO) or relative window (e.g. 7d, 12h) to export from")
+
+    retention_parser = subparsers.add_parser("retention")
+    retention_parser.add_argument("--months", type=int, help="Override RESPONSE_RETENTION_MONTHS")
+    retention_parser.add_argument("--partitions-ahead", type=int, help="Also pre-create this many future monthly partitions")
+
+    report_parser = subparsers.add_parser("report")
+    report_parser.add_argument("--source", help="Restrict the report to one prompt source")
+    report_parser.add_argument("--since", help="First day (YYYY-MM-DD) to include")
+    report_parser.add_argument("--until", help="Last day (YYYY-MM-DD) to include")
+    report_parser.add_argument("--daily", action="store_true", help="Show one row per day instead of a summary")
+    report_parser.add_argument("--rebuild", action="store_true", help="Recompute rollups from raw eval rows first")
+    report_parser.add_argument("--fingerprint", help="Restrict the report to one configuration fingerprint")
+
+    enqueue_parser = subparsers.add_parser("enqueue")
+    enqueue_parser.add_argument("--source", default="redteam", help="Prompt source to queue for evaluation")
+    enqueue_parser.add_argument("--limit", type=int, help="Queue at most this many prompts")
+    enqueue_parser.add_argument("--canonical-only", action="store_true", help="Skip prompts marked as duplicates at ingest")
+    enqueue_parser.add_argument("--force", action="store_true", help="Also queue prompts already judged under the current configuration")
+
+    similar_parser = subparsers.add_parser("similar")
+    similar_query = similar_parser.add_mutually_exclusive_group(required=True)
+    similar_query.add_argument("--response-id", type=int, help="Find responses similar to this stored response")
+    similar_query.add_argument("--text", help="Find responses similar to this text")
+    similar_parser.add_argument("--k", type=int, default=10, help="Number of neighbours to return")
+
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("--workers", type=int, default=1, help="Worker processes to start on this machine")
+    worker_parser.add_argument("--batch-size", type=int, help="Jobs claimed per batch (default WORKER_BATCH_SIZE)")
+    worker_parser.add_argument("--concurrency", type=int, default=1, help="Workers per pipeline stage within each process")
+    worker_parser.add_argument("--exit-when-idle", action="store_true", help="Stop once the queue is empty instead of polling")
+
+    subparsers.add_parser("migrate", help="Bring the database schema up to date (needed when AUTO_MIGRATE is off)")
 
     args = parser.parse_args()
+    if args.command == "migrate":
+        from db import DatabaseHandler
+        DatabaseHandler(migrate=True)
+        return
+    if args.command == "worker":
+        # Each worker process builds its own runner and serves its own metrics.
+        run_workers(args.workers, batch_size=args.batch_size, concurrency=args.concurrency, exit_when_idle=args.exit_when_idle, metrics_port=args.metrics_port)
+        return
+    if args.metrics_port:
+        registry.serve(args.metrics_port)
+    if settings.metrics_dump:
+        registry.dump_at_exit(os.path.join(settings.output_dir, f"metrics_{args.command}.json"))
     runner = UnifiedRunner()
 
     if args.command == "ingest":
-        runner.prompt_ingestor.ingest_from_file(args.source, 'cli-ingest')
+        runner.prompt_ingestor.ingest_from_file(args.source, 'cli-ingest', batch_size=args.batch_size, dedup=False if args.no_dedup else None)
     elif args.command == "eval":
-        runner.run_evaluation_cycle(args.source, args.limit)
+        if args.cache or args.refresh_cache:
+            runner.bot_api.enable_cache(bypass=args.refresh_cache)
+        if args.sample:
+            runner.run_sampled_evaluation(args.source.split(','), margin=args.margin, confidence=args.confidence, seed=args.seed, concurrency=args.concurrency, canonical_only=args.canonical_only)
+        else:
+            runner.run_evaluation_cycle(args.source, args.limit, concurrency=args.concurrency, canonical_only=args.canonical_only, force=args.force)
     elif args.command == "cluster":
-        runner.cluster_and_analyze(time_window=args.since, method=args.method)
+        if args.method == "stream":
+            runner.stream_cluster(limit=args.limit, since=args.since)
+        else:
+            runner.cluster_and_analyze(time_window=args.since, limit=args.limit, method=args.method, refit=args.refit)
     elif args.command == "run-tests":
         test_ids = [int(tid) for tid in args.test_ids.split(',')]
-        runner.run_psych_tests_sequential(test_ids, args.prompts)
+        runner.run_psych_tests_parallel(test_ids, args.prompts, concurrency=args.concurrency)
     elif args.command == "export":
         if args.clusters:
-            df = runner.cluster_engine.cluster_and_save(limit=10000)
+            df = runner.cluster_engine.cluster_and_save(time_window=args.since, limit=10000)
             runner.visualizer.save_cluster_csv(df, args.path)
+    elif args.command == "retention":
+        if runner.db_handler.partitioned:
+            runner.db_handler.ensure_response_partitions(months_ahead=args.partitions_ahead)
+        runner.db_handler.apply_retention(months=args.months)
+    elif args.command == "enqueue":
+        queued = runner.db_handler.enqueue_jobs(args.source, limit=args.limit, canonical_only=args.canonical_only, fingerprint=None if args.force else runner.config_fingerprint())
+        print(f"Queued {queued} prompts; queue now {runner.db_handler.job_counts()}")
+    elif args.command == "similar":
+        runner.find_similar(response_id=args.response_id, text=args.text, k=args.k)
+    elif args.command == "report":
+        runner.report_scores(source=args.source, since=args.since, until=args.until, daily=args.daily, rebuild=args.rebuild, fingerprint=args.fingerprint)
 
 if __name__ == "__main__":
     main()
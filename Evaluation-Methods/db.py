@@ -1,130 +1,1028 @@
+import io
+import json
 import logging
-from sqlalchemy import create_engine, inspect, text
+import re
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import column, create_engine, event, insert, inspect, table, text
 from sqlalchemy.orm import sessionmaker
 from settings import settings
+from metrics import registry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tables that hang off chatbot_responses. They carry the response's created_at
+# so that, when responses are partitioned by month, they can be partitioned on
+# the same key and dropped partition-by-partition under the retention policy.
+DEPENDENT_TABLES = {
+    "rule_eval": """
+        crisis_detected BOOLEAN,
+        helpline_detected BOOLEAN,
+        toxicity_score FLOAT""",
+    "llm_eval": """
+        safety_score INTEGER,
+        empathy_score INTEGER,
+        helpfulness_score INTEGER,
+        rationale TEXT""",
+    "failure_log": """
+        routed_to VARCHAR(255),
+        reason TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP""",
+    "clusters": """
+        cluster_id INTEGER,
+        cluster_prob FLOAT,
+        model_version INTEGER,
+        run_id INTEGER""",
+}
+
+RESPONSE_CREATED_AT_SQL = "(SELECT created_at FROM chatbot_responses WHERE id = :response_id)"
+
+prompts_table = table("prompts", column("id"), column("source"), column("text"), column("text_hash"))
+responses_table = table("chatbot_responses", column("id"), column("prompt_id"), column("response_text"), column("model_version"), column("run_id"), column("fingerprint"), column("created_at"))
+
+def _responses_table_sql(partitioned):
+    if partitioned:
+        return """
+            CREATE TABLE chatbot_responses (
+                id SERIAL,
+                prompt_id INTEGER REFERENCES prompts(id),
+                response_text TEXT,
+                model_version VARCHAR(255),
+                run_id INTEGER,
+                fingerprint CHAR(64),
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at);"""
+    return """
+        CREATE TABLE chatbot_responses (
+            id SERIAL PRIMARY KEY,
+            prompt_id INTEGER REFERENCES prompts(id),
+            response_text TEXT,
+            model_version VARCHAR(255),
+            run_id INTEGER,
+            fingerprint CHAR(64),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );"""
+
+def _dependent_table_sql(name, columns, partitioned):
+    if partitioned:
+        return f"""
+            CREATE TABLE {name} (
+                id SERIAL,
+                response_id INTEGER,
+                response_created_at TIMESTAMP NOT NULL,{columns},
+                PRIMARY KEY (id, response_created_at),
+                FOREIGN KEY (response_id, response_created_at) REFERENCES chatbot_responses(id, created_at)
+            ) PARTITION BY RANGE (response_created_at);"""
+    return f"""
+        CREATE TABLE {name} (
+            id SERIAL PRIMARY KEY,
+            response_id INTEGER REFERENCES chatbot_responses(id),
+            response_created_at TIMESTAMP,{columns}
+        );"""
+
+def _month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def _add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1)
+
+def parse_since(value):
+    """Accepts a datetime, an ISO timestamp/date, or a relative window such as '30m', '12h', '7d' or '4w'."""
+    if value is None or isinstance(value, datetime):
+        return value
+    value = str(value).strip()
+    match = re.fullmatch(r"(\d+)\s*([mhdw])", value.lower())
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        delta = {"m": timedelta(minutes=amount), "h": timedelta(hours=amount), "d": timedelta(days=amount), "w": timedelta(weeks=amount)}[unit]
+        return datetime.now() - delta
+    return datetime.fromisoformat(value)
+
+# Rollups are keyed by (source, day, model_version, fingerprint) and updated in
+# the same transaction as the raw eval row, so they never drift from
+# llm_eval/rule_eval. The fingerprint (UnifiedRunner.config_fingerprint) covers the
+# system prompt and judge templates, so configurations sharing a model stay apart.
+ROLLUP_KEY_SQL = """
+    SELECT COALESCE(p.source, '') AS source, CAST(r.created_at AS DATE) AS day, COALESCE(r.model_version, '') AS model_version, COALESCE(r.fingerprint, '') AS fingerprint
+    FROM chatbot_responses r JOIN prompts p ON p.id = r.prompt_id
+    WHERE r.id = :response_id
+"""
+
+# A judge reply that could not be parsed has NULL scores; rows written before that
+# change carry 0/0/0 with this rationale. Either way it counts as a parse failure,
+# not as a score.
+PARSE_FAILED_RATIONALE = "Parsing failed"
+LLM_PARSE_FAILED_SQL = f"(CAST(:safety_score AS INTEGER) IS NULL OR CAST(:empathy_score AS INTEGER) IS NULL OR CAST(:helpfulness_score AS INTEGER) IS NULL OR COALESCE(CAST(:rationale AS TEXT), '') = '{PARSE_FAILED_RATIONALE}')"
+LLM_EVAL_PARSE_FAILED_SQL = f"(e.safety_score IS NULL OR e.empathy_score IS NULL OR e.helpfulness_score IS NULL OR COALESCE(e.rationale, '') = '{PARSE_FAILED_RATIONALE}')"
+
+ROLLUP_RULE_EVAL_SQL = f"""
+    INSERT INTO score_rollups (source, day, model_version, fingerprint, rule_count, crisis_count, helpline_count, toxicity_sum)
+    SELECT k.source, k.day, k.model_version, k.fingerprint, 1,
+           CASE WHEN :crisis_detected THEN 1 ELSE 0 END,
+           CASE WHEN :helpline_detected THEN 1 ELSE 0 END,
+           :toxicity_score
+    FROM ({ROLLUP_KEY_SQL}) k
+    ON CONFLICT (source, day, model_version, fingerprint) DO UPDATE SET
+        rule_count = score_rollups.rule_count + EXCLUDED.rule_count,
+        crisis_count = score_rollups.crisis_count + EXCLUDED.crisis_count,
+        helpline_count = score_rollups.helpline_count + EXCLUDED.helpline_count,
+        toxicity_sum = score_rollups.toxicity_sum + EXCLUDED.toxicity_sum,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+ROLLUP_LLM_EVAL_SQL = f"""
+    INSERT INTO score_rollups (source, day, model_version, fingerprint, llm_count, safety_sum, empathy_sum, helpfulness_sum, parse_failures)
+    SELECT k.source, k.day, k.model_version, k.fingerprint,
+           CASE WHEN f.failed THEN 0 ELSE 1 END,
+           CASE WHEN f.failed THEN 0 ELSE CAST(:safety_score AS INTEGER) END,
+           CASE WHEN f.failed THEN 0 ELSE CAST(:empathy_score AS INTEGER) END,
+           CASE WHEN f.failed THEN 0 ELSE CAST(:helpfulness_score AS INTEGER) END,
+           CASE WHEN f.failed THEN 1 ELSE 0 END
+    FROM ({ROLLUP_KEY_SQL}) k CROSS JOIN (SELECT {LLM_PARSE_FAILED_SQL} AS failed) f
+    ON CONFLICT (source, day, model_version, fingerprint) DO UPDATE SET
+        llm_count = score_rollups.llm_count + EXCLUDED.llm_count,
+        parse_failures = score_rollups.parse_failures + EXCLUDED.parse_failures,
+        safety_sum = score_rollups.safety_sum + EXCLUDED.safety_sum,
+        empathy_sum = score_rollups.empathy_sum + EXCLUDED.empathy_sum,
+        helpfulness_sum = score_rollups.helpfulness_sum + EXCLUDED.helpfulness_sum,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+ROLLUP_LLM_HISTOGRAM_SQL = f"""
+    INSERT INTO score_histograms (source, day, model_version, fingerprint, metric, score, count)
+    SELECT k.source, k.day, k.model_version, k.fingerprint, m.metric, m.score, 1
+    FROM ({ROLLUP_KEY_SQL}) k
+    CROSS JOIN (VALUES ('safety', CAST(:safety_score AS INTEGER)), ('empathy', CAST(:empathy_score AS INTEGER)), ('helpfulness', CAST(:helpfulness_score AS INTEGER))) AS m(metric, score)
+    WHERE NOT {LLM_PARSE_FAILED_SQL}
+    ON CONFLICT (source, day, model_version, fingerprint, metric, score) DO UPDATE SET
+        count = score_histograms.count + EXCLUDED.count
+"""
+
+# Bump whenever migrate() gains a step. A process compares it with the
+# schema_version table and only runs DDL when the database is behind, so
+# starting many workers doesn't queue them all on ACCESS EXCLUSIVE locks.
+SCHEMA_VERSION = 1
+# pg_advisory_lock key that serialises migrations across processes.
+MIGRATION_LOCK_ID = 5273001
+
+# Indexes added after their tables first shipped. They are built outside any
+# transaction, CONCURRENTLY unless the table is partitioned (Postgres can't
+# build a partitioned parent's index concurrently).
+INDEXES = [
+    ("chatbot_responses", "CREATE INDEX {concurrently} IF NOT EXISTS idx_chatbot_responses_created_at ON chatbot_responses (created_at)"),
+    ("prompts", "CREATE INDEX {concurrently} IF NOT EXISTS idx_prompts_source_text_hash ON prompts (source, text_hash)"),
+    ("chatbot_responses", "CREATE INDEX {concurrently} IF NOT EXISTS idx_chatbot_responses_prompt_fingerprint ON chatbot_responses (prompt_id, fingerprint)"),
+    ("llm_eval", "CREATE INDEX {concurrently} IF NOT EXISTS idx_llm_eval_response_id ON llm_eval (response_id)"),
+    ("clusters", "CREATE INDEX {concurrently} IF NOT EXISTS idx_clusters_response_model_version ON clusters (response_id, model_version)"),
+    # One row per (run, response); response_created_at is in the key only
+    # because a unique index on a partitioned table must cover the partition key.
+    ("clusters", "CREATE UNIQUE INDEX {concurrently} IF NOT EXISTS idx_clusters_run_response ON clusters (run_id, response_id, response_created_at)"),
+    ("clusters", "CREATE INDEX {concurrently} IF NOT EXISTS idx_clusters_response_latest ON clusters (response_id, run_id DESC NULLS LAST, id DESC)"),
+]
+
+DB_STATEMENT_SECONDS = registry.histogram("db_statement_seconds", "Database statement latency by statement type", ("statement",))
+
+def _time_statements(engine):
+    # Times every statement at the cursor level, so bulk executemany writes count once.
+    # The start lives on the statement's own execution context, so a statement that
+    # fails (and never reaches after_cursor_execute) leaves nothing behind.
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.query_start
+        DB_STATEMENT_SECONDS.observe(elapsed, statement=statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "EMPTY")
+
 class DatabaseHandler:
-    def __init__(self):
-        self.engine = create_engine(settings.db_url)
+    def __init__(self, migrate=None):
+        self.engine = create_engine(settings.db_url, pool_size=settings.db_pool_size, pool_pre_ping=True)
+        _time_statements(self.engine)
         self.Session = sessionmaker(bind=self.engine)
-        self._create_tables_if_not_exist()
+        version = self.schema_version()
+        if version < SCHEMA_VERSION:
+            if not (settings.auto_migrate if migrate is None else migrate):
+                raise RuntimeError(f"Database schema is at version {version}, expected {SCHEMA_VERSION}; run `python cli.py migrate`.")
+            self.migrate()
+        self.partitioned = self._is_partitioned("chatbot_responses")
+        self._partitions_checked = None
+        if self.partitioned:
+            self.ensure_response_partitions()
+
+    def schema_version(self):
+        with self.engine.connect() as connection:
+            if not connection.execute(text("SELECT to_regclass('schema_version') IS NOT NULL")).scalar():
+                return 0
+            return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+    def migrate(self):
+        # Brings the schema up to SCHEMA_VERSION. Concurrent callers wait on the
+        # advisory lock and then find nothing left to do.
+        with self.engine.connect() as lock_connection:
+            lock_connection.execution_options(isolation_level="AUTOCOMMIT")
+            lock_connection.execute(text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+            try:
+                if self.schema_version() >= SCHEMA_VERSION:
+                    return
+                logger.info(f"Migrating database schema to version {SCHEMA_VERSION}.")
+                self._create_tables_if_not_exist()
+                self._create_indexes()
+                with self.engine.connect() as connection:
+                    connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, migrated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"))
+                    connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": SCHEMA_VERSION})
+                    connection.commit()
+            finally:
+                lock_connection.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+
+    def _create_indexes(self):
+        with self.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")
+            for table_name, sql in INDEXES:
+                connection.execute(text(sql.format(concurrently="" if self._is_partitioned(table_name) else "CONCURRENTLY")))
 
     def _create_tables_if_not_exist(self):
         inspector = inspect(self.engine)
         with self.engine.connect() as connection:
             if not inspector.has_table("prompts"):
                 logger.info("Creating database tables.")
-                connection.execute(text("""
+                partitioned = settings.partition_responses
+                dependent_sql = "".join(_dependent_table_sql(name, columns, partitioned) for name, columns in DEPENDENT_TABLES.items())
+                connection.execute(text(f"""
                     CREATE TABLE prompts (
                         id SERIAL PRIMARY KEY,
                         source VARCHAR(255),
                         text TEXT,
+                        text_hash CHAR(64),
+                        canonical_id INTEGER REFERENCES prompts(id),
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
-                    CREATE TABLE chatbot_responses (
+                    {_responses_table_sql(partitioned)}
+                    {dependent_sql}
+                    CREATE TABLE psych_tests (
                         id SERIAL PRIMARY KEY,
-                        prompt_id INTEGER REFERENCES prompts(id),
-                        response_text TEXT,
+                        name VARCHAR(255),
+                        description TEXT,
+                        scoring_rubric TEXT,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
-                    CREATE TABLE rule_eval (
+                     CREATE TABLE test_results (
                         id SERIAL PRIMARY KEY,
-                        response_id INTEGER REFERENCES chatbot_responses(id),
-                        crisis_detected BOOLEAN,
-                        helpline_detected BOOLEAN,
-                        toxicity_score FLOAT
+                        test_id INTEGER REFERENCES psych_tests(id),
+                        prompt_id INTEGER REFERENCES prompts(id),
+                        score INTEGER,
+                        rationale TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
-                    CREATE TABLE llm_eval (
+                """))
+                connection.commit()
+            for name in DEPENDENT_TABLES:
+                connection.execute(text(f"ALTER TABLE {name} ADD COLUMN IF NOT EXISTS response_created_at TIMESTAMP"))
+            connection.execute(text("ALTER TABLE prompts ADD COLUMN IF NOT EXISTS text_hash CHAR(64)"))
+            connection.execute(text("ALTER TABLE prompts ADD COLUMN IF NOT EXISTS canonical_id INTEGER REFERENCES prompts(id)"))
+            connection.execute(text("ALTER TABLE chatbot_responses ADD COLUMN IF NOT EXISTS model_version VARCHAR(255)"))
+            connection.execute(text("ALTER TABLE chatbot_responses ADD COLUMN IF NOT EXISTS run_id INTEGER"))
+            connection.execute(text("ALTER TABLE chatbot_responses ADD COLUMN IF NOT EXISTS fingerprint CHAR(64)"))
+            if not inspector.has_table("eval_runs"):
+                connection.execute(text("""
+                    CREATE TABLE eval_runs (
                         id SERIAL PRIMARY KEY,
-                        response_id INTEGER REFERENCES chatbot_responses(id),
-                        safety_score INTEGER,
-                        empathy_score INTEGER,
-                        helpfulness_score INTEGER,
-                        rationale TEXT
+                        fingerprint CHAR(64),
+                        source VARCHAR(255),
+                        params TEXT,
+                        status VARCHAR(16) DEFAULT 'running',
+                        prompts_processed INTEGER DEFAULT 0,
+                        prompts_failed INTEGER DEFAULT 0,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP
                     );
-                    CREATE TABLE failure_log (
+                """))
+            for name, column_type in (("prompt_tokens", "BIGINT DEFAULT 0"), ("completion_tokens", "BIGINT DEFAULT 0"), ("cost_usd", "FLOAT DEFAULT 0"), ("usage", "TEXT")):
+                connection.execute(text(f"ALTER TABLE eval_runs ADD COLUMN IF NOT EXISTS {name} {column_type}"))
+            if not inspector.has_table("token_usage"):
+                connection.execute(text("""
+                    CREATE TABLE token_usage (
                         id SERIAL PRIMARY KEY,
-                        response_id INTEGER REFERENCES chatbot_responses(id),
-                        routed_to VARCHAR(255),
-                        reason TEXT,
+                        run_id INTEGER,
+                        provider VARCHAR(32),
+                        model VARCHAR(255),
+                        stage VARCHAR(64),
+                        prompt_tokens INTEGER,
+                        completion_tokens INTEGER,
+                        cost_usd FLOAT,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
-                    CREATE TABLE clusters (
+                    CREATE INDEX idx_token_usage_created_at ON token_usage (created_at);
+                """))
+            connection.execute(text("ALTER TABLE clusters ADD COLUMN IF NOT EXISTS model_version INTEGER"))
+            connection.execute(text("ALTER TABLE clusters ADD COLUMN IF NOT EXISTS run_id INTEGER"))
+            if not inspector.has_table("cluster_runs"):
+                connection.execute(text("""
+                    CREATE TABLE cluster_runs (
                         id SERIAL PRIMARY KEY,
-                        response_id INTEGER REFERENCES chatbot_responses(id),
-                        cluster_id INTEGER,
-                        cluster_prob FLOAT
+                        method VARCHAR(64),
+                        params TEXT,
+                        model_version INTEGER,
+                        n_assignments INTEGER,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP
                     );
-                    CREATE TABLE psych_tests (
+                """))
+            if not inspector.has_table("cluster_models"):
+                connection.execute(text("""
+                    CREATE TABLE cluster_models (
                         id SERIAL PRIMARY KEY,
-                        name VARCHAR(255),
-                        description TEXT,
-                        scoring_rubric TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        method VARCHAR(64),
+                        params TEXT,
+                        path TEXT,
+                        n_fit INTEGER,
+                        noise_rate FLOAT,
+                        fitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
-                     CREATE TABLE test_results (
+                """))
+            if not inspector.has_table("embeddings"):
+                connection.execute(text("""
+                    CREATE TABLE embeddings (
+                        text_hash CHAR(64),
+                        model_name VARCHAR(255),
+                        dim INTEGER,
+                        vector BYTEA,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (text_hash, model_name)
+                    );
+                """))
+            if not inspector.has_table("score_rollups"):
+                logger.info("Creating score rollup tables.")
+                connection.execute(text("""
+                    CREATE TABLE score_rollups (
+                        source VARCHAR(255),
+                        day DATE,
+                        model_version VARCHAR(255),
+                        fingerprint VARCHAR(64) DEFAULT '',
+                        llm_count INTEGER DEFAULT 0,
+                        parse_failures INTEGER DEFAULT 0,
+                        safety_sum FLOAT DEFAULT 0,
+                        empathy_sum FLOAT DEFAULT 0,
+                        helpfulness_sum FLOAT DEFAULT 0,
+                        rule_count INTEGER DEFAULT 0,
+                        crisis_count INTEGER DEFAULT 0,
+                        helpline_count INTEGER DEFAULT 0,
+                        toxicity_sum FLOAT DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (source, day, model_version, fingerprint)
+                    );
+                    CREATE TABLE score_histograms (
+                        source VARCHAR(255),
+                        day DATE,
+                        model_version VARCHAR(255),
+                        fingerprint VARCHAR(64) DEFAULT '',
+                        metric VARCHAR(32),
+                        score INTEGER,
+                        count INTEGER DEFAULT 0,
+                        PRIMARY KEY (source, day, model_version, fingerprint, metric, score)
+                    );
+                """))
+            elif "fingerprint" not in {c["name"] for c in inspector.get_columns("score_rollups")}:
+                # Rollups from before the configuration fingerprint joined the key.
+                # Old rows land under fingerprint ''; `report --rebuild` regroups them
+                # and moves parse failures out of the averages.
+                logger.info("Adding fingerprint and parse_failures to score rollups.")
+                connection.execute(text("""
+                    ALTER TABLE score_rollups ADD COLUMN fingerprint VARCHAR(64) NOT NULL DEFAULT '',
+                        ADD COLUMN IF NOT EXISTS parse_failures INTEGER DEFAULT 0,
+                        DROP CONSTRAINT score_rollups_pkey,
+                        ADD PRIMARY KEY (source, day, model_version, fingerprint);
+                    ALTER TABLE score_histograms ADD COLUMN fingerprint VARCHAR(64) NOT NULL DEFAULT '',
+                        DROP CONSTRAINT score_histograms_pkey,
+                        ADD PRIMARY KEY (source, day, model_version, fingerprint, metric, score);
+                """))
+            if not inspector.has_table("eval_jobs"):
+                logger.info("Creating eval job queue table.")
+                connection.execute(text("""
+                    CREATE TABLE eval_jobs (
                         id SERIAL PRIMARY KEY,
-                        test_id INTEGER REFERENCES psych_tests(id),
                         prompt_id INTEGER REFERENCES prompts(id),
-                        score INTEGER,
-                        rationale TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        status VARCHAR(16) DEFAULT 'pending',
+                        attempts INTEGER DEFAULT 0,
+                        worker_id VARCHAR(255),
+                        lease_expires_at TIMESTAMP,
+                        last_error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
+                    CREATE INDEX idx_eval_jobs_claimable ON eval_jobs (id) WHERE status IN ('pending', 'running');
+                    CREATE INDEX idx_eval_jobs_prompt ON eval_jobs (prompt_id);
                 """))
-                connection.commit()
+            connection.commit()
+
 
+    def _is_partitioned(self, table_name):
+        with self.engine.connect() as connection:
+            relkind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = :name"), {"name": table_name}).scalar()
+            return relkind == "p"
+
+    def ensure_response_partitions(self, months_ahead=None, start=None):
+        # Monthly partitions from `start` (default: this month) through `months_ahead`
+        # months in the future, for chatbot_responses and every dependent table.
+        months_ahead = settings.partition_months_ahead if months_ahead is None else months_ahead
+        month = _month_start(start or datetime.now())
+        if start is None:
+            self._partitions_checked = month
+        partitions = []
+        for _ in range(months_ahead + 1):
+            upper = _add_months(month, 1)
+            suffix = month.strftime("y%Ym%m")
+            partitions += [(table, f"{table}_{suffix}", month, upper) for table in ["chatbot_responses", *DEPENDENT_TABLES]]
+            month = upper
+        with self.engine.connect() as connection:
+            # Only issue DDL for partitions that are missing, so a routine start
+            # doesn't take locks on the parent tables.
+            existing = set(connection.execute(text("SELECT relname FROM pg_class WHERE relname = ANY(:names)"), {"names": [name for _, name, _, _ in partitions]}).scalars())
+            for table, name, lower, upper in partitions:
+                if name not in existing:
+                    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM ('{lower:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"))
+            connection.commit()
+
+    def ensure_current_partitions(self):
+        # Called before inserting responses and from long-running workers: once per
+        # calendar month, extends the partitions so a process that outlives
+        # PARTITION_MONTHS_AHEAD never hits "no partition of relation found for row".
+        if self.partitioned and self._partitions_checked != _month_start(datetime.now()):
+            self.ensure_response_partitions()
+
+    def _monthly_partitions(self, connection, table_name):
+        result = connection.execute(text("""
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = :name
+        """), {"name": table_name})
+        partitions = {}
+        for (name,) in result:
+            match = re.search(r"_y(\d{4})m(\d{2})$", name)
+            if match:
+                partitions[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+        return partitions
+
+    def apply_retention(self, months=None):
+        # Drops responses (and everything keyed to them) older than `months` whole
+        # months. Score rollups are left untouched so long-range reporting survives.
+        months = settings.response_retention_months if months is None else months
+        if not months:
+            logger.info("No retention policy configured; keeping all responses.")
+            return
+        cutoff = _add_months(_month_start(datetime.now()), -months)
+        with self.engine.connect() as connection:
+            if self.partitioned:
+                expired = [month for month in self._monthly_partitions(connection, "chatbot_responses") if month < cutoff]
+                for month in sorted(expired):
+                    for table in [*DEPENDENT_TABLES, "chatbot_responses"]:
+                        partition = self._monthly_partitions(connection, table).get(month)
+                        if partition:
+                            connection.execute(text(f"DROP TABLE {partition}"))
+                    logger.info(f"Dropped response partitions for {month:%Y-%m}.")
+            else:
+                expired_ids = "SELECT id FROM chatbot_responses WHERE created_at < :cutoff"
+                for table in DEPENDENT_TABLES:
+                    connection.execute(text(f"DELETE FROM {table} WHERE response_id IN ({expired_ids})"), {"cutoff": cutoff})
+                result = connection.execute(text("DELETE FROM chatbot_responses WHERE created_at < :cutoff"), {"cutoff": cutoff})
+                logger.info(f"Deleted {result.rowcount} responses older than {cutoff:%Y-%m-%d}.")
+            connection.commit()
+
+    def build_responses_query(self, since=None, until=None, limit=None):
+        # Range filters on created_at let Postgres use the created_at index and,
+        # when responses are partitioned, prune to the months in the window.
+        clauses, params = [], {}
+        if since is not None:
+            clauses.append("created_at >= :since")
+            params["since"] = parse_since(since)
+        if until is not None:
+            clauses.append("created_at < :until")
+            params["until"] = parse_since(until)
+        where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+        limit_sql = "LIMIT :limit" if limit else ""
+        params["limit"] = limit
+        return f"SELECT id, response_text as text, created_at FROM chatbot_responses {where} ORDER BY created_at DESC {limit_sql}", params
+
+    def fetch_embeddings(self, model_name, text_hashes, chunk_size=10000):
+        # Returns {text_hash: (dim, vector bytes)} for the hashes already embedded.
+        text_hashes = list(text_hashes)
+        found = {}
+        with self.Session() as session:
+            for start in range(0, len(text_hashes), chunk_size):
+                result = session.execute(text("SELECT text_hash, dim, vector FROM embeddings WHERE model_name = :model_name AND text_hash = ANY(:text_hashes)"), {"model_name": model_name, "text_hashes": text_hashes[start:start + chunk_size]})
+                found.update((text_hash, (dim, bytes(vector))) for text_hash, dim, vector in result)
+        return found
+
+    def insert_embeddings(self, model_name, records):
+        # records: (text_hash, dim, vector bytes) tuples. Existing rows are kept.
+        if not records:
+            return
+        with self.Session() as session:
+            session.execute(text("INSERT INTO embeddings (text_hash, model_name, dim, vector) VALUES (:text_hash, :model_name, :dim, :vector) ON CONFLICT (text_hash, model_name) DO NOTHING"), [{"text_hash": text_hash, "model_name": model_name, "dim": dim, "vector": vector} for text_hash, dim, vector in records])
+            session.commit()
 
-    def insert_prompt(self, source, text):
+    def insert_prompts(self, source, texts, text_hashes=None):
+        # Returns the new ids in input order.
+        if not texts:
+            return []
+        text_hashes = text_hashes or [None] * len(texts)
         with self.Session() as session:
-            session.execute(text("INSERT INTO prompts (source, text) VALUES (:source, :text)"), {"source": source, "text": text})
+            result = session.execute(insert(prompts_table).returning(prompts_table.c.id, sort_by_parameter_order=True), [{"source": source, "text": prompt_text, "text_hash": text_hash} for prompt_text, text_hash in zip(texts, text_hashes)])
+            prompt_ids = result.scalars().all()
             session.commit()
+            return prompt_ids
 
-    def fetch_prompts(self, source, limit):
+    def mark_duplicate_prompts(self, duplicates):
+        # duplicates: {prompt_id: canonical_id}
+        if not duplicates:
+            return
         with self.Session() as session:
-            result = session.execute(text("SELECT id, text FROM prompts WHERE source = :source LIMIT :limit"), {"source": source, "limit": limit})
+            session.execute(text("UPDATE prompts SET canonical_id = :canonical_id WHERE id = :id"), [{"id": prompt_id, "canonical_id": canonical_id} for prompt_id, canonical_id in duplicates.items()])
+            session.commit()
+
+    def fetch_canonical_ids_by_hash(self, source, text_hashes, exclude_ids=()):
+        if not text_hashes:
+            return {}
+        exclude_sql = "AND id NOT IN :exclude_ids" if exclude_ids else ""
+        with self.Session() as session:
+            result = session.execute(text(f"SELECT text_hash, MIN(id) FROM prompts WHERE source = :source AND canonical_id IS NULL AND text_hash IN :text_hashes {exclude_sql} GROUP BY text_hash"), {"source": source, "text_hashes": tuple(text_hashes), "exclude_ids": tuple(exclude_ids)})
+            return dict(result.fetchall())
+
+    def fetch_canonical_prompts(self, source, after_id=0):
+        with self.Session() as session:
+            result = session.execute(text("SELECT id, text FROM prompts WHERE source = :source AND canonical_id IS NULL AND id > :after_id ORDER BY id").execution_options(yield_per=5000), {"source": source, "after_id": after_id})
+            for row in result:
+                yield row
+
+    def fetch_prompts(self, source, limit, canonical_only=False):
+        canonical_sql = "AND canonical_id IS NULL" if canonical_only else ""
+        with self.Session() as session:
+            result = session.execute(text(f"SELECT id, text FROM prompts WHERE source = :source {canonical_sql} LIMIT :limit"), {"source": source, "limit": limit})
             return result.fetchall()
 
-    def insert_response(self, prompt_id, response_text):
+    def fetch_pending_prompts(self, source, limit, fingerprint, canonical_only=False):
+        # Prompts with no judged response under this configuration fingerprint.
+        # Done as an anti-join so a restarted run picks up exactly where it stopped.
+        canonical_sql = "AND p.canonical_id IS NULL" if canonical_only else ""
         with self.Session() as session:
-            result = session.execute(text("INSERT INTO chatbot_responses (prompt_id, response_text) VALUES (:prompt_id, :response_text) RETURNING id"), {"prompt_id": prompt_id, "response_text": response_text})
+            result = session.execute(text(f"""
+                SELECT p.id, p.text FROM prompts p
+                WHERE p.source = :source {canonical_sql}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM chatbot_responses r JOIN llm_eval e ON e.response_id = r.id
+                      WHERE r.prompt_id = p.id AND r.fingerprint = :fingerprint
+                  )
+                ORDER BY p.id
+                LIMIT :limit
+            """), {"source": source, "limit": limit, "fingerprint": fingerprint})
+            return result.fetchall()
+
+    def start_eval_run(self, fingerprint, source, params):
+        with self.Session() as session:
+            result = session.execute(text("INSERT INTO eval_runs (fingerprint, source, params) VALUES (:fingerprint, :source, :params) RETURNING id"), {"fingerprint": fingerprint, "source": source, "params": json.dumps(params)})
             session.commit()
             return result.scalar_one()
 
+    def finish_eval_run(self, run_id, status, prompts_processed, prompts_failed, usage=None):
+        usage = usage or {}
+        with self.Session() as session:
+            session.execute(text("""
+                UPDATE eval_runs SET status = :status, prompts_processed = :prompts_processed, prompts_failed = :prompts_failed,
+                    prompt_tokens = :prompt_tokens, completion_tokens = :completion_tokens, cost_usd = :cost_usd, usage = :usage, finished_at = NOW()
+                WHERE id = :run_id
+            """), {"run_id": run_id, "status": status, "prompts_processed": prompts_processed, "prompts_failed": prompts_failed,
+                   "prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0), "cost_usd": usage.get("cost_usd", 0.0),
+                   "usage": json.dumps(usage.get("by_stage", []))})
+            session.commit()
+
+    def insert_token_usage(self, records):
+        # records: (run_id, provider, model, stage, prompt_tokens, completion_tokens, cost_usd) tuples.
+        if not records:
+            return
+        keys = ("run_id", "provider", "model", "stage", "prompt_tokens", "completion_tokens", "cost_usd")
+        with self.Session() as session:
+            session.execute(text("INSERT INTO token_usage (run_id, provider, model, stage, prompt_tokens, completion_tokens, cost_usd) VALUES (:run_id, :provider, :model, :stage, :prompt_tokens, :completion_tokens, :cost_usd)"), [dict(zip(keys, record)) for record in records])
+            session.commit()
+
+    def fetch_token_cost_since(self, since):
+        with self.Session() as session:
+            return float(session.execute(text("SELECT COALESCE(SUM(cost_usd), 0) FROM token_usage WHERE created_at >= :since"), {"since": since}).scalar())
+
+    def fetch_prompt_strata(self, sources, canonical_only=False):
+        # Each prompt with its most recent cluster assignment and most recent judge
+        # scores (either may be NULL), for stratified sampling.
+        canonical_sql = "AND p.canonical_id IS NULL" if canonical_only else ""
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                SELECT p.id, p.text, p.source, lc.cluster_id, ls.safety_score, ls.empathy_score, ls.helpfulness_score
+                FROM prompts p
+                LEFT JOIN LATERAL (
+                    SELECT c.cluster_id FROM chatbot_responses r JOIN clusters c ON c.response_id = r.id
+                    WHERE r.prompt_id = p.id ORDER BY c.run_id DESC NULLS LAST, c.id DESC LIMIT 1
+                ) lc ON TRUE
+                LEFT JOIN LATERAL (
+                    SELECT e.safety_score, e.empathy_score, e.helpfulness_score FROM chatbot_responses r JOIN llm_eval e ON e.response_id = r.id
+                    WHERE r.prompt_id = p.id ORDER BY e.id DESC LIMIT 1
+                ) ls ON TRUE
+                WHERE p.source IN :sources {canonical_sql}
+            """), {"sources": tuple(sources)})
+            return result.fetchall()
+
+    def insert_responses(self, records, model_version=None, run_id=None, fingerprint=None):
+        # records: (prompt_id, response_text) pairs. Returns (id, created_at) rows in the same order.
+        if not records:
+            return []
+        rows = [{"prompt_id": prompt_id, "response_text": response_text, "model_version": model_version or settings.gemini_model, "run_id": run_id, "fingerprint": fingerprint} for prompt_id, response_text in records]
+        self.ensure_current_partitions()
+        with self.Session() as session:
+            result = session.execute(insert(responses_table).returning(responses_table.c.id, responses_table.c.created_at, sort_by_parameter_order=True), rows)
+            inserted = result.all()
+            session.commit()
+            return inserted
+
     def insert_rule_eval(self, response_id, crisis_detected, helpline_detected, toxicity_score):
+        params = {"response_id": response_id, "crisis_detected": crisis_detected, "helpline_detected": helpline_detected, "toxicity_score": toxicity_score}
         with self.Session() as session:
-            session.execute(text("INSERT INTO rule_eval (response_id, crisis_detected, helpline_detected, toxicity_score) VALUES (:response_id, :crisis_detected, :helpline_detected, :toxicity_score)"), {"response_id": response_id, "crisis_detected": crisis_detected, "helpline_detected": helpline_detected, "toxicity_score": toxicity_score})
+            session.execute(text(f"INSERT INTO rule_eval (response_id, response_created_at, crisis_detected, helpline_detected, toxicity_score) VALUES (:response_id, {RESPONSE_CREATED_AT_SQL}, :crisis_detected, :helpline_detected, :toxicity_score)"), params)
+            session.execute(text(ROLLUP_RULE_EVAL_SQL), params)
             session.commit()
 
     def insert_llm_eval(self, response_id, safety_score, empathy_score, helpfulness_score, rationale):
+        params = {"response_id": response_id, "safety_score": safety_score, "empathy_score": empathy_score, "helpfulness_score": helpfulness_score, "rationale": rationale}
         with self.Session() as session:
-            session.execute(text("INSERT INTO llm_eval (response_id, safety_score, empathy_score, helpfulness_score, rationale) VALUES (:response_id, :safety_score, :empathy_score, :helpfulness_score, :rationale)"), {"response_id": response_id, "safety_score": safety_score, "empathy_score": empathy_score, "helpfulness_score": helpfulness_score, "rationale": rationale})
+            session.execute(text(f"INSERT INTO llm_eval (response_id, response_created_at, safety_score, empathy_score, helpfulness_score, rationale) VALUES (:response_id, {RESPONSE_CREATED_AT_SQL}, :safety_score, :empathy_score, :helpfulness_score, :rationale)"), params)
+            session.execute(text(ROLLUP_LLM_EVAL_SQL), params)
+            session.execute(text(ROLLUP_LLM_HISTOGRAM_SQL), params)
             session.commit()
 
-    def insert_failure(self, response_id, routed_to, reason):
+    def insert_failures(self, records):
+        # records: (response_id, routed_to, reason) tuples, written in one round trip.
+        if not records:
+            return
         with self.Session() as session:
-            session.execute(text("INSERT INTO failure_log (response_id, routed_to, reason) VALUES (:response_id, :routed_to, :reason)"), {"response_id": response_id, "routed_to": routed_to, "reason": reason})
+            session.execute(text(f"INSERT INTO failure_log (response_id, response_created_at, routed_to, reason) VALUES (:response_id, {RESPONSE_CREATED_AT_SQL}, :routed_to, :reason)"), [{"response_id": response_id, "routed_to": routed_to, "reason": reason} for response_id, routed_to, reason in records])
             session.commit()
 
-    def save_cluster_assignments(self, batch):
+    def start_cluster_run(self, method, params, model_version=None):
         with self.Session() as session:
-            for record in batch:
-                session.execute(text("INSERT INTO clusters (response_id, cluster_id, cluster_prob) VALUES (:response_id, :cluster_id, :cluster_prob)"), record)
+            result = session.execute(text("INSERT INTO cluster_runs (method, params, model_version) VALUES (:method, :params, :model_version) RETURNING id"), {"method": method, "params": json.dumps(params, default=str), "model_version": model_version})
             session.commit()
+            return result.scalar_one()
+
+    def save_cluster_assignments(self, run_id, response_ids, cluster_ids, cluster_probs, model_version=None):
+        # Columnar arrays, COPYed into a temp table and upserted per (run, response)
+        # in one statement that also fills response_created_at; closes the run.
+        response_ids, cluster_ids, cluster_probs = (np.asarray(values).ravel() for values in (response_ids, cluster_ids, cluster_probs))
+        _, last = np.unique(response_ids[::-1], return_index=True)
+        keep = np.sort(len(response_ids) - 1 - last)
+        rows = io.StringIO("".join(f"{r},{c},{p!r}\n" for r, c, p in zip(response_ids[keep].astype(np.int64).tolist(), cluster_ids[keep].astype(np.int64).tolist(), cluster_probs[keep].astype(float).tolist())))
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("CREATE TEMP TABLE cluster_assignments_stage (response_id INTEGER, cluster_id INTEGER, cluster_prob FLOAT) ON COMMIT DROP")
+            cursor.copy_expert("COPY cluster_assignments_stage FROM STDIN WITH (FORMAT csv)", rows)
+            cursor.execute("""
+                INSERT INTO clusters (run_id, response_id, response_created_at, cluster_id, cluster_prob, model_version)
+                SELECT %(run_id)s, s.response_id, r.created_at, s.cluster_id, s.cluster_prob, %(model_version)s
+                FROM cluster_assignments_stage s JOIN chatbot_responses r ON r.id = s.response_id
+                ON CONFLICT (run_id, response_id, response_created_at)
+                DO UPDATE SET cluster_id = EXCLUDED.cluster_id, cluster_prob = EXCLUDED.cluster_prob, model_version = EXCLUDED.model_version
+            """, {"run_id": run_id, "model_version": model_version})
+            saved = cursor.rowcount
+            cursor.execute("UPDATE cluster_runs SET n_assignments = %(n)s, finished_at = CURRENT_TIMESTAMP WHERE id = %(run_id)s", {"n": saved, "run_id": run_id})
+            connection.commit()
+        finally:
+            connection.close()
+        return saved
+
+    def fetch_latest_cluster_assignments(self, response_ids=None):
+        # Most recent assignment per response (rows from before cluster runs sort last).
+        where_sql = "WHERE c.response_id = ANY(:ids)" if response_ids is not None else ""
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                SELECT DISTINCT ON (c.response_id) c.response_id, c.cluster_id, c.cluster_prob, c.model_version, c.run_id
+                FROM clusters c {where_sql}
+                ORDER BY c.response_id, c.run_id DESC NULLS LAST, c.id DESC
+            """), {"ids": list(response_ids or [])})
+            return result.fetchall()
+
+    def insert_cluster_model(self, method, params, path, n_fit, noise_rate):
+        with self.Session() as session:
+            result = session.execute(text("INSERT INTO cluster_models (method, params, path, n_fit, noise_rate) VALUES (:method, :params, :path, :n_fit, :noise_rate) RETURNING id"), {"method": method, "params": json.dumps(params), "path": path, "n_fit": n_fit, "noise_rate": noise_rate})
+            session.commit()
+            return result.scalar_one()
+
+    def update_cluster_model_path(self, model_version, path):
+        with self.Session() as session:
+            session.execute(text("UPDATE cluster_models SET path = :path WHERE id = :id"), {"id": model_version, "path": path})
+            session.commit()
+
+    def fetch_latest_cluster_model(self, method):
+        # The age comes from the database clock, so it never mixes a naive client
+        # datetime with the column's timezone.
+        with self.Session() as session:
+            result = session.execute(text("SELECT id, params, path, n_fit, noise_rate, fitted_at, EXTRACT(EPOCH FROM now() - fitted_at) AS age_seconds FROM cluster_models WHERE method = :method AND path IS NOT NULL ORDER BY id DESC LIMIT 1"), {"method": method})
+            return result.fetchone()
+
+    def fetch_responses_after(self, after_id, limit=None, exclude_ids=None, since=None):
+        # Responses in id order, with whether any failure_log row points at them.
+        # exclude_ids skips responses a consumer already holds above its watermark.
+        clauses, params = ["r.id > :after_id"], {"after_id": after_id, "limit": limit}
+        if exclude_ids is not None and len(exclude_ids):
+            clauses.append("r.id <> ALL(:exclude_ids)")
+            params["exclude_ids"] = [int(response_id) for response_id in exclude_ids]
+        if since is not None:
+            clauses.append("r.created_at >= :since")
+            params["since"] = parse_since(since)
+        limit_sql = "LIMIT :limit" if limit else ""
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                SELECT r.id, r.response_text AS text, r.created_at,
+                       EXISTS (SELECT 1 FROM failure_log f WHERE f.response_id = r.id) AS failed
+                FROM chatbot_responses r WHERE {' AND '.join(clauses)} ORDER BY r.id {limit_sql}
+            """), params)
+            return result.fetchall()
+
+    def fetch_settled_response_id(self, after_id, lag_seconds=None):
+        # Highest response id whose insert is settled: ids come from a sequence
+        # before the transaction commits, so a lower id can become visible after a
+        # higher one. A row created more than the lag ago (the lag being well over
+        # twice the longest insert transaction) has no uncommitted id below it.
+        # Call this before reading, so every id up to the result is visible to the read.
+        lag_seconds = settings.response_watermark_lag if lag_seconds is None else lag_seconds
+        with self.Session() as session:
+            result = session.execute(text("SELECT COALESCE(MAX(id), :after_id) FROM chatbot_responses WHERE id > :after_id AND created_at < LOCALTIMESTAMP - make_interval(secs => :lag)"), {"after_id": after_id, "lag": lag_seconds})
+            return result.scalar()
+
+    def fetch_responses_by_id(self, response_ids):
+        if not response_ids:
+            return []
+        with self.Session() as session:
+            result = session.execute(text("""
+                SELECT r.id, r.response_text AS text, r.created_at,
+                       EXISTS (SELECT 1 FROM failure_log f WHERE f.response_id = r.id) AS failed
+                FROM chatbot_responses r WHERE r.id = ANY(:ids)
+            """), {"ids": list(response_ids)})
+            return result.fetchall()
+
+    def fetch_unassigned_responses(self, model_version, since=None, limit=None):
+        # Responses with no cluster row under this model version (anti-join).
+        clauses, params = ["NOT EXISTS (SELECT 1 FROM clusters c WHERE c.response_id = r.id AND c.model_version = :model_version)"], {"model_version": model_version, "limit": limit}
+        if since is not None:
+            clauses.append("r.created_at >= :since")
+            params["since"] = parse_since(since)
+        limit_sql = "LIMIT :limit" if limit else ""
+        with self.Session() as session:
+            result = session.execute(text(f"SELECT r.id, r.response_text AS text, r.created_at FROM chatbot_responses r WHERE {' AND '.join(clauses)} ORDER BY r.created_at {limit_sql}"), params)
+            return result.fetchall()
 
     def insert_test(self, name, description, scoring_rubric):
         with self.Session() as session:
             session.execute(text("INSERT INTO psych_tests (name, description, scoring_rubric) VALUES (:name, :description, :scoring_rubric)"), {"name": name, "description": description, "scoring_rubric": scoring_rubric})
             session.commit()
 
+    def fetch_test_rubrics(self, test_ids):
+        if not test_ids:
+            return {}
+        with self.Session() as session:
+            result = session.execute(text("SELECT id, scoring_rubric FROM psych_tests WHERE id IN :test_ids"), {"test_ids": tuple(test_ids)})
+            return dict(result.fetchall())
+
     def fetch_unscored_prompts_for_tests(self, test_id, prompt_ids):
+        if not prompt_ids:
+            return []
         with self.Session() as session:
             result = session.execute(text("SELECT id, text FROM prompts WHERE id IN :prompt_ids AND id NOT IN (SELECT prompt_id FROM test_results WHERE test_id = :test_id)"), {"prompt_ids": tuple(prompt_ids), "test_id": test_id})
             return result.fetchall()
     
-    def mark_test_scored(self, test_id, prompt_id, score, rationale):
+    def insert_test_results(self, records):
+        # records: (test_id, prompt_id, score, rationale) tuples, written in one round trip.
+        if not records:
+            return
         with self.Session() as session:
-            session.execute(text("INSERT INTO test_results (test_id, prompt_id, score, rationale) VALUES (:test_id, :prompt_id, :score, :rationale)"), {"test_id": test_id, "prompt_id": prompt_id, "score": score, "rationale": rationale})
+            session.execute(text("INSERT INTO test_results (test_id, prompt_id, score, rationale) VALUES (:test_id, :prompt_id, :score, :rationale)"), [{"test_id": test_id, "prompt_id": prompt_id, "score": score, "rationale": rationale} for test_id, prompt_id, score, rationale in records])
             session.commit()
+
+    def rebuild_score_rollups(self, since=None):
+        # Recomputes rollups from the raw tables for every day on or after `since`
+        # (or all days). Used to backfill existing data and to repair drift.
+        day_filter = "WHERE CAST(r.created_at AS DATE) >= CAST(:since AS DATE)" if since else ""
+        rollup_filter = "WHERE day >= CAST(:since AS DATE)" if since else ""
+        key_sql = "COALESCE(p.source, ''), CAST(r.created_at AS DATE), COALESCE(r.model_version, ''), COALESCE(r.fingerprint, '')"
+        params = {"since": since}
+        with self.Session() as session:
+            session.execute(text(f"DELETE FROM score_rollups {rollup_filter}"), params)
+            session.execute(text(f"DELETE FROM score_histograms {rollup_filter}"), params)
+            session.execute(text(f"""
+                INSERT INTO score_rollups (source, day, model_version, fingerprint, llm_count, safety_sum, empathy_sum, helpfulness_sum, parse_failures)
+                SELECT {key_sql},
+                       COUNT(*) FILTER (WHERE NOT {LLM_EVAL_PARSE_FAILED_SQL}),
+                       COALESCE(SUM(e.safety_score) FILTER (WHERE NOT {LLM_EVAL_PARSE_FAILED_SQL}), 0),
+                       COALESCE(SUM(e.empathy_score) FILTER (WHERE NOT {LLM_EVAL_PARSE_FAILED_SQL}), 0),
+                       COALESCE(SUM(e.helpfulness_score) FILTER (WHERE NOT {LLM_EVAL_PARSE_FAILED_SQL}), 0),
+                       COUNT(*) FILTER (WHERE {LLM_EVAL_PARSE_FAILED_SQL})
+                FROM llm_eval e
+                JOIN chatbot_responses r ON r.id = e.response_id
+                JOIN prompts p ON p.id = r.prompt_id
+                {day_filter}
+                GROUP BY 1, 2, 3, 4
+            """), params)
+            session.execute(text(f"""
+                INSERT INTO score_rollups (source, day, model_version, fingerprint, rule_count, crisis_count, helpline_count, toxicity_sum)
+                SELECT {key_sql},
+                       COUNT(*), SUM(CASE WHEN e.crisis_detected THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN e.helpline_detected THEN 1 ELSE 0 END), SUM(e.toxicity_score)
+                FROM rule_eval e
+                JOIN chatbot_responses r ON r.id = e.response_id
+                JOIN prompts p ON p.id = r.prompt_id
+                {day_filter}
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (source, day, model_version, fingerprint) DO UPDATE SET
+                    rule_count = EXCLUDED.rule_count,
+                    crisis_count = EXCLUDED.crisis_count,
+                    helpline_count = EXCLUDED.helpline_count,
+                    toxicity_sum = EXCLUDED.toxicity_sum
+            """), params)
+            session.execute(text(f"""
+                INSERT INTO score_histograms (source, day, model_version, fingerprint, metric, score, count)
+                SELECT {key_sql}, m.metric, m.score, COUNT(*)
+                FROM llm_eval e
+                JOIN chatbot_responses r ON r.id = e.response_id
+                JOIN prompts p ON p.id = r.prompt_id
+                CROSS JOIN LATERAL (VALUES ('safety', e.safety_score), ('empathy', e.empathy_score), ('helpfulness', e.helpfulness_score)) AS m(metric, score)
+                {day_filter or 'WHERE TRUE'} AND NOT {LLM_EVAL_PARSE_FAILED_SQL}
+                GROUP BY 1, 2, 3, 4, 5, 6
+            """), params)
+            session.commit()
+        logger.info(f"Rebuilt score rollups{' since ' + str(since) if since else ''}.")
+
+    def _rollup_filters(self, source, since, until, model_version, fingerprint=None):
+        clauses, params = [], {}
+        if source is not None:
+            clauses.append("source = :source")
+            params["source"] = source
+        if since is not None:
+            clauses.append("day >= CAST(:since AS DATE)")
+            params["since"] = since
+        if until is not None:
+            clauses.append("day <= CAST(:until AS DATE)")
+            params["until"] = until
+        if model_version is not None:
+            clauses.append("model_version = :model_version")
+            params["model_version"] = model_version
+        if fingerprint is not None:
+            clauses.append("fingerprint = :fingerprint")
+            params["fingerprint"] = fingerprint
+        return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def fetch_score_rollups(self, source=None, since=None, until=None, model_version=None, fingerprint=None):
+        where, params = self._rollup_filters(source, since, until, model_version, fingerprint)
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                SELECT source, day, model_version, fingerprint, llm_count, parse_failures,
+                       safety_sum / NULLIF(llm_count, 0) AS avg_safety,
+                       empathy_sum / NULLIF(llm_count, 0) AS avg_empathy,
+                       helpfulness_sum / NULLIF(llm_count, 0) AS avg_helpfulness,
+                       rule_count,
+                       CAST(crisis_count AS FLOAT) / NULLIF(rule_count, 0) AS crisis_rate,
+                       CAST(helpline_count AS FLOAT) / NULLIF(rule_count, 0) AS helpline_rate,
+                       toxicity_sum / NULLIF(rule_count, 0) AS avg_toxicity
+                FROM score_rollups {where}
+                ORDER BY day, source, model_version, fingerprint
+            """), params)
+            return result.fetchall()
+
+    def summarize_scores(self, source=None, since=None, until=None, model_version=None, fingerprint=None):
+        where, params = self._rollup_filters(source, since, until, model_version, fingerprint)
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                SELECT source, model_version, fingerprint, SUM(llm_count) AS llm_count, SUM(parse_failures) AS parse_failures,
+                       SUM(safety_sum) / NULLIF(SUM(llm_count), 0) AS avg_safety,
+                       SUM(empathy_sum) / NULLIF(SUM(llm_count), 0) AS avg_empathy,
+                       SUM(helpfulness_sum) / NULLIF(SUM(llm_count), 0) AS avg_helpfulness,
+                       SUM(rule_count) AS rule_count,
+                       CAST(SUM(crisis_count) AS FLOAT) / NULLIF(SUM(rule_count), 0) AS crisis_rate,
+                       CAST(SUM(helpline_count) AS FLOAT) / NULLIF(SUM(rule_count), 0) AS helpline_rate,
+                       SUM(toxicity_sum) / NULLIF(SUM(rule_count), 0) AS avg_toxicity
+                FROM score_rollups {where}
+                GROUP BY source, model_version, fingerprint
+                ORDER BY source, model_version, fingerprint
+            """), params)
+            return result.fetchall()
+
+    def fetch_score_histogram(self, metric, source=None, since=None, until=None, model_version=None, fingerprint=None):
+        where, params = self._rollup_filters(source, since, until, model_version, fingerprint)
+        where = (where + " AND " if where else "WHERE ") + "metric = :metric"
+        params["metric"] = metric
+        with self.Session() as session:
+            result = session.execute(text(f"SELECT score, SUM(count) FROM score_histograms {where} GROUP BY score ORDER BY score"), params)
+            return {score: int(count) for score, count in result.fetchall()}
+
+    def enqueue_jobs(self, source, limit=None, canonical_only=False, fingerprint=None):
+        # Queues one job per prompt, skipping prompts that already have an open job
+        # and, given a fingerprint, prompts already judged under it. Returns the
+        # number of jobs created.
+        canonical_sql = "AND p.canonical_id IS NULL" if canonical_only else ""
+        if fingerprint:
+            canonical_sql += """
+                  AND NOT EXISTS (
+                      SELECT 1 FROM chatbot_responses r JOIN llm_eval e ON e.response_id = r.id
+                      WHERE r.prompt_id = p.id AND r.fingerprint = :fingerprint
+                  )"""
+        limit_sql = "LIMIT :limit" if limit else ""
+        with self.Session() as session:
+            result = session.execute(text(f"""
+                INSERT INTO eval_jobs (prompt_id)
+                SELECT p.id FROM prompts p
+                WHERE p.source = :source {canonical_sql}
+                  AND NOT EXISTS (SELECT 1 FROM eval_jobs j WHERE j.prompt_id = p.id AND j.status IN ('pending', 'running'))
+                ORDER BY p.id {limit_sql}
+            """), {"source": source, "limit": limit, "fingerprint": fingerprint})
+            session.commit()
+            return result.rowcount
+
+    def claim_jobs(self, worker_id, batch_size, lease_seconds, max_attempts):
+        # Claims up to batch_size pending jobs, or running jobs whose lease has
+        # expired (their worker died). SKIP LOCKED lets concurrent workers claim
+        # disjoint batches without waiting on each other.
+        with self.Session() as session:
+            session.execute(text("""
+                UPDATE eval_jobs SET status = 'failed', last_error = 'lease expired on final attempt', updated_at = NOW()
+                WHERE status = 'running' AND lease_expires_at < NOW() AND attempts >= :max_attempts
+            """), {"max_attempts": max_attempts})
+            result = session.execute(text("""
+                UPDATE eval_jobs j
+                SET status = 'running', worker_id = :worker_id, attempts = j.attempts + 1,
+                    lease_expires_at = NOW() + make_interval(secs => :lease_seconds), updated_at = NOW()
+                FROM prompts p
+                WHERE p.id = j.prompt_id AND j.id IN (
+                    SELECT id FROM eval_jobs
+                    WHERE (status = 'pending' OR (status = 'running' AND lease_expires_at < NOW()))
+                      AND attempts < :max_attempts
+                    ORDER BY id
+                    LIMIT :batch_size
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.id, j.prompt_id, p.text
+            """), {"worker_id": worker_id, "batch_size": batch_size, "lease_seconds": lease_seconds, "max_attempts": max_attempts})
+            jobs = result.fetchall()
+            session.commit()
+            return sorted(jobs)
+
+    def renew_job_leases(self, worker_id, job_ids, lease_seconds):
+        # Returns the ids this worker still holds; a job missing from the result
+        # was reclaimed by another worker after its lease lapsed.
+        if not job_ids:
+            return set()
+        with self.Session() as session:
+            result = session.execute(text("""
+                UPDATE eval_jobs SET lease_expires_at = NOW() + make_interval(secs => :lease_seconds), updated_at = NOW()
+                WHERE id IN :job_ids AND worker_id = :worker_id AND status = 'running'
+                RETURNING id
+            """), {"worker_id": worker_id, "job_ids": tuple(job_ids), "lease_seconds": lease_seconds})
+            renewed = set(result.scalars().all())
+            session.commit()
+            return renewed
+
+    def complete_jobs(self, worker_id, job_ids):
+        if not job_ids:
+            return
+        with self.Session() as session:
+            session.execute(text("UPDATE eval_jobs SET status = 'done', lease_expires_at = NULL, updated_at = NOW() WHERE id IN :job_ids AND worker_id = :worker_id"), {"worker_id": worker_id, "job_ids": tuple(job_ids)})
+            session.commit()
+
+    def fail_jobs(self, worker_id, job_ids, error, max_attempts):
+        # Failed jobs go back to pending until they have used max_attempts.
+        if not job_ids:
+            return
+        with self.Session() as session:
+            session.execute(text("""
+                UPDATE eval_jobs
+                SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'pending' END,
+                    lease_expires_at = NULL, last_error = :error, updated_at = NOW()
+                WHERE id IN :job_ids AND worker_id = :worker_id
+            """), {"worker_id": worker_id, "job_ids": tuple(job_ids), "error": error, "max_attempts": max_attempts})
+            session.commit()
+
+    def release_jobs(self, worker_id, job_ids):
+        # Hands jobs back unrun (e.g. the LLM budget is spent): pending again,
+        # without spending one of their attempts.
+        if not job_ids:
+            return
+        with self.Session() as session:
+            session.execute(text("""
+                UPDATE eval_jobs
+                SET status = 'pending', attempts = GREATEST(attempts - 1, 0), worker_id = NULL, lease_expires_at = NULL, updated_at = NOW()
+                WHERE id IN :job_ids AND worker_id = :worker_id AND status = 'running'
+            """), {"worker_id": worker_id, "job_ids": tuple(job_ids)})
+            session.commit()
+
+    def job_counts(self):
+        with self.Session() as session:
+            result = session.execute(text("SELECT status, COUNT(*) FROM eval_jobs GROUP BY status"))
+            return dict(result.fetchall())
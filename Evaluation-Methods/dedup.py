@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import zlib
+import numpy as np
+from settings import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Smallest prime above 2**32: with 32-bit shingle hashes and coefficients below
+# 2**32, a * h + b never overflows uint64.
+_PRIME = np.uint64((1 << 32) + 15)
+
+def dedup_key(prompt_text):
+    # Case and whitespace only matter for storage, not for duplicate detection.
+    return " ".join(prompt_text.lower().split())
+
+def prompt_hash(prompt_text):
+    return hashlib.sha256(dedup_key(prompt_text).encode("utf-8")).hexdigest()
+
+class MinHasher:
+    def __init__(self, num_perm=64, shingle_size=5, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, prompt_text):
+        normalized = dedup_key(prompt_text)
+        k = self.shingle_size
+        shingles = {zlib.crc32(normalized[i:i + k].encode("utf-8")) for i in range(max(1, len(normalized) - k + 1))}
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        return ((np.outer(hashes, self.a) + self.b) % _PRIME).min(axis=0).astype(np.uint32)
+
+class MinHashLSHIndex:
+    """Banded LSH over MinHash signatures of canonical prompts for one source.
+
+    Candidates that share any band are confirmed by their estimated Jaccard
+    similarity. Persisted as an .npz of ids and signatures; buckets are rebuilt
+    on load.
+    """
+
+    def __init__(self, path, hasher, bands=16, threshold=0.8):
+        self.path = path
+        self.hasher = hasher
+        self.bands = bands
+        self.rows = hasher.num_perm // bands
+        self.threshold = threshold
+        self.signatures = {}
+        self.buckets = [{} for _ in range(bands)]
+        self.max_id = 0
+        if os.path.exists(path):
+            with np.load(path) as data:
+                for prompt_id, signature in zip(data["ids"], data["signatures"]):
+                    self._add(int(prompt_id), signature)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _add(self, prompt_id, signature):
+        self.signatures[prompt_id] = signature
+        for band, key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(key, []).append(prompt_id)
+        self.max_id = max(self.max_id, prompt_id)
+
+    def add(self, prompt_id, prompt_text=None, signature=None):
+        self._add(prompt_id, self.hasher.signature(prompt_text) if signature is None else signature)
+
+    def query(self, prompt_text=None, signature=None):
+        # Returns (canonical_id, similarity) for the closest match above threshold, else (None, 0).
+        signature = self.hasher.signature(prompt_text) if signature is None else signature
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        best_id, best_similarity = None, 0.0
+        for candidate in candidates:
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= self.threshold and similarity > best_similarity:
+                best_id, best_similarity = candidate, similarity
+        return best_id, best_similarity
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        ids = np.fromiter(self.signatures, dtype=np.int64, count=len(self.signatures))
+        signatures = np.stack(list(self.signatures.values())) if self.signatures else np.empty((0, self.hasher.num_perm), dtype=np.uint32)
+        np.savez(self.path, ids=ids, signatures=signatures)
+
+class PromptDeduplicator:
+    """Ingest-time duplicate suppression.
+
+    Exact duplicates are found by the normalized-text hash stored in
+    prompts.text_hash; near duplicates by the MinHash/LSH index. Duplicates
+    are still stored, with canonical_id pointing at the prompt they repeat.
+    """
+
+    def __init__(self, db_handler, threshold=None):
+        self.db_handler = db_handler
+        self.threshold = threshold or settings.dedup_threshold
+        self.hasher = MinHasher()
+        self.indexes = {}
+
+    def index_for(self, source):
+        if source not in self.indexes:
+            safe_source = "".join(c if c.isalnum() or c in "-_" else "_" for c in source)
+            index = MinHashLSHIndex(os.path.join(settings.output_dir, "dedup", f"{safe_source}.npz"), self.hasher, threshold=self.threshold)
+            # Catch up with canonical prompts ingested since the index was last saved.
+            for prompt_id, prompt_text in self.db_handler.fetch_canonical_prompts(source, after_id=index.max_id):
+                index.add(prompt_id, prompt_text)
+            self.indexes[source] = index
+        return self.indexes[source]
+
+    def assign(self, source, prompt_ids, prompts, hashes):
+        # Returns {prompt_id: canonical_id} for every duplicate in the batch, in
+        # input order, adding each new canonical prompt to the index as it goes.
+        index = self.index_for(source)
+        canonical_by_hash = self.db_handler.fetch_canonical_ids_by_hash(source, set(hashes), exclude_ids=prompt_ids)
+        duplicates = {}
+        for prompt_id, prompt_text, text_hash in zip(prompt_ids, prompts, hashes):
+            if text_hash in canonical_by_hash:
+                duplicates[prompt_id] = canonical_by_hash[text_hash]
+                continue
+            signature = self.hasher.signature(prompt_text)
+            canonical_id, _ = index.query(signature=signature)
+            if canonical_id is not None:
+                duplicates[prompt_id] = canonical_id
+                continue
+            canonical_by_hash[text_hash] = prompt_id
+            index.add(prompt_id, signature=signature)
+        return duplicates
+
+    def save(self):
+        for index in self.indexes.values():
+            index.save()
@@ -1,17 +1,14 @@
 import logging
+import threading
+import time
+from collections import Counter, defaultdict
 from db import DatabaseHandler
 from evaluator import RuleEvaluator, LLMJudge
+from metrics import registry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-try:
-    from langgraph.graph import StateGraph
-    LANGGRAPH_AVAILABLE = True
-except ImportError:
-    LANGGRAPH_AVAILABLE = False
-    logger.warning("langgraph not found. Using fallback GraphRouter.")
-
 class GraphRouter:
     def __init__(self, db_handler: DatabaseHandler):
         self.nodes = {}
@@ -21,25 +18,59 @@ class GraphRouter:
     def add_node(self, name, node):
         self.nodes[name] = node
 
-    def add_conditional_edge(self, start_node, condition, end_nodes):
-        self.edges[start_node] = (condition, end_nodes)
-
-    def run(self, initial_state):
-        current_node_name = "input"
-        state = initial_state
-        while current_node_name != "output":
-            current_node = self.nodes[current_node_name]
-            state = current_node.run(state)
-            if current_node_name in self.edges:
-                condition, end_nodes = self.edges[current_node_name]
-                next_node_name = condition(state)
-                if next_node_name in end_nodes:
-                    current_node_name = next_node_name
-                else:
-                    break
+    def add_edge(self, start_node, end_node):
+        self.edges[start_node] = (lambda state: end_node, {end_node: end_node})
+
+    def add_conditional_edge(self, start_node, condition, path_map):
+        # Same contract as langgraph: condition(state) returns a key of path_map,
+        # whose value names the next node.
+        self.edges[start_node] = (condition, path_map)
+
+    def next_node(self, node_name, state):
+        if node_name not in self.edges:
+            return None
+        condition, path_map = self.edges[node_name]
+        return path_map.get(condition(state))
+
+    def topological_order(self, entry="input"):
+        successors = {name: set(path_map.values()) for name, (_, path_map) in self.edges.items()}
+        indegree = {name: 0 for name in self.nodes}
+        for targets in successors.values():
+            for target in targets:
+                indegree[target] += 1
+        order, ready = [], [entry]
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            for target in successors.get(name, ()):
+                indegree[target] -= 1
+                if indegree[target] == 0:
+                    ready.append(target)
+        return order
+
+    def run_batch(self, states):
+        # Moves the whole batch through the graph one node at a time, in
+        # topological order, so each node sees every state routed to it at once.
+        pending = {name: [] for name in self.nodes}
+        pending["input"] = list(enumerate(states))
+        results = [None] * len(pending["input"])
+        for node_name in self.topological_order():
+            batch = pending[node_name]
+            if not batch:
+                continue
+            node = self.nodes[node_name]
+            batch_states = [state for _, state in batch]
+            if hasattr(node, "run_batch"):
+                batch_states = node.run_batch(batch_states)
             else:
-                break
-        return state
+                batch_states = [node.run(state) for state in batch_states]
+            for (index, _), state in zip(batch, batch_states):
+                next_name = self.next_node(node_name, state)
+                if next_name is None:
+                    results[index] = state
+                else:
+                    pending[next_name].append((index, state))
+        return results
 
 class InputNode:
     def run(self, state):
@@ -49,28 +80,33 @@ class InputNode:
 class RuleEvalNode:
     def __init__(self):
         self.evaluator = RuleEvaluator()
-    def run(self, state):
-        logger.debug("Running RuleEvalNode")
-        eval_results = self.evaluator.evaluate(state["response_text"])
-        state.update(eval_results)
-        return state
+    def run_batch(self, states):
+        for state, eval_results in zip(states, self.evaluator.evaluate_batch([state["response_text"] for state in states])):
+            state.update(eval_results)
+            state["rule_eval"] = eval_results
+        return states
 
 class LLMEvalNode:
     def __init__(self, bot_api):
         self.evaluator = LLMJudge(bot_api)
-    def run(self, state):
-        logger.debug("Running LLMEvalNode")
-        eval_results = self.evaluator.evaluate(state["prompt_text"], state["response_text"])
-        state.update(eval_results)
-        return state
+    def run_batch(self, states):
+        for state, eval_results in zip(states, self.evaluator.evaluate_batch([(state["prompt_text"], state["response_text"]) for state in states])):
+            state.update(eval_results)
+            state["llm_eval"] = eval_results
+        return states
 
 class SafetyGuardrailNode:
-    def __init__(self, db_handler: DatabaseHandler):
-        self.db_handler = db_handler
-    def run(self, state):
-        logger.warning(f"Routing to SafetyGuardrailNode for response {state['response_id']}")
-        self.db_handler.insert_failure(state["response_id"], "safety_guardrail", "Crisis detected")
+    def run_batch(self, states):
+        # The failure_log rows are left on the states for the caller to write once
+        # the response rows exist (see LangGraphRouter.run_batch).
+        logger.warning(f"Routing {len(states)} responses to SafetyGuardrailNode")
+        for state in states:
+            state.setdefault("failures", []).append(("safety_guardrail", "Crisis detected"))
+        return [self._rewrite(state) for state in states]
+
+    def _rewrite(self, state):
         state["response_text"] = "I am a helpful and harmless AI assistant."
+        state["response_rewritten"] = True
         return state
 
 class PersonaUpdateNode:
@@ -86,68 +122,138 @@ class PromptPatchNode:
         return state
 
 class ClinicianReviewNode:
-    def __init__(self, db_handler: DatabaseHandler):
-        self.db_handler = db_handler
-    def run(self, state):
-        logger.warning(f"Routing to ClinicianReviewNode for response {state['response_id']}")
-        self.db_handler.insert_failure(state["response_id"], "clinician_review", "LLM evaluation failed safety check")
-        return state
+    def run_batch(self, states):
+        logger.warning(f"Routing {len(states)} responses to ClinicianReviewNode")
+        for state in states:
+            state.setdefault("failures", []).append(("clinician_review", self._reason(state)))
+        return states
+
+    def _reason(self, state):
+        if state.get("safety_score") == 0:
+            return "LLM evaluation failed safety check"
+        return "LLM evaluation returned no usable safety score"
 
 class OutputNode:
     def run(self, state):
         logger.debug("Running OutputNode")
         return state
 
+def route_after_rule_eval(state):
+    return "safety_guardrail" if state.get("crisis_detected") else "llm_eval"
+
+def route_after_llm_eval(state):
+    # Fails closed: a response the judge could not score goes to review too.
+    safety = state.get("safety_score")
+    if safety == 0 or not isinstance(safety, int) or isinstance(safety, bool):
+        return "clinician_review"
+    return "persona_update"
+
+EDGES = [
+    ("input", "rule_eval"),
+    ("safety_guardrail", "output"),
+    ("clinician_review", "output"),
+    ("persona_update", "prompt_patch"),
+    ("prompt_patch", "output"),
+]
+
+CONDITIONAL_EDGES = [
+    ("rule_eval", route_after_rule_eval, {"safety_guardrail": "safety_guardrail", "llm_eval": "llm_eval"}),
+    ("llm_eval", route_after_llm_eval, {"clinician_review": "clinician_review", "persona_update": "persona_update"}),
+]
+
+class TimedNode:
+    """Wraps a node so every call records its latency and the path taken.
+
+    Per-state timings land in state["node_timings"] and the visited nodes in
+    state["route"]; aggregate counts go to the router's node_stats.
+    """
+
+    def __init__(self, name, node, router):
+        self.name = name
+        self.node = node
+        self.router = router
+
+    def _record(self, states, elapsed):
+        for state in states:
+            state.setdefault("node_timings", {})[self.name] = elapsed / len(states)
+            state.setdefault("route", []).append(self.name)
+        self.router.record_node(self.name, len(states), elapsed)
+
+    def run_batch(self, states):
+        start = time.perf_counter()
+        if hasattr(self.node, "run_batch"):
+            states = self.node.run_batch(states)
+        else:
+            states = [self.node.run(state) for state in states]
+        self._record(states, time.perf_counter() - start)
+        return states
+
+ROUTER_BRANCHES = registry.counter("router_branches_total", "Conditional edges taken in the routing graph", ("node", "branch"))
+ROUTER_NODE_SECONDS = registry.histogram("router_node_seconds", "Time per routing-graph node call (one state or one batch)", ("node",))
+
 class LangGraphRouter:
     def __init__(self, db_handler, bot_api):
         self.db_handler = db_handler
-        if LANGGRAPH_AVAILABLE:
-            self.graph = self._build_langgraph(bot_api)
-        else:
-            self.graph = self._build_fallback_graph(bot_api)
-
-    def _build_langgraph(self, bot_api):
-        workflow = StateGraph(dict)
-        workflow.add_node("input", InputNode().run)
-        workflow.add_node("rule_eval", RuleEvalNode().run)
-        workflow.add_node("llm_eval", LLMEvalNode(bot_api).run)
-        workflow.add_node("safety_guardrail", SafetyGuardrailNode(self.db_handler).run)
-        workflow.add_node("persona_update", PersonaUpdateNode().run)
-        workflow.add_node("prompt_patch", PromptPatchNode().run)
-        workflow.add_node("clinician_review", ClinicianReviewNode(self.db_handler).run)
-        workflow.add_node("output", OutputNode().run)
-
-        workflow.set_entry_point("input")
-        workflow.add_edge("input", "rule_eval")
-        workflow.add_conditional_edges(
-            "rule_eval",
-            lambda state: "safety_guardrail" if state.get("crisis_detected") else "llm_eval",
-            {"safety_guardrail": "output", "llm_eval": "llm_eval"}
-        )
-        workflow.add_conditional_edges(
-            "llm_eval",
-            lambda state: "clinician_review" if state.get("safety_score") == 0 else "persona_update",
-            {"clinician_review": "output", "persona_update": "prompt_patch"}
-        )
-        workflow.add_edge("prompt_patch", "output")
-        workflow.add_edge("persona_update", "prompt_patch")
-        
-        return workflow.compile()
-
-    def _build_fallback_graph(self, bot_api):
+        self.node_stats = defaultdict(lambda: {"calls": 0, "items": 0, "seconds": 0.0})
+        self.branch_counts = Counter()
+        self._stats_lock = threading.Lock()
+        self.nodes = self._build_nodes(bot_api)
+        self.batch_graph = self._build_graph()
+
+    def _build_nodes(self, bot_api):
+        nodes = {
+            "input": InputNode(),
+            "rule_eval": RuleEvalNode(),
+            "llm_eval": LLMEvalNode(bot_api),
+            "safety_guardrail": SafetyGuardrailNode(),
+            "persona_update": PersonaUpdateNode(),
+            "prompt_patch": PromptPatchNode(),
+            "clinician_review": ClinicianReviewNode(),
+            "output": OutputNode(),
+        }
+        return {name: TimedNode(name, node, self) for name, node in nodes.items()}
+
+    def _counted(self, node_name, condition):
+        def route(state):
+            branch = condition(state)
+            with self._stats_lock:
+                self.branch_counts[(node_name, branch)] += 1
+            ROUTER_BRANCHES.inc(node=node_name, branch=branch)
+            return branch
+        return route
+
+    def _build_graph(self):
         router = GraphRouter(self.db_handler)
-        router.add_node("input", InputNode())
-        router.add_node("rule_eval", RuleEvalNode())
-        router.add_node("llm_eval", LLMEvalNode(bot_api))
-        router.add_node("safety_guardrail", SafetyGuardrailNode(self.db_handler))
-        router.add_node("persona_update", PersonaUpdateNode())
-        router.add_node("prompt_patch", PromptPatchNode())
-        router.add_node("clinician_review", ClinicianReviewNode(self.db_handler))
-        router.add_node("output", OutputNode())
-
-        router.add_conditional_edge("rule_eval", lambda state: "safety_guardrail" if state.get("crisis_detected") else "llm_eval", {"safety_guardrail": "output", "llm_eval": "llm_eval"})
-        router.add_conditional_edge("llm_eval", lambda state: "clinician_review" if state.get("safety_score") == 0 else "persona_update", {"clinician_review": "output", "persona_update": "prompt_patch"})
+        for name, node in self.nodes.items():
+            router.add_node(name, node)
+        for start, end in EDGES:
+            router.add_edge(start, end)
+        for start, condition, path_map in CONDITIONAL_EDGES:
+            router.add_conditional_edge(start, self._counted(start, condition), path_map)
         return router
 
-    def run(self, state):
-        return self.graph.invoke(state) if LANGGRAPH_AVAILABLE else self.graph.run(state)
+    def record_node(self, node_name, items, seconds):
+        with self._stats_lock:
+            stats = self.node_stats[node_name]
+            stats["calls"] += 1
+            stats["items"] += items
+            stats["seconds"] += seconds
+        ROUTER_NODE_SECONDS.observe(seconds, node=node_name)
+
+    def timing_summary(self):
+        with self._stats_lock:
+            summary = [{"node": name, **stats, "seconds_per_item": stats["seconds"] / stats["items"] if stats["items"] else 0.0} for name, stats in self.node_stats.items()]
+            branches = {f"{node}->{branch}": count for (node, branch), count in self.branch_counts.items()}
+        return sorted(summary, key=lambda row: row["seconds"], reverse=True), branches
+
+    def log_timing_summary(self):
+        summary, branches = self.timing_summary()
+        for row in summary:
+            logger.info(f"Node {row['node']}: {row['items']} items in {row['calls']} calls, {row['seconds']:.2f}s total, {row['seconds_per_item'] * 1000:.1f}ms/item")
+        if branches:
+            logger.info(f"Branches taken: {branches}")
+
+    def run_batch(self, states):
+        # Writes nothing: states need no response_id yet, and failure nodes list
+        # their failure_log rows in state["failures"] for the caller to insert.
+        return self.batch_graph.run_batch(states)
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from settings import settings
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = registry.counter("cache_lookups_total", "Cache lookups by cache and outcome", ("cache", "outcome"))
+MCP_REQUEST_SECONDS = registry.histogram("mcp_request_seconds", "MCP web-context request latency")
+
+class MCPClient:
+    """Web-context client for the MCP endpoint.
+
+    Reuses keep-alive connections through a pooled requests.Session and keeps a
+    TTL/LRU cache keyed on the normalized query, so repeated queries within a
+    run cost nothing. Failed fetches are not cached.
+    """
+
+    def __init__(self, url=None, timeout=None, pool_size=None, cache_size=None, cache_ttl=None):
+        self.url = url or settings.mcp_url
+        self.timeout = timeout or settings.mcp_timeout
+        self.pool_size = pool_size or settings.mcp_pool_size
+        self.cache_size = cache_size or settings.mcp_cache_size
+        self.cache_ttl = settings.mcp_cache_ttl if cache_ttl is None else cache_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.request_seconds = 0.0
+
+    @staticmethod
+    def normalize_query(query):
+        return " ".join(query.lower().split())
+
+    def _cache_get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="mcp", outcome="hit")
+                return True, entry[1]
+            if entry is not None:
+                del self._cache[key]
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="mcp", outcome="miss")
+            return False, None
+
+    def _cache_put(self, key, value):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def fetch(self, query):
+        if not self.url:
+            logger.debug("MCP_URL not set, skipping web context fetch.")
+            return None
+        key = self.normalize_query(query)
+        found, value = self._cache_get(key)
+        if found:
+            return value
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, json={"q": query}, timeout=self.timeout)
+            response.raise_for_status()
+            value = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning(f"Could not fetch web context from MCP: {e}")
+            return None
+        finally:
+            elapsed = time.perf_counter() - start
+            MCP_REQUEST_SECONDS.observe(elapsed)
+            with self._lock:
+                self.request_seconds += elapsed
+        self._cache_put(key, value)
+        return value
+
+    def fetch_many(self, queries, max_workers=None):
+        # Identical (normalized) queries are fetched once; results keep input order.
+        queries = list(queries)
+        unique = {}
+        for query in queries:
+            unique.setdefault(self.normalize_query(query), query)
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool_size) as executor:
+            fetched = dict(zip(unique, executor.map(self.fetch, unique.values())))
+        return [fetched[self.normalize_query(query)] for query in queries]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "avg_request_seconds": self.request_seconds / self.misses if self.misses else 0.0,
+                "cached_queries": len(self._cache),
+            }
+
+    def close(self):
+        self.session.close()
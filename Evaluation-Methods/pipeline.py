@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+STAGE_ITEMS = registry.counter("pipeline_stage_items_total", "Items leaving each pipeline stage, by outcome", ("stage", "outcome"))
+QUEUE_DEPTH = registry.gauge("pipeline_queue_depth", "Items waiting in each stage's input queue", ("stage",))
+
+class Stage:
+    # With batch_size > 1, fn receives a list of up to batch_size items (whatever
+    # is queued when a worker frees up) and returns the list to pass on.
+    def __init__(self, name, fn, workers=1, batch_size=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+
+class StagedPipeline:
+    """Runs items through a chain of stages, each with its own worker pool.
+
+    Stages are connected by bounded queues, so a slow stage blocks the ones
+    upstream of it instead of letting work pile up in memory. A stage function
+    returns the item to pass downstream, or None to drop it. Exceptions are
+    logged and only drop the item that raised them: a batch stage that raises is
+    retried one item at a time, so stage functions must be safe to rerun on items
+    of a failed batch.
+    """
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size or 2 * max(stage.workers for stage in stages)
+        self.results = []
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._queues = []
+
+    def stop(self):
+        # Stops feeding new items; items already in flight still drain.
+        self._stop.set()
+
+    def run(self, items):
+        queues = self._queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker_num in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index, queues, remaining), name=f"{stage.name}-{worker_num}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            if self._stop.is_set():
+                break
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def queue_depths(self):
+        return {stage.name: inbox.qsize() for stage, inbox in zip(self.stages, self._queues)}
+
+    def _next_batch(self, inbox, batch_size):
+        # Blocks for the first item, then takes whatever else is already queued.
+        batch, done = [], False
+        item = inbox.get()
+        while True:
+            if item is _DONE:
+                done = True
+                break
+            batch.append(item)
+            if len(batch) >= batch_size:
+                break
+            try:
+                item = inbox.get_nowait()
+            except queue.Empty:
+                break
+        return batch, done
+
+    def _process(self, stage, batch):
+        try:
+            if stage.batch_size > 1:
+                results = [result for result in stage.fn(batch) if result is not None]
+            else:
+                result = stage.fn(batch[0])
+                results = [] if result is None else [result]
+            STAGE_ITEMS.inc(len(results), stage=stage.name, outcome="ok")
+            if len(results) < len(batch):
+                STAGE_ITEMS.inc(len(batch) - len(results), stage=stage.name, outcome="dropped")
+            return results
+        except Exception as e:
+            if stage.batch_size > 1 and len(batch) > 1:
+                logger.warning(f"Stage '{stage.name}' failed on a batch of {len(batch)} ({e}); retrying items one at a time.")
+                return [result for item in batch for result in self._process(stage, [item])]
+            STAGE_ITEMS.inc(len(batch), stage=stage.name, outcome="error")
+            logger.error(f"Stage '{stage.name}' failed: {e}")
+            with self._lock:
+                self.errors += len(batch)
+            return []
+
+    def _work(self, index, queues, remaining):
+        stage = self.stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+        done = False
+        while not done:
+            batch, done = self._next_batch(inbox, stage.batch_size)
+            QUEUE_DEPTH.set(inbox.qsize(), stage=stage.name)
+            if not batch:
+                continue
+            for result in self._process(stage, batch):
+                if outbox is not None:
+                    outbox.put(result)
+                else:
+                    with self._lock:
+                        self.results.append(result)
+
+        with self._lock:
+            remaining[index] -= 1
+            last_worker = remaining[index] == 0
+        if last_worker and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(_DONE)
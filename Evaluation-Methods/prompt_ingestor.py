@@ -1,38 +1,118 @@
 import csv
 import json
 import logging
-import requests
+import os
+import time
 from db import DatabaseHandler
+from dedup import PromptDeduplicator, dedup_key, prompt_hash
+from mcp_client import MCPClient
 from settings import settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _prompt_from_item(item):
+    if isinstance(item, dict):
+        return item.get('prompt', item.get('text'))
+    return item
+
+def iter_csv_prompts(f):
+    for row in csv.reader(f):
+        if row:
+            yield row[0]
+
+def iter_jsonl_prompts(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield _prompt_from_item(json.loads(line))
+
+def iter_json_array_prompts(f, chunk_size=1 << 16):
+    # Incremental parser for a top-level JSON array: decodes one element at a
+    # time from a sliding buffer, so memory stays bounded by the largest element.
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, started = "", 0, False, False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            chunk = f.read(chunk_size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        char = buffer[pos]
+        if not started:
+            if char != "[":
+                raise ValueError("Expected a top-level JSON array of prompts")
+            started, pos = True, pos + 1
+            continue
+        if char == "]":
+            return
+        if char == ",":
+            pos += 1
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            item, end = None, None
+        # An element ending exactly at the buffer edge may be truncated (e.g. a number).
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError("Malformed element in JSON array of prompts")
+            chunk = f.read(chunk_size)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        yield _prompt_from_item(item)
+        pos = end
+
 class PromptIngestor:
     def __init__(self, db_handler: DatabaseHandler):
         self.db_handler = db_handler
+        self.mcp_client = MCPClient()
 
-    def ingest_from_file(self, file_path, source):
-        if file_path.endswith('.csv'):
-            with open(file_path, 'r') as f:
-                reader = csv.reader(f)
-                for row in reader:
-                    self.db_handler.insert_prompt(source, row[0])
-        elif file_path.endswith('.json'):
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                for item in data:
-                    self.db_handler.insert_prompt(source, item['prompt'])
-        logger.info(f"Ingested prompts from {file_path}")
+    def ingest_from_file(self, file_path, source, batch_size=None, dedup=None):
+        readers = {".csv": iter_csv_prompts, ".jsonl": iter_jsonl_prompts, ".json": iter_json_array_prompts}
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in readers:
+            raise ValueError(f"Unsupported prompt file type '{extension}' for {file_path}; expected .csv, .json or .jsonl")
+        batch_size = batch_size or settings.ingest_batch_size
+        deduplicator = PromptDeduplicator(self.db_handler) if (settings.dedup_enabled if dedup is None else dedup) else None
+        if deduplicator:
+            deduplicator.index_for(source)
+        self.duplicates_found = 0
+
+        start = time.perf_counter()
+        count, batch = 0, []
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            for prompt in readers[extension](f):
+                # Stored as written; only the hash and MinHash keys are normalized.
+                if prompt is None or not dedup_key(str(prompt)):
+                    continue
+                batch.append(str(prompt))
+                if len(batch) >= batch_size:
+                    count += self._flush(source, batch, deduplicator)
+                    batch = []
+        count += self._flush(source, batch, deduplicator)
+        if deduplicator:
+            deduplicator.save()
+        elapsed = time.perf_counter() - start
+        logger.info(f"Ingested {count} prompts from {file_path} in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/sec), {self.duplicates_found} marked as duplicates")
+        return count
+
+    def _flush(self, source, prompts, deduplicator=None):
+        if not prompts:
+            return 0
+        hashes = [prompt_hash(prompt) for prompt in prompts]
+        prompt_ids = self.db_handler.insert_prompts(source, prompts, hashes)
+        if deduplicator:
+            duplicates = deduplicator.assign(source, prompt_ids, prompts, hashes)
+            self.db_handler.mark_duplicate_prompts(duplicates)
+            self.duplicates_found += len(duplicates)
+        return len(prompts)
 
     def fetch_web_context(self, query):
-        if not settings.mcp_url:
-            logger.debug("MCP_URL not set, skipping web context fetch.")
-            return None
-        try:
-            response = requests.post(settings.mcp_url, json={"q": query}, timeout=5)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Could not fetch web context from MCP: {e}")
-            return None
+        return self.mcp_client.fetch(query)
+
+    def fetch_web_context_batch(self, queries, max_workers=None):
+        return self.mcp_client.fetch_many(queries, max_workers=max_workers)
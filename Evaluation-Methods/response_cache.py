@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from settings import settings
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = registry.counter("cache_lookups_total", "Cache lookups by cache and outcome", ("cache", "outcome"))
+
+class ResponseCache:
+    """Persistent LRU cache of model replies, stored in a local SQLite file.
+
+    Keys hash the model name, system prompt, context snippets and prompt text,
+    so a change to any of them is a miss. With `bypass` set, lookups always
+    miss but fresh replies are still written, which refreshes stale entries.
+    """
+
+    def __init__(self, path=None, max_entries=None, bypass=False):
+        self.path = path or os.path.join(settings.output_dir, "response_cache.sqlite")
+        self.max_entries = max_entries or settings.response_cache_max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, system_prompt, context_snippets, prompt_text):
+        payload = json.dumps([model_name, system_prompt or "", list(context_snippets or []), prompt_text])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="response", outcome="miss")
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="response", outcome="hit")
+            return row[0]
+
+    def put(self, key, response):
+        with self._lock:
+            inserted = self._conn.execute("INSERT OR IGNORE INTO responses (key, response, last_used) VALUES (?, ?, ?)", (key, response, time.time())).rowcount
+            if not inserted:
+                self._conn.execute("UPDATE responses SET response = ?, last_used = ? WHERE key = ?", (response, time.time(), key))
+            self._size += inserted
+            if self._size > self.max_entries:
+                # Evict down to 90% so we don't pay for an eviction on every insert.
+                excess = self._size - int(self.max_entries * 0.9)
+                self._conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+                self._size -= excess
+            self._conn.commit()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        logger.info(f"Response cache: {self.hits} hits, {self.misses} misses ({self.hit_rate():.0%} hit rate).")
@@ -0,0 +1,91 @@
+import logging
+import math
+import random
+from collections import defaultdict
+from statistics import NormalDist
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS = ("safety_score", "empathy_score", "helpfulness_score")
+
+# Planning standard deviations used when a stratum has no earlier scores:
+# the Bernoulli maximum for safety (0/1) and range/4 for the 0-3 scales.
+DEFAULT_STD = {"safety_score": 0.5, "empathy_score": 0.75, "helpfulness_score": 0.75}
+
+class StratifiedSampler:
+    """Stratified random sampling of prompts with bootstrap confidence intervals.
+
+    Strata are (source, cluster_id); prompts whose responses were never
+    clustered share a stratum with cluster_id -1. The total sample size is the
+    smallest that meets `margin` at `confidence` for every metric, using
+    Neyman allocation for whichever metric needs the most samples.
+    """
+
+    def __init__(self, margin=0.1, confidence=0.95, seed=0, min_per_stratum=2, n_bootstrap=2000):
+        self.margin = margin
+        self.confidence = confidence
+        self.seed = seed
+        self.min_per_stratum = min_per_stratum
+        self.n_bootstrap = n_bootstrap
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    @staticmethod
+    def stratify(population):
+        # population rows: (prompt_id, text, source, cluster_id, safety, empathy, helpfulness)
+        strata = defaultdict(list)
+        for row in population:
+            strata[(row[2], -1 if row[3] is None else int(row[3]))].append(row)
+        return strata
+
+    def _stratum_std(self, rows, metric_index, metric):
+        scores = [row[4 + metric_index] for row in rows if row[4 + metric_index] is not None]
+        if len(scores) < 2:
+            return DEFAULT_STD[metric]
+        return max(float(np.std(scores, ddof=1)), 1e-3)
+
+    def plan(self, population):
+        strata = self.stratify(population)
+        total = sum(len(rows) for rows in strata.values())
+        if not total:
+            return {}
+        weights = {key: len(rows) / total for key, rows in strata.items()}
+        tolerance = (self.margin / self.z) ** 2
+
+        best_n, best_allocation = 0, None
+        for metric_index, metric in enumerate(METRICS):
+            stds = {key: self._stratum_std(rows, metric_index, metric) for key, rows in strata.items()}
+            weighted_std = sum(weights[key] * stds[key] for key in strata)
+            weighted_var = sum(weights[key] * stds[key] ** 2 for key in strata)
+            n = math.ceil(weighted_std ** 2 / (tolerance + weighted_var / total))
+            if n > best_n:
+                best_n = n
+                best_allocation = {key: weights[key] * stds[key] / weighted_std for key in strata}
+
+        rng = random.Random(self.seed)
+        sample = {}
+        for key, rows in sorted(strata.items(), key=lambda item: str(item[0])):
+            n_h = min(len(rows), max(self.min_per_stratum, math.ceil(best_n * best_allocation[key])))
+            sample[key] = rng.sample(sorted(rows, key=lambda row: row[0]), n_h)
+        logger.info(f"Sampling {sum(len(rows) for rows in sample.values())} of {total} prompts across {len(strata)} strata (margin {self.margin}, confidence {self.confidence})")
+        return sample
+
+    def estimate(self, stratum_sizes, stratum_scores):
+        # stratum_sizes: {stratum: population size}; stratum_scores: {stratum: [(safety, empathy, helpfulness), ...]}
+        observed = {key: np.asarray(scores, dtype=float) for key, scores in stratum_scores.items() if len(scores)}
+        if not observed:
+            return {}
+        total = sum(stratum_sizes[key] for key in observed)
+        weights = {key: stratum_sizes[key] / total for key in observed}
+        point = sum(weights[key] * values.mean(axis=0) for key, values in observed.items())
+
+        rng = np.random.default_rng(self.seed)
+        boot = np.zeros((self.n_bootstrap, len(METRICS)))
+        for key, values in observed.items():
+            idx = rng.integers(0, len(values), size=(self.n_bootstrap, len(values)))
+            boot += weights[key] * values[idx].mean(axis=1)
+        alpha = (1 - self.confidence) / 2
+        low, high = np.quantile(boot, [alpha, 1 - alpha], axis=0)
+        n = sum(len(values) for values in observed.values())
+        return {metric: {"mean": float(point[i]), "ci_low": float(low[i]), "ci_high": float(high[i]), "n": n} for i, metric in enumerate(METRICS)}
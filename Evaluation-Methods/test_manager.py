@@ -1,44 +1,82 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from db import DatabaseHandler
 from prompt_ingestor import PromptIngestor
 from evaluator import LLMJudge
 from bot_api import ChatbotAPI
+from budget import BudgetExceeded
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RESULT_FLUSH_SIZE = 100
+
 class TestManager:
     def __init__(self, db_handler: DatabaseHandler, bot_api: ChatbotAPI):
         self.db_handler = db_handler
         self.prompt_ingestor = PromptIngestor(db_handler)
-        self.llm_judge = LLMJudge(bot_api)
+        self.llm_judge = LLMJudge(bot_api, stage_name="psych_test")
 
     def add_test(self, name, description, scoring_rubric):
         self.db_handler.insert_test(name, description, scoring_rubric)
         logger.info(f"Added test: {name}")
 
-    def run_tests_on_prompts(self, test_id, prompt_ids):
-        prompts_to_score = self.db_handler.fetch_unscored_prompts_for_tests(test_id, prompt_ids)
-        
-        with self.db_handler.Session() as session:
-            test_info = session.execute(text("SELECT scoring_rubric FROM psych_tests WHERE id = :test_id"), {"test_id": test_id}).fetchone()
-            if not test_info:
+    def _build_eval_prompt(self, scoring_rubric, prompt_text, web_context):
+        # This is a simplification. A real implementation would use the bot to get a response first.
+        # Here we just score the prompt directly.
+        eval_prompt = f"Score the following text based on this rubric: {scoring_rubric}\n\nText: {prompt_text}"
+        if web_context:
+            eval_prompt += "\n\nWeb Context:\n" + "\n".join(web_context)
+        return eval_prompt
+
+    def run_test_matrix(self, test_ids, prompt_ids, concurrency=4):
+        # Plan every (test, prompt) pair still unscored, fetch each prompt's web
+        # context once, then run the judge calls with bounded concurrency.
+        rubrics = self.db_handler.fetch_test_rubrics(test_ids)
+        tasks = []
+        for test_id in test_ids:
+            if test_id not in rubrics:
                 logger.error(f"Test with id {test_id} not found.")
-                return
-
-        scoring_rubric = test_info[0]
-
-        for prompt_id, prompt_text in prompts_to_score:
-            web_context = self.prompt_ingestor.fetch_web_context(prompt_text)
-            
-            # This is a simplification. A real implementation would use the bot to get a response first.
-            # Here we just score the prompt directly.
-            
-            eval_prompt = f"Score the following text based on this rubric: {scoring_rubric}\n\nText: {prompt_text}"
-            if web_context:
-                eval_prompt += "\n\nWeb Context:\n" + "\n".join(web_context)
-
-            evaluation = self.llm_judge.evaluate("N/A", eval_prompt) # No real response to evaluate
-            
-            self.db_handler.mark_test_scored(test_id, prompt_id, evaluation['helpfulness_score'], evaluation['rationale'])
-            logger.info(f"Scored prompt {prompt_id} for test {test_id}")
+                continue
+            for prompt_id, prompt_text in self.db_handler.fetch_unscored_prompts_for_tests(test_id, prompt_ids):
+                tasks.append((test_id, prompt_id, prompt_text))
+        if not tasks:
+            logger.info("No unscored (test, prompt) pairs to run.")
+            return
+
+        prompt_texts = {prompt_id: prompt_text for _, prompt_id, prompt_text in tasks}
+        logger.info(f"Running {len(tasks)} test/prompt pairs over {len(prompt_texts)} prompts with concurrency {concurrency}")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            web_contexts = dict(zip(prompt_texts, self.prompt_ingestor.fetch_web_context_batch(prompt_texts.values(), max_workers=concurrency)))
+
+            def score(task):
+                test_id, prompt_id, prompt_text = task
+                eval_prompt = self._build_eval_prompt(rubrics[test_id], prompt_text, web_contexts[prompt_id])
+                evaluation = self.llm_judge.evaluate("N/A", eval_prompt) # No real response to evaluate
+                return test_id, prompt_id, evaluation['helpfulness_score'], evaluation['rationale']
+
+            pending, stopped = [], False
+            futures = [executor.submit(score, task) for task in tasks]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    pending.append(future.result())
+                except BudgetExceeded as e:
+                    # Queued pairs are cancelled and stay unscored for the next run;
+                    # pairs already running are still drained and saved.
+                    if not stopped:
+                        logger.error(f"Stopping test run: {e}")
+                        stopped = True
+                        for remaining in futures:
+                            remaining.cancel()
+                    continue
+                except Exception as e:
+                    logger.error(f"Test scoring failed: {e}")
+                    continue
+                if len(pending) >= RESULT_FLUSH_SIZE:
+                    self.db_handler.insert_test_results(pending)
+                    pending = []
+            self.db_handler.insert_test_results(pending)
+        logger.info(f"Scored {len(tasks)} test/prompt pairs for tests {test_ids}")
+        logger.info(f"Web context fetches: {self.prompt_ingestor.mcp_client.stats()}")
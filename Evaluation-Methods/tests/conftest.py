@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# Modules import each other by bare name (from settings import settings), as
+# when the CLI is run from this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_stub import MCPStub
+
+@pytest.fixture
+def mcp_stub():
+    with MCPStub() as stub:
+        yield stub
@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+
+pytest.importorskip("google.generativeai")
+from google.api_core import exceptions as google_exceptions
+import bot_api
+from bot_api import ChatbotAPI
+
+class FlakyModel:
+    """Streams `chunks`, raising ServiceUnavailable after `fail_after` chunks on each of the first `failures` attempts."""
+
+    model_name = "models/fake"
+
+    def __init__(self, chunks, failures, fail_after=0):
+        self.chunks, self.failures, self.fail_after = chunks, failures, fail_after
+        self.attempts = 0
+
+    async def call(self, model, contents, on_chunk):
+        self.attempts += 1
+        for position, chunk in enumerate(self.chunks):
+            if self.attempts <= self.failures and position == self.fail_after:
+                raise google_exceptions.ServiceUnavailable("try again")
+            if on_chunk:
+                on_chunk(chunk)
+        return "".join(self.chunks), None
+
+def make_api(monkeypatch, model, max_retries=3):
+    api = ChatbotAPI.__new__(ChatbotAPI)
+    api.budget, api.max_in_flight, api.timeout, api.max_retries, api._semaphore = None, 2, 5, max_retries, None
+    monkeypatch.setattr(api, "_call", model.call)
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(bot_api.asyncio, "sleep", sleep)
+    monkeypatch.setattr(bot_api.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(bot_api.settings, "gemini_retry_base_delay", 1.0)
+    monkeypatch.setattr(bot_api.settings, "gemini_retry_max_delay", 3.0)
+    return api, delays
+
+def test_backoff_doubles_up_to_the_cap(monkeypatch):
+    model = FlakyModel(["ok"], failures=3)
+    api, delays = make_api(monkeypatch, model)
+    assert asyncio.run(api._generate(model, "prompt")) == "ok"
+    assert delays == [1.0, 2.0, 3.0]
+
+def test_gives_up_after_max_retries(monkeypatch):
+    model = FlakyModel(["ok"], failures=5)
+    api, delays = make_api(monkeypatch, model, max_retries=2)
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(api._generate(model, "prompt"))
+    assert model.attempts == 3 and len(delays) == 2
+
+def test_retried_stream_does_not_replay_delivered_text(monkeypatch):
+    model = FlakyModel(["Hel", "lo", " there"], failures=1, fail_after=2)
+    api, _ = make_api(monkeypatch, model)
+    received = []
+    assert asyncio.run(api._generate(model, "prompt", on_chunk=received.append)) == "Hello there"
+    assert "".join(received) == "Hello there"
+    assert received == ["Hel", "lo", " there"]
@@ -0,0 +1,72 @@
+import pytest
+from budget import BudgetExceeded, BudgetTracker, stage, current_stage
+
+PRICES = {"big": (1.0, 1.0), "small": (0.1, 0.1)}
+
+class FakeDB:
+    def __init__(self, spent_today=0.0):
+        self.spent_today = spent_today
+        self.usage = []
+
+    def fetch_token_cost_since(self, since):
+        return self.spent_today + sum(row[-1] for row in self.usage)
+
+    def insert_token_usage(self, records):
+        self.usage += records
+
+def tracker(db=None, **kwargs):
+    options = {"run_budget": 0, "daily_budget": 0, "fallback_model": "small", "degrade_at": 0.8, "prices": PRICES}
+    options.update(kwargs)
+    return BudgetTracker(db, **options)
+
+def test_price_matches_longest_known_prefix():
+    budget = tracker(prices={"big": (1.0, 2.0), "big-pro": (10.0, 20.0)})
+    assert budget.price("models/big-pro-002", 1000, 1000) == 30.0
+    assert budget.price("big-001", 500, 0) == 0.5
+    assert budget.price("unknown", 1000, 1000) == 0.0
+
+def test_degrades_then_exceeds_run_budget():
+    budget = tracker(run_budget=10.0)
+    stopped = []
+    budget.on_exceeded = lambda: stopped.append(True)
+    budget.record("gemini", "big", 4000, 3000)
+    assert budget.model_for("big") == "big" and not budget.exceeded
+    budget.record("gemini", "big", 1000, 0)
+    assert budget.model_for("big") == "small"
+    budget.check()
+    budget.record("gemini", "big", 2000, 0)
+    assert budget.exceeded and stopped == [True]
+    with pytest.raises(BudgetExceeded):
+        budget.check()
+
+def test_start_run_refuses_when_today_is_already_spent():
+    budget = tracker(FakeDB(spent_today=5.0), daily_budget=5.0)
+    assert budget.exceeded
+    with pytest.raises(BudgetExceeded):
+        budget.check()
+
+def test_start_run_degrades_up_front_and_resets_only_run_spend():
+    db = FakeDB(spent_today=4.0)
+    budget = tracker(db, run_budget=100.0, daily_budget=5.0)
+    assert budget.degraded and not budget.exceeded
+    budget.record("gemini", "small", 10000, 0)
+    budget.flush()
+    budget.start_run(2)
+    assert budget.run_cost == 0.0 and budget.exceeded
+
+def test_check_sees_spend_flushed_by_other_processes():
+    db = FakeDB()
+    budget = tracker(db, daily_budget=5.0, degrade_at=1.0)
+    budget.check()
+    db.spent_today = 6.0
+    budget.flush()
+    with pytest.raises(BudgetExceeded):
+        budget.check()
+
+def test_stage_labels_nest():
+    assert current_stage() == "other"
+    with stage("generate"):
+        with stage("judge"):
+            assert current_stage() == "judge"
+        assert current_stage() == "generate"
+    assert current_stage() == "other"
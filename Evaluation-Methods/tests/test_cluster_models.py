@@ -0,0 +1,103 @@
+import json
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from settings import settings
+from Tracker.cluster_models import IncrementalClusterer
+
+ModelRow = namedtuple("ModelRow", "id params path n_fit noise_rate fitted_at age_seconds")
+
+class FakeDB:
+    def __init__(self, model_row=None, unassigned=()):
+        self.model_row, self.unassigned = model_row, list(unassigned)
+        self.saved = []
+        engine = create_engine("sqlite://")
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE chatbot_responses (id INTEGER, text TEXT, created_at TEXT)"))
+            connection.execute(text("INSERT INTO chatbot_responses VALUES (1, 'a', '2024-01-01'), (2, 'b', '2024-01-02')"))
+        self.Session = sessionmaker(bind=engine)
+
+    def fetch_latest_cluster_model(self, method):
+        return self.model_row
+
+    def fetch_unassigned_responses(self, model_version, since=None, limit=None):
+        return self.unassigned
+
+    def build_responses_query(self, since=None, limit=None):
+        return "SELECT id, text, created_at FROM chatbot_responses", {}
+
+    def start_cluster_run(self, method, params, model_version=None):
+        self.saved.append({"params": params, "model_version": model_version})
+        return len(self.saved)
+
+    def save_cluster_assignments(self, run_id, response_ids, cluster_ids, cluster_probs, model_version=None):
+        self.saved[run_id - 1]["assignments"] = dict(zip(response_ids.tolist(), cluster_ids.tolist()))
+        return len(response_ids)
+
+class FakeEmbeddingStore:
+    model_name = "model"
+
+    def get(self, texts):
+        return np.ones((len(texts), 4))
+
+class ScriptedClusterer(IncrementalClusterer):
+    """Replaces the UMAP/HDBSCAN calls with fixed labels, to exercise the refit decisions."""
+
+    def __init__(self, db, predicted_labels):
+        super().__init__(db, FakeEmbeddingStore(), model_dir="unused")
+        self.predicted_labels = np.asarray(predicted_labels)
+        self.fits = 0
+
+    def _load(self, row):
+        return {}
+
+    def predict(self, models, embeddings):
+        return self.predicted_labels, np.ones(len(embeddings)), np.zeros((len(embeddings), 2))
+
+    def fit(self, embeddings):
+        self.fits += 1
+        return 99, np.zeros(len(embeddings), dtype=int), np.ones(len(embeddings)), np.zeros((len(embeddings), 2))
+
+def model_row(noise_rate=0.1, age_days=1, embedding_model="model"):
+    return ModelRow(7, json.dumps({"embedding_model": embedding_model}), "v7.pkl", 100, noise_rate, None, age_days * 86400)
+
+UNASSIGNED = [(1, "a", datetime(2024, 1, 1)), (2, "b", datetime(2024, 1, 2)), (3, "c", datetime(2024, 1, 3)), (4, "d", datetime(2024, 1, 4))]
+
+@pytest.fixture(autouse=True)
+def refit_settings(monkeypatch):
+    monkeypatch.setattr(settings, "cluster_refit_days", 7)
+    monkeypatch.setattr(settings, "cluster_drift_threshold", 0.15)
+
+def test_stale_when_old_or_fitted_on_another_embedding_model():
+    clusterer = ScriptedClusterer(FakeDB(), [])
+    assert not clusterer._stale(model_row(age_days=6))
+    assert clusterer._stale(model_row(age_days=8))
+    assert clusterer._stale(model_row(embedding_model="other"))
+
+def test_new_responses_are_assigned_under_the_saved_model():
+    db = FakeDB(model_row(noise_rate=0.1), UNASSIGNED)
+    clusterer = ScriptedClusterer(db, [0, 1, 0, -1])
+    df = clusterer.run()
+    assert clusterer.fits == 0 and len(df) == 4
+    assert db.saved == [{"params": {"mode": "predict", "time_window": None, "limit": 1000}, "model_version": 7, "assignments": {1: 0, 2: 1, 3: 0, 4: -1}}]
+
+def test_noise_drift_triggers_a_refit():
+    # 50% noise against a fit with 10% exceeds the 15-point threshold.
+    db = FakeDB(model_row(noise_rate=0.1), UNASSIGNED)
+    clusterer = ScriptedClusterer(db, [0, -1, 0, -1])
+    clusterer.run()
+    assert clusterer.fits == 1
+    assert [(run["params"]["mode"], run["model_version"]) for run in db.saved] == [("fit", 99)]
+
+def test_stale_model_is_refitted_without_predicting():
+    db = FakeDB(model_row(age_days=30), UNASSIGNED)
+    clusterer = ScriptedClusterer(db, [])
+    clusterer.run()
+    assert clusterer.fits == 1 and db.saved[0]["assignments"] == {1: 0, 2: 0}
+
+def test_nothing_new_to_assign():
+    clusterer = ScriptedClusterer(FakeDB(model_row()), [])
+    assert clusterer.run().empty and clusterer.fits == 0
@@ -0,0 +1,286 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+import db
+from db import ROLLUP_LLM_EVAL_SQL, ROLLUP_LLM_HISTOGRAM_SQL, SCHEMA_VERSION, DatabaseHandler
+
+class FakeResult:
+    def __init__(self, value):
+        self.value = value
+        self.rowcount = 0
+
+    def scalar(self):
+        return self.value
+
+    def scalars(self):
+        return iter(self.value or [])
+
+    def fetchall(self):
+        return self.value or []
+
+    def __iter__(self):
+        return iter(self.value or [])
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+        self.isolation_level = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execution_options(self, isolation_level=None):
+        self.isolation_level = isolation_level
+
+    def execute(self, statement, params=None):
+        sql = " ".join(str(statement).split())
+        self.engine.statements.append((sql, self.isolation_level))
+        for prefix, value in self.engine.answers.items():
+            if sql.startswith(prefix):
+                return FakeResult(value(sql, params) if callable(value) else value)
+        return FakeResult(None)
+
+    def commit(self):
+        pass
+
+class FakeEngine:
+    def __init__(self, answers):
+        self.answers = answers
+        self.statements = []
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def sql(self, prefix):
+        return [(sql, level) for sql, level in self.statements if sql.startswith(prefix)]
+
+def make_handler(monkeypatch, engine, migrate=None):
+    monkeypatch.setattr(db, "create_engine", lambda *args, **kwargs: engine)
+    monkeypatch.setattr(db, "_time_statements", lambda engine: None)
+    monkeypatch.setattr(DatabaseHandler, "_create_tables_if_not_exist", lambda self: engine.statements.append(("CREATE TABLES", None)))
+    return DatabaseHandler(migrate=migrate)
+
+def test_current_schema_runs_no_ddl(monkeypatch):
+    engine = FakeEngine({"SELECT to_regclass": True, "SELECT COALESCE(MAX(version)": SCHEMA_VERSION, "SELECT relkind": "r"})
+    make_handler(monkeypatch, engine)
+    assert not engine.sql("CREATE")
+    assert not engine.sql("SELECT pg_advisory_lock")
+
+def test_outdated_schema_refuses_to_start_without_migrate(monkeypatch):
+    engine = FakeEngine({"SELECT to_regclass": False})
+    with pytest.raises(RuntimeError, match="cli.py migrate"):
+        make_handler(monkeypatch, engine, migrate=False)
+    assert not engine.sql("CREATE")
+
+def test_migrate_builds_indexes_concurrently_outside_a_transaction(monkeypatch):
+    versions = iter([0, 0])
+    engine = FakeEngine({
+        "SELECT to_regclass": lambda sql, params: next(versions, SCHEMA_VERSION) != 0,
+        "SELECT relkind": lambda sql, params: "p" if params["name"] == "clusters" else "r",
+    })
+    handler = make_handler(monkeypatch, engine, migrate=True)
+    assert not handler.partitioned
+    indexes = engine.sql("CREATE INDEX") + engine.sql("CREATE UNIQUE INDEX")
+    assert len(indexes) == len(db.INDEXES)
+    assert all(level == "AUTOCOMMIT" for _, level in indexes)
+    for sql, _ in indexes:
+        assert ("CONCURRENTLY" in sql) != (" ON clusters " in sql)
+    assert engine.sql("INSERT INTO schema_version")
+    assert engine.sql("SELECT pg_advisory_unlock")
+
+def test_migrate_is_a_no_op_once_another_process_finished(monkeypatch):
+    # Behind at startup, but up to date once the advisory lock is ours.
+    versions = iter([False, True])
+    engine = FakeEngine({"SELECT to_regclass": lambda sql, params: next(versions), "SELECT COALESCE(MAX(version)": SCHEMA_VERSION, "SELECT relkind": "r"})
+    make_handler(monkeypatch, engine, migrate=True)
+    assert engine.sql("SELECT pg_advisory_lock")
+    assert not engine.sql("CREATE")
+    assert engine.sql("SELECT pg_advisory_unlock")
+
+def test_existing_partitions_are_not_recreated(monkeypatch):
+    engine = FakeEngine({
+        "SELECT to_regclass": True,
+        "SELECT COALESCE(MAX(version)": SCHEMA_VERSION,
+        "SELECT relkind": "p",
+        "SELECT relname FROM pg_class": lambda sql, params: [name for name in params["names"] if name.startswith("chatbot_responses_")],
+    })
+    monkeypatch.setattr(db.settings, "partition_months_ahead", 1)
+    make_handler(monkeypatch, engine)
+    created = engine.sql("CREATE TABLE IF NOT EXISTS")
+    assert created
+    assert not any("chatbot_responses_" in sql for sql, _ in created)
+    assert len(created) == 2 * len(db.DEPENDENT_TABLES)
+
+def engine_handler(engine, partitioned):
+    handler = DatabaseHandler.__new__(DatabaseHandler)
+    handler.engine, handler.partitioned, handler._partitions_checked = engine, partitioned, None
+    return handler
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2024, 6, 15)
+
+def test_partitions_cover_each_month_across_a_year_boundary():
+    engine = FakeEngine({})
+    engine_handler(engine, True).ensure_response_partitions(months_ahead=1, start=datetime(2024, 12, 5))
+    created = [sql for sql, _ in engine.sql("CREATE TABLE")]
+    assert len(created) == 2 * (1 + len(db.DEPENDENT_TABLES))
+    assert "CREATE TABLE IF NOT EXISTS chatbot_responses_y2024m12 PARTITION OF chatbot_responses FOR VALUES FROM ('2024-12-01') TO ('2025-01-01')" in created
+    assert "CREATE TABLE IF NOT EXISTS llm_eval_y2025m01 PARTITION OF llm_eval FOR VALUES FROM ('2025-01-01') TO ('2025-02-01')" in created
+
+def test_retention_drops_expired_months_dependents_first(monkeypatch):
+    monkeypatch.setattr(db, "datetime", FixedDatetime)
+    months = ["y2024m01", "y2024m02", "y2024m03", "y2024m06"]
+    engine = FakeEngine({"SELECT child.relname": lambda sql, params: [(f"{params['name']}_{month}",) for month in months]})
+    engine_handler(engine, True).apply_retention(months=3)
+    dropped = [sql.removeprefix("DROP TABLE ") for sql, _ in engine.sql("DROP TABLE")]
+    expected = [f"{table}_{month}" for month in ("y2024m01", "y2024m02") for table in [*db.DEPENDENT_TABLES, "chatbot_responses"]]
+    assert dropped == expected
+
+def test_retention_without_partitions_deletes_rows_before_the_cutoff(monkeypatch):
+    monkeypatch.setattr(db, "datetime", FixedDatetime)
+    cutoffs = []
+    engine = FakeEngine({"DELETE": lambda sql, params: cutoffs.append(params["cutoff"])})
+    engine_handler(engine, False).apply_retention(months=3)
+    tables = [sql.split()[2] for sql, _ in engine.sql("DELETE")]
+    assert tables == [*db.DEPENDENT_TABLES, "chatbot_responses"]
+    assert set(cutoffs) == {datetime(2024, 3, 1)}
+
+class FakeSession:
+    """Records each (sql, params) a DatabaseHandler method runs through Session(), and commits as ("COMMIT", None)."""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        sql = " ".join(str(statement).split())
+        self.handler.executed.append((sql, params))
+        for prefix, value in self.handler.answers.items():
+            if sql.startswith(prefix):
+                return FakeResult(value)
+        return FakeResult(None)
+
+    def commit(self):
+        self.handler.executed.append(("COMMIT", None))
+
+def session_handler(answers=None):
+    handler = DatabaseHandler.__new__(DatabaseHandler)
+    handler.executed, handler.answers = [], answers or {}
+    handler.Session = lambda: FakeSession(handler)
+    return handler
+
+def test_eval_rows_and_their_rollups_commit_together():
+    handler = session_handler()
+    handler.insert_llm_eval(7, 1, 2, 3, "fine")
+    statements = [sql for sql, _ in handler.executed]
+    assert statements[0].startswith("INSERT INTO llm_eval")
+    assert statements[1:] == [" ".join(ROLLUP_LLM_EVAL_SQL.split()), " ".join(ROLLUP_LLM_HISTOGRAM_SQL.split()), "COMMIT"]
+    assert all(params["response_id"] == 7 for _, params in handler.executed[:3])
+
+def test_rebuild_replaces_rollups_from_the_given_day():
+    handler = session_handler()
+    handler.rebuild_score_rollups(since="2024-03-01")
+    statements = [sql for sql, _ in handler.executed]
+    assert statements[:2] == ["DELETE FROM score_rollups WHERE day >= CAST(:since AS DATE)", "DELETE FROM score_histograms WHERE day >= CAST(:since AS DATE)"]
+    assert all("CAST(r.created_at AS DATE) >= CAST(:since AS DATE)" in sql for sql in statements[2:5])
+    assert statements[-1] == "COMMIT"
+
+def test_full_rebuild_has_no_day_filter():
+    handler = session_handler()
+    handler.rebuild_score_rollups()
+    statements = [sql for sql, _ in handler.executed]
+    assert statements[:2] == ["DELETE FROM score_rollups", "DELETE FROM score_histograms"]
+    assert not any(":since" in sql for sql in statements)
+
+def test_histogram_filters_by_metric_and_source():
+    handler = session_handler({"SELECT score, SUM(count)": [(0, 2), (2, 5)]})
+    assert handler.fetch_score_histogram("safety", source="redteam") == {0: 2, 2: 5}
+    sql, params = handler.executed[0]
+    assert "WHERE source = :source AND metric = :metric" in sql
+    assert params == {"source": "redteam", "metric": "safety"}
+
+def sqlite_handler(*statements):
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+    handler = DatabaseHandler.__new__(DatabaseHandler)
+    handler.engine, handler.Session = engine, sessionmaker(bind=engine)
+    return handler
+
+def test_pending_prompts_are_those_not_judged_under_the_fingerprint():
+    handler = sqlite_handler(
+        "CREATE TABLE prompts (id INTEGER PRIMARY KEY, source TEXT, text TEXT, canonical_id INTEGER)",
+        "CREATE TABLE chatbot_responses (id INTEGER PRIMARY KEY, prompt_id INTEGER, fingerprint TEXT)",
+        "CREATE TABLE llm_eval (id INTEGER PRIMARY KEY, response_id INTEGER)",
+        "INSERT INTO prompts VALUES (1, 'redteam', 'judged', NULL), (2, 'redteam', 'judged under old config', NULL), (3, 'redteam', 'answered, not judged', NULL), (4, 'redteam', 'duplicate', 1), (5, 'redteam', 'new', NULL), (6, 'dataset', 'other source', NULL)",
+        "INSERT INTO chatbot_responses VALUES (10, 1, 'current'), (11, 2, 'old'), (12, 3, 'current')",
+        "INSERT INTO llm_eval VALUES (100, 10), (101, 11)",
+    )
+    assert [row.id for row in handler.fetch_pending_prompts("redteam", 10, "current")] == [2, 3, 4, 5]
+    assert [row.id for row in handler.fetch_pending_prompts("redteam", 10, "current", canonical_only=True)] == [2, 3, 5]
+    assert [row.id for row in handler.fetch_pending_prompts("redteam", 2, "current")] == [2, 3]
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection, self.rowcount = connection, 0
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        if self.connection.fail_on and sql.startswith(self.connection.fail_on):
+            raise RuntimeError("statement failed")
+        self.connection.statements.append((sql, params))
+        if sql.startswith("INSERT INTO clusters"):
+            self.rowcount = len(self.connection.copied.splitlines())
+
+    def copy_expert(self, sql, rows):
+        self.connection.copied = rows.read()
+
+class RecordingRawConnection:
+    def __init__(self, fail_on=None):
+        self.fail_on, self.statements, self.copied, self.events = fail_on, [], "", []
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.events.append("commit")
+
+    def close(self):
+        self.events.append("close")
+
+def raw_handler(connection):
+    handler = DatabaseHandler.__new__(DatabaseHandler)
+    handler.engine = type("Engine", (), {"raw_connection": lambda self: connection})()
+    return handler
+
+def test_cluster_assignments_are_copied_once_per_response_and_upserted():
+    connection = RecordingRawConnection()
+    saved = raw_handler(connection).save_cluster_assignments(3, np.array([1, 2, 1]), np.array([5, 6, 7]), np.array([0.25, 0.5, 1.0]), model_version=9)
+    # The last assignment for a response wins, and numpy scalars are written as plain numbers.
+    assert connection.copied == "2,6,0.5\n1,7,1.0\n"
+    assert saved == 2
+    statements = [sql for sql, _ in connection.statements]
+    assert statements[0].startswith("CREATE TEMP TABLE cluster_assignments_stage") and statements[0].endswith("ON COMMIT DROP")
+    assert "ON CONFLICT (run_id, response_id, response_created_at) DO UPDATE" in statements[1]
+    assert connection.statements[1][1] == {"run_id": 3, "model_version": 9}
+    assert connection.statements[2][1] == {"n": 2, "run_id": 3}
+    assert connection.events == ["commit", "close"]
+
+def test_failed_save_still_releases_the_connection():
+    connection = RecordingRawConnection(fail_on="INSERT INTO clusters")
+    with pytest.raises(RuntimeError):
+        raw_handler(connection).save_cluster_assignments(3, [1], [5], [0.5])
+    assert connection.events == ["close"]
@@ -0,0 +1,43 @@
+from dedup import MinHasher, MinHashLSHIndex, prompt_hash
+
+def test_prompt_hash_ignores_case_and_whitespace():
+    assert prompt_hash("I feel  hopeless\ntoday") == prompt_hash("i feel hopeless today")
+    assert prompt_hash("I feel hopeless today") != prompt_hash("I feel hopeful today")
+
+def test_signature_is_deterministic():
+    hasher = MinHasher()
+    assert (hasher.signature("a short prompt") == MinHasher().signature("a short prompt")).all()
+
+def test_index_finds_near_duplicate_but_not_unrelated(tmp_path):
+    index = MinHashLSHIndex(str(tmp_path / "dedup.npz"), MinHasher(), threshold=0.6)
+    index.add(1, "I have been feeling really anxious about my exams lately and cannot sleep")
+    index.add(2, "What are some good breathing exercises for panic attacks?")
+    assert index.query("I have been feeling really anxious about my exams lately and can't sleep")[0] == 1
+    assert index.query("Recommend a vegetarian lasagna recipe for a family dinner") == (None, 0.0)
+
+def test_index_round_trips_through_disk(tmp_path):
+    path = str(tmp_path / "dedup" / "source.npz")
+    index = MinHashLSHIndex(path, MinHasher())
+    index.add(7, "how do I talk to my therapist about medication side effects")
+    index.save()
+    reloaded = MinHashLSHIndex(path, MinHasher())
+    assert reloaded.max_id == 7
+    assert reloaded.query("how do I talk to my therapist about medication side effects")[0] == 7
+
+def test_ingest_stores_prompt_text_as_written(tmp_path, monkeypatch):
+    import prompt_ingestor
+
+    class FakeDB:
+        def __init__(self):
+            self.rows = []
+
+        def insert_prompts(self, source, texts, text_hashes=None):
+            self.rows += list(zip(texts, text_hashes))
+            return list(range(len(self.rows) - len(texts), len(self.rows)))
+
+    monkeypatch.setattr(prompt_ingestor, "MCPClient", lambda: None)
+    path = tmp_path / "prompts.jsonl"
+    path.write_text('{"prompt": "Line one\\n\\n  indented   line"}\n{"prompt": "   "}\n')
+    db = FakeDB()
+    assert prompt_ingestor.PromptIngestor(db).ingest_from_file(str(path), "test", dedup=False) == 1
+    assert db.rows == [("Line one\n\n  indented   line", prompt_hash("line one indented line"))]
@@ -0,0 +1,57 @@
+import numpy as np
+from Tracker.cluster_engine import Embedder, embedding_model_key
+
+class RecordingModel:
+    """Stands in for the SentenceTransformer: a text's vector is [len(text), position in the batch it was given]."""
+
+    def __init__(self):
+        self.batches, self.pools = [], 0
+
+    def _encode(self, texts):
+        self.batches.append(list(texts))
+        return np.array([[len(text), position] for position, text in enumerate(texts)], dtype=np.float32)
+
+    def encode(self, texts, batch_size, normalize_embeddings, convert_to_numpy):
+        return self._encode(texts)
+
+    def start_multi_process_pool(self, devices):
+        self.pools += 1
+        return devices
+
+    def encode_multi_process(self, texts, pool, batch_size, normalize_embeddings):
+        return self._encode(texts)
+
+    def stop_multi_process_pool(self, pool):
+        self.pools -= 1
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+def make_embedder(processes=1, batch_size=2):
+    embedder = Embedder.__new__(Embedder)
+    embedder.model, embedder.batch_size, embedder.normalize, embedder.processes, embedder._pool = RecordingModel(), batch_size, False, processes, None
+    return embedder
+
+TEXTS = ["mid", "a", "longest text", "mid", "xy"]
+
+def test_texts_are_encoded_longest_first_and_returned_in_input_order():
+    embedder = make_embedder()
+    vectors = embedder.encode(TEXTS)
+    assert embedder.model.batches == [["longest text", "mid", "mid", "xy", "a"]]
+    assert vectors[:, 0].tolist() == [len(text) for text in TEXTS]
+    assert vectors[:, 1].tolist() == [1, 4, 0, 2, 3]
+
+def test_large_inputs_use_one_reusable_process_pool():
+    embedder = make_embedder(processes=2, batch_size=2)
+    assert embedder.encode(TEXTS)[:, 0].tolist() == [len(text) for text in TEXTS]
+    embedder.encode(TEXTS)
+    assert embedder.model.pools == 1
+    embedder.close()
+    assert embedder.model.pools == 0 and embedder._pool is None
+
+def test_empty_input_keeps_the_embedding_width():
+    assert make_embedder().encode([]).shape == (0, 2)
+
+def test_model_key_changes_with_backend_and_normalization():
+    assert embedding_model_key("m", "torch", False) == "m"
+    assert embedding_model_key("m", "onnx", True) == "m+onnx+norm"
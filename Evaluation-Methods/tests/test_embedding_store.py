@@ -0,0 +1,53 @@
+import numpy as np
+from Tracker.embedding_store import EmbeddingStore
+
+class FakeDB:
+    def __init__(self):
+        self.rows = {}
+
+    def fetch_embeddings(self, model_name, text_hashes):
+        return {h: self.rows[(model_name, h)] for h in text_hashes if (model_name, h) in self.rows}
+
+    def insert_embeddings(self, model_name, records):
+        for h, dim, blob in records:
+            self.rows[(model_name, h)] = (dim, blob)
+
+class FakeEmbedder:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded += texts
+        return [[len(text), 1 / 3, -2.5] for text in texts]
+
+def make(db, embedder, model_name="model"):
+    return EmbeddingStore(db, lambda: embedder, model_name)
+
+def test_vectors_round_trip_through_float16_blobs():
+    db, embedder = FakeDB(), FakeEmbedder()
+    first = make(db, embedder).get(["hi", "hello", "hi"])
+    again = make(db, FakeEmbedder()).get(["hello", "hi"])
+    assert first.dtype == np.float32 and first.shape == (3, 3)
+    assert np.array_equal(first[[1, 0]], again)
+    assert np.allclose(first[0], [2, 1 / 3, -2.5], atol=1e-3)
+    assert embedder.encoded == ["hi", "hello"]
+
+def test_fully_cached_run_never_builds_the_embedder():
+    db = FakeDB()
+    make(db, FakeEmbedder()).get(["a"])
+
+    def factory():
+        raise AssertionError("embedder should not be loaded")
+
+    store = EmbeddingStore(db, factory, "model")
+    assert store.get(["a"]).shape == (1, 3)
+    assert (store.hits, store.misses) == (1, 0)
+
+def test_models_do_not_share_vectors():
+    db, embedder = FakeDB(), FakeEmbedder()
+    make(db, embedder, "one").get(["a"])
+    make(db, embedder, "two").get(["a"])
+    assert embedder.encoded == ["a", "a"]
+
+def test_empty_input():
+    assert make(FakeDB(), FakeEmbedder()).get([]).shape == (0, 0)
@@ -0,0 +1,73 @@
+from evaluator import KeywordMatcher, LLMJudge, RuleEvaluator, parse_json_reply
+
+def test_keyword_matcher_counts_whole_words_and_phrases():
+    matcher = KeywordMatcher({"crisis": ["kill myself", "suicide"], "helpline": ["helpline"]})
+    hits = matcher.count("i want to kill   myself. suicide? call the helpline, not the suicidehelpline")
+    assert hits == {"crisis": 2, "helpline": 1}
+
+def test_keyword_matcher_prefers_longest_phrase():
+    matcher = KeywordMatcher({"crisis": ["kill myself"], "violence": ["kill"]})
+    assert matcher.count("i will kill myself") == {"crisis": 1}
+    assert matcher.count("don't kill the vibe") == {"violence": 1}
+
+def test_keyword_in_several_groups_counts_for_each():
+    matcher = KeywordMatcher({"a": ["Hopeless"], "b": ["hopeless"]})
+    assert matcher.count("feeling hopeless") == {"a": 1, "b": 1}
+
+def test_empty_matcher():
+    assert KeywordMatcher({}).count("anything") == {}
+
+def test_rule_evaluator_scores():
+    result = RuleEvaluator().evaluate("If you feel hopeless, please call a support line.")
+    assert result["crisis_detected"] and result["helpline_detected"]
+    assert result["toxicity_score"] == 1 / 9
+    assert RuleEvaluator().evaluate("") == {"crisis_detected": False, "helpline_detected": False, "toxicity_score": 0}
+
+def test_parse_plain_json():
+    assert parse_json_reply('{"safety": 1, "empathy": 2}') == {"safety": 1, "empathy": 2}
+
+def test_parse_fenced_json_with_prose():
+    reply = 'Here is my evaluation:\n```json\n{"safety": 1, "rationale": "ok"}\n```\nThanks!'
+    assert parse_json_reply(reply) == {"safety": 1, "rationale": "ok"}
+
+def test_parse_trailing_commas_and_surrounding_text():
+    assert parse_json_reply('Scores: {"safety": 0, "empathy": 1,} done') == {"safety": 0, "empathy": 1}
+
+def test_parse_list_for_batches():
+    assert parse_json_reply('[{"id": 1}, {"id": 2},]', expected=list) == [{"id": 1}, {"id": 2}]
+    assert parse_json_reply('{"id": 1}', expected=list) is None
+
+def test_unparseable_reply():
+    assert parse_json_reply("I cannot score this response.") is None
+
+class ScriptedBot:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    def get_response(self, prompt):
+        self.prompts.append(prompt)
+        return self.replies.pop(0)
+
+def test_judge_parse_failure_gives_none_scores():
+    judge = LLMJudge(ScriptedBot(["no json here"]))
+    assert judge.evaluate("p", "r") == {"safety_score": None, "empathy_score": None, "helpfulness_score": None, "rationale": "Parsing failed"}
+
+def test_batch_judge_rejudges_missing_items_alone():
+    bot = ScriptedBot([
+        '[{"id": 1, "safety": 1, "empathy": 2, "helpfulness": 3, "rationale": "a"}]',
+        '{"safety": 0, "empathy": 0, "helpfulness": 1, "rationale": "b"}',
+    ])
+    results = LLMJudge(bot).evaluate_batch([("p1", "r1"), ("p2", "r2")], batch_size=2, max_chars=10000)
+    assert [result["rationale"] for result in results] == ["a", "b"]
+    assert len(bot.prompts) == 2 and "Item 2" in bot.prompts[0] and "p2" in bot.prompts[1]
+
+def test_count_batch_keeps_texts_apart():
+    matcher = KeywordMatcher({"crisis": ["kill myself", "hopeless"]})
+    hits = matcher.count_batch(["i might kill", "myself. hopeless", "", "hopeless hopeless"])
+    assert hits == [{}, {"crisis": 1}, {}, {"crisis": 2}]
+
+def test_rule_evaluator_batch_matches_single():
+    texts = ["If you feel hopeless, please call a support line.", "All good here.", "", "SUICIDE hotline"]
+    evaluator = RuleEvaluator()
+    assert evaluator.evaluate_batch(texts) == [evaluator.evaluate(text) for text in texts]
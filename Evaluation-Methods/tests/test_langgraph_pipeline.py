@@ -0,0 +1,63 @@
+import pytest
+from langgraph_pipeline import GraphRouter, LangGraphRouter, route_after_llm_eval
+
+class ScriptedBot:
+    def __init__(self, replies):
+        self.replies = list(replies)
+
+    def get_response(self, prompt):
+        return self.replies.pop(0)
+
+@pytest.mark.parametrize("safety", [None, 0, "1", 1.0, True])
+def test_unsafe_or_unusable_safety_score_goes_to_review(safety):
+    assert route_after_llm_eval({"safety_score": safety}) == "clinician_review"
+
+def test_safe_score_continues():
+    assert route_after_llm_eval({"safety_score": 1}) == "persona_update"
+
+def test_unparseable_judge_reply_is_sent_to_clinician_review():
+    router = LangGraphRouter(None, ScriptedBot(["I'd rather not score this."]))
+    [state] = router.run_batch([{"prompt_text": "I feel low", "response_text": "That sounds hard. Want to talk about it?"}])
+    assert state["safety_score"] is None
+    assert state["route"] == ["input", "rule_eval", "llm_eval", "clinician_review", "output"]
+    assert state["failures"] == [("clinician_review", "LLM evaluation returned no usable safety score")]
+
+class CountingNode:
+    def __init__(self, name, calls):
+        self.name, self.calls = name, calls
+
+    def run_batch(self, states):
+        self.calls.append((self.name, len(states)))
+        for state in states:
+            state.setdefault("path", []).append(self.name)
+        return states
+
+def diamond(calls):
+    # input -> (odd|even) -> output
+    router = GraphRouter(None)
+    for name in ["input", "odd", "even", "output"]:
+        router.add_node(name, CountingNode(name, calls))
+    router.add_conditional_edge("input", lambda state: state["n"] % 2, {1: "odd", 0: "even"})
+    router.add_edge("odd", "output")
+    router.add_edge("even", "output")
+    return router
+
+def test_topological_order_puts_each_node_after_its_predecessors():
+    order = diamond([]).topological_order()
+    assert order[0] == "input" and order[-1] == "output"
+    assert sorted(order[1:3]) == ["even", "odd"]
+
+def test_run_batch_calls_each_node_once_and_keeps_input_order():
+    calls = []
+    results = diamond(calls).run_batch([{"n": n} for n in range(5)])
+    assert [state["n"] for state in results] == list(range(5))
+    assert [state["path"][1] for state in results] == ["even", "odd", "even", "odd", "even"]
+    assert sorted(calls) == [("even", 3), ("input", 5), ("odd", 2), ("output", 5)]
+
+def test_crisis_responses_skip_the_judge():
+    bot = ScriptedBot([])
+    router = LangGraphRouter(None, bot)
+    [state] = router.run_batch([{"prompt_text": "help", "response_text": "You sound hopeless."}])
+    assert state["route"] == ["input", "rule_eval", "safety_guardrail", "output"]
+    assert state["response_rewritten"] and state["failures"] == [("safety_guardrail", "Crisis detected")]
+    assert router.branch_counts[("rule_eval", "safety_guardrail")] == 1
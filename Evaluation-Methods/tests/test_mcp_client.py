@@ -0,0 +1,49 @@
+import time
+from mcp_client import MCPClient
+from settings import settings
+
+def test_cache_hit_skips_request(mcp_stub):
+    client = MCPClient(url=mcp_stub.url, timeout=2)
+    first = client.fetch("Coping with  Anxiety")
+    second = client.fetch("coping with anxiety")
+    assert first == second == {"query": "Coping with  Anxiety", "results": ["context for Coping with  Anxiety"]}
+    assert mcp_stub.queries == ["Coping with  Anxiety"]
+    assert client.stats()["hits"] == 1 and client.stats()["misses"] == 1
+
+def test_ttl_expiry_refetches(mcp_stub):
+    client = MCPClient(url=mcp_stub.url, timeout=2, cache_ttl=0.05)
+    client.fetch("sleep hygiene")
+    time.sleep(0.1)
+    client.fetch("sleep hygiene")
+    assert mcp_stub.queries == ["sleep hygiene", "sleep hygiene"]
+
+def test_lru_evicts_oldest(mcp_stub):
+    client = MCPClient(url=mcp_stub.url, timeout=2, cache_size=2)
+    for query in ("a", "b", "c", "a"):
+        client.fetch(query)
+    assert mcp_stub.queries == ["a", "b", "c", "a"]
+
+def test_timeout_returns_none_and_is_not_cached(mcp_stub):
+    mcp_stub.delay = 0.5
+    client = MCPClient(url=mcp_stub.url, timeout=0.1)
+    assert client.fetch("grief support") is None
+    assert client.stats()["errors"] == 1
+    mcp_stub.delay = 0.0
+    assert client.fetch("grief support") is not None
+    assert client.stats()["cached_queries"] == 1
+
+def test_http_error_returns_none(mcp_stub):
+    mcp_stub.status = 500
+    client = MCPClient(url=mcp_stub.url, timeout=2)
+    assert client.fetch("panic attacks") is None
+    assert client.stats()["errors"] == 1 and client.stats()["cached_queries"] == 0
+
+def test_fetch_many_dedups_and_keeps_order(mcp_stub):
+    client = MCPClient(url=mcp_stub.url, timeout=2)
+    results = client.fetch_many(["One", "two", "one ", "TWO"])
+    assert [result["query"] for result in results] == ["One", "two", "One", "two"]
+    assert sorted(mcp_stub.queries) == ["One", "two"]
+
+def test_no_url_skips_fetch(monkeypatch):
+    monkeypatch.setattr(settings, "mcp_url", None)
+    assert MCPClient(timeout=1).fetch("anything") is None
@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from db import DB_STATEMENT_SECONDS, _time_statements
+from metrics import MetricsRegistry
+
+def _statement_count(kind):
+    return sum(sample["count"] for sample in DB_STATEMENT_SECONDS.snapshot() if sample["labels"]["statement"] == kind)
+
+def test_failed_statement_does_not_skew_later_timings():
+    engine = create_engine("sqlite://")
+    _time_statements(engine)
+    before = _statement_count("SELECT")
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing_table"))
+        connection.execute(text("SELECT 1"))
+        assert "query_start" not in connection.info
+    assert _statement_count("SELECT") == before + 1
+
+def test_counter_renders_in_prometheus_text_format():
+    registry = MetricsRegistry()
+    calls = registry.counter("llm_calls_total", "LLM calls", ("provider", "outcome"))
+    calls.inc(provider="gemini", outcome="ok")
+    calls.inc(2, provider="gemini", outcome='bad "quote"\n')
+    assert registry.render_prometheus().splitlines() == [
+        "# HELP llm_calls_total LLM calls",
+        "# TYPE llm_calls_total counter",
+        'llm_calls_total{provider="gemini",outcome="bad \\"quote\\"\\n"} 2',
+        'llm_calls_total{provider="gemini",outcome="ok"} 1',
+    ]
+
+def test_histogram_buckets_are_cumulative_and_upper_inclusive():
+    registry = MetricsRegistry()
+    latency = registry.histogram("stage_seconds", "Stage time", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, stage="judge")
+    assert registry.render_prometheus().splitlines()[2:] == [
+        'stage_seconds_bucket{stage="judge",le="0.1"} 2',
+        'stage_seconds_bucket{stage="judge",le="1.0"} 3',
+        'stage_seconds_bucket{stage="judge",le="+Inf"} 4',
+        'stage_seconds_sum{stage="judge"} 3.65',
+        'stage_seconds_count{stage="judge"} 4',
+    ]
+
+def test_metrics_are_rendered_by_name_and_shared_by_name():
+    registry = MetricsRegistry()
+    registry.gauge("b_gauge", "B").set(3)
+    registry.counter("a_total", "A").inc()
+    assert registry.counter("a_total", "A") is registry.counter("a_total", "ignored")
+    with pytest.raises(ValueError):
+        registry.gauge("a_total", "A")
+    assert [line for line in registry.render_prometheus().splitlines() if not line.startswith("#")] == ["a_total 1", "b_gauge 3"]
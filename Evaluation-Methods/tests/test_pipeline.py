@@ -0,0 +1,48 @@
+from pipeline import Stage, StagedPipeline
+
+def test_items_flow_through_every_stage():
+    pipeline = StagedPipeline([
+        Stage("double", lambda item: item * 2, workers=3),
+        Stage("batch", lambda items: [item + 1 for item in items], workers=2, batch_size=4),
+        Stage("stringify", str, workers=2),
+    ])
+    assert sorted(pipeline.run(range(50)), key=int) == [str(i * 2 + 1) for i in range(50)]
+    assert pipeline.errors == 0
+
+def test_none_drops_item_without_error():
+    pipeline = StagedPipeline([Stage("odd", lambda item: item if item % 2 else None)])
+    assert sorted(pipeline.run(range(10))) == [1, 3, 5, 7, 9]
+    assert pipeline.errors == 0
+
+def test_exception_drops_only_failing_item():
+    def fn(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+    pipeline = StagedPipeline([Stage("fail", fn, workers=2)])
+    assert sorted(pipeline.run(range(6))) == [0, 1, 2, 4, 5]
+    assert pipeline.errors == 1
+
+def test_failed_batch_is_retried_item_by_item():
+    calls = []
+    def fn(items):
+        calls.append(list(items))
+        if 3 in items:
+            raise ValueError("bad batch")
+        return items
+    pipeline = StagedPipeline([Stage("batch", fn, batch_size=8)])
+    results = pipeline.run(range(6))
+    assert sorted(results) == [0, 1, 2, 4, 5]
+    assert pipeline.errors == 1
+    assert [3] in calls
+
+def test_stop_halts_feeding():
+    seen = []
+    pipeline = StagedPipeline([Stage("collect", lambda item: seen.append(item) or item)])
+    def items():
+        for i in range(1000):
+            if i == 5:
+                pipeline.stop()
+            yield i
+    pipeline.run(items())
+    assert len(seen) <= 5
@@ -0,0 +1,29 @@
+import io
+import pytest
+from prompt_ingestor import iter_json_array_prompts
+
+DOCUMENT = '[ "a", {"prompt": "b"}, {"text": "c"},\n 123456, "d, ]" ]'
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 13, 1 << 16])
+def test_elements_split_across_chunks_parse_the_same(chunk_size):
+    assert list(iter_json_array_prompts(io.StringIO(DOCUMENT), chunk_size=chunk_size)) == ["a", "b", "c", 123456, "d, ]"]
+
+def test_number_ending_at_a_chunk_edge_is_not_cut_short():
+    assert list(iter_json_array_prompts(io.StringIO("[123456]"), chunk_size=4)) == [123456]
+
+def test_empty_array():
+    assert list(iter_json_array_prompts(io.StringIO(" [ ] "), chunk_size=2)) == []
+
+def test_not_an_array_is_rejected():
+    with pytest.raises(ValueError, match="top-level JSON array"):
+        list(iter_json_array_prompts(io.StringIO('{"prompt": "a"}')))
+
+def test_malformed_element_is_rejected_after_the_good_ones():
+    prompts = iter_json_array_prompts(io.StringIO('["a", {oops}]'), chunk_size=4)
+    assert next(prompts) == "a"
+    with pytest.raises(ValueError, match="Malformed element"):
+        next(prompts)
+
+def test_truncated_array_is_rejected():
+    with pytest.raises(ValueError, match="Unexpected end"):
+        list(iter_json_array_prompts(io.StringIO('["a", "b"'), chunk_size=3))
@@ -0,0 +1,51 @@
+import itertools
+import response_cache
+from response_cache import ResponseCache
+
+def make(tmp_path, monkeypatch, **options):
+    clock = itertools.count(1)
+    monkeypatch.setattr(response_cache.time, "time", lambda: next(clock))
+    return ResponseCache(path=str(tmp_path / "cache.sqlite"), **options)
+
+def test_key_covers_every_input():
+    key = ResponseCache.make_key("model", "system", ["ctx"], "prompt")
+    assert key == ResponseCache.make_key("model", "system", ("ctx",), "prompt")
+    assert key != ResponseCache.make_key("other", "system", ["ctx"], "prompt")
+    assert key != ResponseCache.make_key("model", None, ["ctx"], "prompt")
+    assert key != ResponseCache.make_key("model", "system", [], "prompt")
+
+def test_least_recently_used_entries_are_evicted_to_ninety_percent(tmp_path, monkeypatch):
+    cache = make(tmp_path, monkeypatch, max_entries=10)
+    for i in range(10):
+        cache.put(f"k{i}", f"v{i}")
+    assert cache.get("k0") == "v0"
+    cache.put("k10", "v10")
+    # 11 entries > 10: evict the two least recently used, k1 and k2 (k0 was just read).
+    assert [cache.get(f"k{i}") for i in range(4)] == ["v0", None, None, "v3"]
+    assert cache.get("k10") == "v10"
+    cache.close()
+
+def test_overwrite_does_not_grow_the_cache(tmp_path, monkeypatch):
+    cache = make(tmp_path, monkeypatch, max_entries=2)
+    cache.put("k", "old")
+    cache.put("k", "new")
+    cache.put("j", "other")
+    assert (cache.get("k"), cache.get("j")) == ("new", "other")
+    cache.close()
+
+def test_bypass_misses_but_refreshes_entries(tmp_path, monkeypatch):
+    cache = make(tmp_path, monkeypatch, bypass=True)
+    cache.put("k", "fresh")
+    assert cache.get("k") is None
+    cache.bypass = False
+    assert cache.get("k") == "fresh"
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.close()
+
+def test_entries_persist_across_instances(tmp_path, monkeypatch):
+    cache = make(tmp_path, monkeypatch)
+    cache.put("k", "v")
+    cache.close()
+    reopened = make(tmp_path, monkeypatch)
+    assert reopened.get("k") == "v"
+    reopened.close()
@@ -0,0 +1,41 @@
+from sampling import METRICS, StratifiedSampler
+
+def population(n_per_stratum=200):
+    rows, prompt_id = [], 0
+    for source, cluster_id in (("redteam", 0), ("redteam", 1), ("chats", None)):
+        for i in range(n_per_stratum):
+            prompt_id += 1
+            rows.append((prompt_id, f"prompt {prompt_id}", source, cluster_id, i % 2, i % 4, (i + 1) % 4))
+    return rows
+
+def test_stratify_puts_unclustered_prompts_in_minus_one():
+    strata = StratifiedSampler.stratify(population(3))
+    assert set(strata) == {("redteam", 0), ("redteam", 1), ("chats", -1)}
+
+def test_plan_is_seeded_and_covers_every_stratum():
+    rows = population()
+    first = StratifiedSampler(margin=0.2, seed=3).plan(rows)
+    second = StratifiedSampler(margin=0.2, seed=3).plan(rows)
+    assert first == second
+    assert all(len(sample) >= 2 for sample in first.values())
+    assert sum(len(sample) for sample in first.values()) < len(rows)
+
+def test_tighter_margin_needs_more_samples():
+    rows = population()
+    loose = sum(len(sample) for sample in StratifiedSampler(margin=0.3).plan(rows).values())
+    tight = sum(len(sample) for sample in StratifiedSampler(margin=0.1).plan(rows).values())
+    assert tight > loose
+
+def test_plan_of_empty_population():
+    assert StratifiedSampler().plan([]) == {}
+
+def test_estimate_weights_strata_by_population():
+    sampler = StratifiedSampler(n_bootstrap=200)
+    estimates = sampler.estimate({"a": 300, "b": 100}, {"a": [(1, 3, 3)] * 5, "b": [(0, 1, 1)] * 5})
+    assert set(estimates) == set(METRICS)
+    assert estimates["safety_score"]["mean"] == 0.75
+    assert estimates["empathy_score"]["ci_low"] <= estimates["empathy_score"]["mean"] <= estimates["empathy_score"]["ci_high"]
+    assert estimates["helpfulness_score"]["n"] == 10
+
+def test_estimate_ignores_strata_without_scores():
+    assert StratifiedSampler().estimate({"a": 10}, {"a": []}) == {}
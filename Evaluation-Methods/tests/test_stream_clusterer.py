@@ -0,0 +1,109 @@
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+from Tracker.cluster_engine import ClusterEngine
+from Tracker.stream_clusterer import StreamClusterer
+
+def make(tmp_path, **kwargs):
+    options = dict(half_life=1, time_unit="hours", merge_threshold=0.9, macro_threshold=0.5, max_micro=10, min_weight=0.05)
+    options.update(kwargs)
+    return StreamClusterer(path=str(tmp_path / "stream.npz"), **options)
+
+def test_similar_responses_merge_and_distinct_ones_split(tmp_path):
+    stream = make(tmp_path)
+    stream.fold([[1, 0, 0], [0.99, 0.01, 0], [0, 1, 0]], [0, 0, 0], failed=[True, False, False], response_ids=[1, 2, 3])
+    assert len(stream.weights) == 2
+    assert stream.weights.tolist() == [2.0, 1.0]
+    assert stream.failure_weights.tolist() == [1.0, 0.0]
+    assert stream.folded_ids.tolist() == [1, 2, 3]
+
+def test_weights_halve_every_half_life(tmp_path):
+    stream = make(tmp_path)
+    stream.fold([[1, 0, 0]], [0])
+    weights, _ = stream.decayed_weights(now=2 * 3600)
+    assert weights[0] == 0.25
+
+def test_full_stream_replaces_weakest(tmp_path):
+    stream = make(tmp_path, max_micro=2)
+    stream.fold([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [0, 3600, 7200])
+    assert len(stream.weights) == 2
+    assert stream.created.tolist() == [7200, 3600]
+
+def test_macro_clusters_link_close_micro_clusters(tmp_path):
+    stream = make(tmp_path)
+    stream.fold([[1, 0, 0], [0.8, 0.6, 0], [0, 0, 1]], [0, 0, 0], failed=[True, True, False])
+    macros = stream.macro_clusters(now=0)
+    assert [sorted(macro["micro_clusters"]) for macro in macros] == [[0, 1], [2]]
+    assert macros[0]["failure_rate"] == 1.0 and macros[1]["failure_rate"] == 0.0
+
+def test_faded_micro_clusters_are_left_out(tmp_path):
+    stream = make(tmp_path)
+    stream.fold([[1, 0, 0]], [0])
+    assert stream.macro_clusters(now=10 * 3600) == []
+
+def test_save_and_reload(tmp_path):
+    stream = make(tmp_path)
+    stream.fold(np.eye(3), [0, 0, 0], response_ids=[4, 5, 6])
+    stream.advance(5)
+    stream.save()
+    reloaded = make(tmp_path)
+    assert reloaded.last_response_id == 5
+    assert reloaded.folded_ids.tolist() == [6]
+    assert np.allclose(reloaded.centroids, stream.centroids)
+
+def test_locked_folds_from_two_processes_are_both_kept(tmp_path):
+    first, second = make(tmp_path), make(tmp_path)
+    with first.locked():
+        first.fold([[1, 0, 0]], [0], response_ids=[1])
+    with second.locked():
+        second.fold([[0, 1, 0]], [0], response_ids=[2])
+    assert make(tmp_path).folded_ids.tolist() == [1, 2]
+    assert len(make(tmp_path).weights) == 2
+
+Row = namedtuple("Row", "id text created_at failed")
+
+class FakeDB:
+    """Responses 1-4 are committed, 3 only on the second pass: its insert
+    transaction was still open while 4 was already visible."""
+
+    def __init__(self):
+        self.rows = {1: Row(1, "a", datetime(2024, 1, 1), False), 2: Row(2, "b", datetime(2024, 1, 2), True), 4: Row(4, "d", datetime(2024, 1, 4), False)}
+        self.settled = 2
+
+    def fetch_settled_response_id(self, after_id):
+        return max(after_id, self.settled)
+
+    def fetch_responses_after(self, after_id, limit=None, exclude_ids=None, since=None):
+        rows = [row for response_id, row in sorted(self.rows.items()) if response_id > after_id and response_id not in set(exclude_ids) and (since is None or row.created_at >= since)]
+        return rows[:limit] if limit else rows
+
+class FakeEmbeddingStore:
+    def get(self, texts):
+        return [[1.0, float(ord(text[0]) - ord("a")), 0.0] for text in texts]
+
+def make_engine(tmp_path, db):
+    engine = ClusterEngine.__new__(ClusterEngine)
+    engine.db_handler, engine.embedding_store, engine._stream = db, FakeEmbeddingStore(), make(tmp_path)
+    return engine
+
+def test_late_commit_below_the_high_water_mark_is_still_folded(tmp_path):
+    db = FakeDB()
+    engine = make_engine(tmp_path, db)
+    engine.cluster_stream()
+    assert (engine.stream.last_response_id, engine.stream.folded_ids.tolist()) == (2, [4])
+    db.rows[3], db.settled = Row(3, "c", datetime(2024, 1, 3), False), 4
+    engine.cluster_stream()
+    assert (engine.stream.last_response_id, engine.stream.folded_ids.tolist()) == (4, [])
+    assert engine.stream.weights.sum() == 4
+
+def test_stream_uses_response_timestamps_and_honours_limit_and_since(tmp_path):
+    db = FakeDB()
+    db.settled = 4
+    engine = make_engine(tmp_path, db)
+    engine.cluster_stream(limit=1, since=datetime(2024, 1, 2))
+    assert engine.stream.created.tolist() == [datetime(2024, 1, 2).timestamp()]
+    # A full page only vouches for ids up to its last row.
+    assert engine.stream.last_response_id == 2
+    engine.cluster_stream(limit=1, since=datetime(2024, 1, 2))
+    assert engine.stream.last_response_id == 4
+    assert engine.stream.weights.sum() == 2
@@ -0,0 +1,73 @@
+import threading
+import pytest
+
+pytest.importorskip("google.generativeai")
+import test_manager
+from budget import BudgetExceeded
+
+JUDGE_REPLY = '{"safety": 1, "empathy": 2, "helpfulness": 2, "rationale": "ok"}'
+
+class FakeDB:
+    def __init__(self, rubrics, prompts):
+        self.rubrics, self.prompts = rubrics, prompts
+        self.results = []
+
+    def fetch_test_rubrics(self, test_ids):
+        return {test_id: self.rubrics[test_id] for test_id in test_ids if test_id in self.rubrics}
+
+    def fetch_unscored_prompts_for_tests(self, test_id, prompt_ids):
+        return [(prompt_id, text) for prompt_id, text in self.prompts if prompt_id in prompt_ids]
+
+    def insert_test_results(self, records):
+        self.results += records
+
+class FakeIngestor:
+    class mcp_client:
+        @staticmethod
+        def stats():
+            return {}
+
+    def __init__(self):
+        self.queries = []
+
+    def fetch_web_context_batch(self, queries, max_workers=None):
+        queries = list(queries)
+        self.queries += queries
+        return [[f"context for {query}"] for query in queries]
+
+class FakeBot:
+    def __init__(self, budget_after=None):
+        self.budget_after = budget_after
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_response(self, prompt):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+        if self.budget_after is not None and calls > self.budget_after:
+            raise BudgetExceeded("run budget spent")
+        return JUDGE_REPLY
+
+def make_manager(db, bot):
+    manager = test_manager.TestManager.__new__(test_manager.TestManager)
+    manager.db_handler, manager.prompt_ingestor = db, FakeIngestor()
+    manager.llm_judge = test_manager.LLMJudge(bot, stage_name="psych_test")
+    return manager
+
+def test_matrix_scores_every_pair_and_fetches_context_once_per_prompt():
+    db = FakeDB({1: "rubric one", 2: "rubric two"}, [(10, "a"), (11, "b")])
+    manager = make_manager(db, FakeBot())
+    manager.run_test_matrix([1, 2, 3], [10, 11], concurrency=2)
+    assert sorted((test_id, prompt_id) for test_id, prompt_id, _, _ in db.results) == [(1, 10), (1, 11), (2, 10), (2, 11)]
+    assert {score for _, _, score, _ in db.results} == {2}
+    assert sorted(manager.prompt_ingestor.queries) == ["a", "b"]
+
+def test_budget_exhaustion_cancels_queued_pairs_and_keeps_finished_ones():
+    db = FakeDB({1: "rubric"}, [(prompt_id, f"p{prompt_id}") for prompt_id in range(20)])
+    bot = FakeBot(budget_after=1)
+    manager = make_manager(db, bot)
+    manager.run_test_matrix([1], list(range(20)), concurrency=1)
+    assert len(db.results) == 1
+    # Only a pair already picked up by the worker can run after the cancel.
+    assert bot.calls <= 3
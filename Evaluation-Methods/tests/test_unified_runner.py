@@ -0,0 +1,88 @@
+import itertools
+from datetime import datetime
+from budget import BudgetTracker
+from unified_runner import UnifiedRunner
+
+JUDGE_REPLY = '{"safety": 1, "empathy": 2, "helpfulness": 2, "rationale": "ok"}'
+
+class FakeDB:
+    def __init__(self):
+        self.runs = {}
+        self.responses = []
+        self.failures = []
+        self.llm_evals = []
+        self._ids = itertools.count(1)
+
+    def start_eval_run(self, fingerprint, source, params):
+        run_id = len(self.runs) + 1
+        self.runs[run_id] = {"source": source, "params": params, "status": None}
+        return run_id
+
+    def finish_eval_run(self, run_id, status, prompts_processed, prompts_failed, usage=None):
+        self.runs[run_id].update(status=status, processed=prompts_processed, failed=prompts_failed)
+
+    def insert_responses(self, records, model_version=None, run_id=None, fingerprint=None):
+        ids = [next(self._ids) for _ in records]
+        self.responses += [(response_id, run_id, model_version) + tuple(record) for response_id, record in zip(ids, records)]
+        return [(response_id, datetime(2024, 1, 1)) for response_id in ids]
+
+    def insert_failures(self, records):
+        self.failures += records
+
+    def insert_rule_eval(self, response_id, **scores):
+        pass
+
+    def insert_llm_eval(self, response_id, **scores):
+        self.llm_evals.append((response_id, scores))
+
+    def insert_token_usage(self, records):
+        pass
+
+class FakeBot:
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+
+    def get_response(self, prompt_text, system_prompt=None, with_model=False):
+        if prompt_text in self.fail_on:
+            raise ConnectionError("Failed to get response from Gemini API.")
+        text = JUDGE_REPLY if "expert evaluator" in prompt_text else f"reply to {prompt_text}"
+        return (text, "gemini-test") if with_model else text
+
+def make_runner(bot=None):
+    runner = UnifiedRunner()
+    runner.__dict__.update(db_handler=FakeDB(), bot_api=bot or FakeBot(), budget=BudgetTracker(run_budget=0, daily_budget=0))
+    return runner
+
+def test_run_pipeline_opens_and_closes_one_run():
+    runner = make_runner(FakeBot(fail_on={"p2"}))
+    results = runner._run_pipeline([(1, "p1"), (2, "p2"), (3, "p3")], source="unit")
+    assert sorted(state["prompt_id"] for state in results) == [1, 3]
+    assert runner.db_handler.runs[1]["status"] == "finished"
+    assert (runner.db_handler.runs[1]["processed"], runner.db_handler.runs[1]["failed"]) == (2, 1)
+    assert {row[1] for row in runner.db_handler.responses} == {1}
+
+def test_batches_accumulate_into_the_open_run():
+    runner = make_runner()
+    runner.start_run(source="queue")
+    runner.process_prompts([(1, "p1")])
+    runner.process_prompts([(2, "p2"), (3, "p3")])
+    runner.finish_run()
+    assert list(runner.db_handler.runs) == [1]
+    assert runner.db_handler.runs[1]["processed"] == 3
+
+def test_spent_budget_skips_the_pipeline():
+    runner = make_runner(FakeBot(fail_on={"p1"}))
+    runner.budget = BudgetTracker(run_budget=1.0, daily_budget=0)
+    runner.start_run(source="queue")
+    runner.budget.exceeded = True
+    assert runner.process_prompts([(1, "p1")]) == []
+    runner.finish_run()
+    assert runner.db_handler.runs[1]["status"] == "budget_exceeded" and runner.db_handler.runs[1]["failed"] == 0
+
+def test_config_fingerprint_needs_no_chat_client(monkeypatch):
+    runner = UnifiedRunner()
+    fingerprint = runner.config_fingerprint()
+    assert "bot_api" not in runner.__dict__ and "evaluator" not in runner.__dict__
+    assert runner.config_fingerprint("gemini-other") != fingerprint
+    monkeypatch.setattr(runner.settings, "system_prompt", "Be brief.")
+    assert runner.config_fingerprint() != fingerprint
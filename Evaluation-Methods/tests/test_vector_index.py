@@ -0,0 +1,97 @@
+from collections import namedtuple
+import numpy as np
+from Tracker.cluster_engine import ClusterEngine
+from Tracker.vector_index import IVFIndex
+
+def clustered_vectors(n=3000, dim=32, centers=30, seed=0):
+    rng = np.random.default_rng(seed)
+    means = rng.normal(size=(centers, dim))
+    return means[rng.integers(0, centers, n)] + 0.2 * rng.normal(size=(n, dim))
+
+def brute_force(vectors, query, k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(unit @ (query / np.linalg.norm(query))))[:k] + 1)
+
+def test_small_index_is_exact(tmp_path):
+    vectors = clustered_vectors(n=200)
+    index = IVFIndex(str(tmp_path / "index.npz"), "model", min_train=1000)
+    index.add(np.arange(1, 201), vectors)
+    assert index.centroids is None
+    assert [hit for hit, _ in index.search(vectors[10], k=5)] == brute_force(vectors, vectors[10], 5)
+
+def test_trained_index_has_high_recall(tmp_path):
+    vectors = clustered_vectors()
+    index = IVFIndex(str(tmp_path / "index.npz"), "model", nlist=30, nprobe=4, min_train=1000)
+    for start in range(0, len(vectors), 500):
+        index.add(np.arange(start + 1, start + 501), vectors[start:start + 500])
+    assert index.centroids is not None and len(index) == len(vectors)
+    recall = np.mean([len({hit for hit, _ in index.search(vectors[q], k=10)} & set(brute_force(vectors, vectors[q], 10))) / 10 for q in range(0, 3000, 100)])
+    assert recall >= 0.9
+
+def test_exclude_and_scores_sorted(tmp_path):
+    vectors = clustered_vectors(n=50)
+    index = IVFIndex(str(tmp_path / "index.npz"), "model")
+    index.add(np.arange(1, 51), vectors)
+    hits = index.search(vectors[0], k=5, exclude=(1,))
+    assert 1 not in [hit for hit, _ in hits]
+    assert [score for _, score in hits] == sorted((score for _, score in hits), reverse=True)
+
+def test_nlist_larger_than_index_is_capped(tmp_path):
+    index = IVFIndex(str(tmp_path / "index.npz"), "model", nlist=4096, min_train=5)
+    index.train()
+    assert index.search(np.ones(8), k=3) == []
+    index.add(np.arange(1, 8), clustered_vectors(n=7, dim=8))
+    assert len(index.centroids) == 7
+    assert len(index.search(np.ones(8), k=3)) == 3
+
+def test_round_trip_and_model_mismatch(tmp_path):
+    path = str(tmp_path / "index.npz")
+    vectors = clustered_vectors(n=1500)
+    index = IVFIndex(path, "model", nlist=10, min_train=1000)
+    index.add(np.arange(1, 1501), vectors)
+    index.advance(1500)
+    index.save()
+    reloaded = IVFIndex(path, "model")
+    assert len(reloaded) == 1500 and reloaded.last_response_id == 1500
+    assert reloaded.search(vectors[3], k=3) == index.search(vectors[3], k=3)
+    assert len(IVFIndex(path, "other-model")) == 0
+
+def test_locked_adds_from_two_processes_are_both_kept(tmp_path):
+    path = str(tmp_path / "index.npz")
+    first, second = IVFIndex(path, "model"), IVFIndex(path, "model")
+    with first.locked():
+        first.add([1], np.eye(4)[:1])
+    with second.locked():
+        second.add([2], np.eye(4)[1:2])
+    assert sorted(IVFIndex(path, "model")._all()[0].tolist()) == [1, 2]
+
+Row = namedtuple("Row", "id text")
+
+class FakeDB:
+    # Response 2's insert commits only after 3 is visible and indexed.
+    def __init__(self):
+        self.rows = {1: Row(1, "a"), 3: Row(3, "c")}
+        self.settled = 1
+
+    def fetch_settled_response_id(self, after_id):
+        return max(after_id, self.settled)
+
+    def fetch_responses_after(self, after_id, limit=None, exclude_ids=None):
+        rows = [row for response_id, row in sorted(self.rows.items()) if response_id > after_id and response_id not in set(exclude_ids.tolist())]
+        return rows[:limit] if limit else rows
+
+class FakeEmbeddingStore:
+    def get(self, texts):
+        return [np.eye(4)[ord(text) - ord("a")] for text in texts]
+
+def test_sync_picks_up_a_late_commit_below_the_highest_id(tmp_path):
+    db = FakeDB()
+    engine = ClusterEngine.__new__(ClusterEngine)
+    engine.db_handler, engine.embedding_store = db, FakeEmbeddingStore()
+    engine._vector_index = IVFIndex(str(tmp_path / "index.npz"), "model")
+    engine.sync_vector_index(limit=1)
+    assert engine.vector_index.last_response_id == 1
+    db.rows[2], db.settled = Row(2, "b"), 3
+    engine.sync_vector_index(limit=1)
+    assert sorted(engine.vector_index._all()[0].tolist()) == [1, 2, 3]
+    assert engine.vector_index.last_response_id == 3
@@ -0,0 +1,87 @@
+import pytest
+from worker import EvalWorker
+
+class FakeDB:
+    def __init__(self, batches=()):
+        self.completed, self.failed, self.released = [], [], []
+        self.batches = list(batches)
+
+    def ensure_current_partitions(self):
+        pass
+
+    def claim_jobs(self, worker_id, batch_size, lease_seconds, max_attempts):
+        return self.batches.pop(0) if self.batches else []
+
+    def complete_jobs(self, worker_id, job_ids):
+        self.completed += job_ids
+
+    def fail_jobs(self, worker_id, job_ids, error, max_attempts):
+        self.failed += job_ids
+
+    def release_jobs(self, worker_id, job_ids):
+        self.released += job_ids
+
+    def renew_job_leases(self, worker_id, job_ids, lease_seconds):
+        return set(job_ids)
+
+class FakeBudget:
+    exceeded = False
+
+class FakeRunner:
+    def __init__(self, drop=(), error=None, batches=()):
+        self.db_handler = FakeDB(batches)
+        self.budget = FakeBudget()
+        self.drop = set(drop)
+        self.error = error
+        self.runs = []
+        self.run_id = None
+
+    def start_run(self, source=None, params=None, concurrency=1):
+        self.run_id = len(self.runs) + 1
+        self.runs.append({"source": source, "batches": 0, "status": "open"})
+        return self.run_id
+
+    def finish_run(self, status=None):
+        self.runs[-1]["status"] = status or "finished"
+
+    def process_prompts(self, prompts, concurrency=1):
+        if self.runs:
+            self.runs[-1]["batches"] += 1
+        if self.error:
+            raise self.error
+        return [{"prompt_id": prompt_id} for prompt_id, _ in prompts if prompt_id not in self.drop]
+
+JOBS = [(1, 10, "a"), (2, 11, "b"), (3, 10, "a"), (4, 12, "c")]
+
+def test_completed_and_dropped_prompts_settle_their_jobs():
+    runner = FakeRunner(drop={11})
+    worker = EvalWorker(runner, worker_id="w1")
+    worker.run_batch(JOBS)
+    assert sorted(runner.db_handler.completed) == [1, 3, 4]
+    assert runner.db_handler.failed == [2]
+    assert (worker.processed, worker.failed) == (3, 1)
+
+def test_pipeline_crash_fails_the_whole_batch():
+    runner = FakeRunner(error=RuntimeError("db down"))
+    worker = EvalWorker(runner, worker_id="w1")
+    with pytest.raises(RuntimeError):
+        worker.run_batch(JOBS)
+    assert sorted(runner.db_handler.failed) == [1, 2, 3, 4]
+    assert worker.failed == 4
+
+def test_worker_keeps_one_run_across_batches():
+    runner = FakeRunner(batches=[JOBS[:2], JOBS[2:]])
+    EvalWorker(runner, worker_id="w1").run(exit_when_idle=True)
+    assert runner.runs == [{"source": "queue", "batches": 2, "status": "finished"}]
+    assert sorted(runner.db_handler.completed) == [1, 2, 3, 4]
+
+def test_budget_exhaustion_releases_jobs_and_stops_the_worker():
+    runner = FakeRunner(drop={11, 12}, batches=[JOBS, [(5, 13, "d")]])
+    runner.budget.exceeded = True
+    worker = EvalWorker(runner, worker_id="w1")
+    worker.run()
+    assert sorted(runner.db_handler.completed) == [1, 3]
+    assert sorted(runner.db_handler.released) == [2, 4]
+    assert runner.db_handler.failed == [] and worker.failed == 0
+    assert runner.db_handler.batches == [[(5, 13, "d")]]
+    assert runner.runs[-1]["status"] == "finished"
@@ -1,56 +1,266 @@
+import hashlib
+import json
 import logging
-from db import DatabaseHandler
-from bot_api import ChatbotAPI
-from prompt_ingestor import PromptIngestor
-from evaluator import Evaluator
-from langgraph_pipeline import LangGraphRouter
-from cluster_engine import ClusterEngine
-from test_manager import TestManager
-from visualizer import Visualizer
+import os
+from collections import defaultdict
+from functools import cached_property
+from pipeline import StagedPipeline, Stage
+from sampling import METRICS, StratifiedSampler
 from settings import Settings
+from metrics import registry
+from budget import BudgetTracker, stage
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PROMPTS_PROCESSED = registry.counter("eval_prompts_processed_total", "Prompts generated, judged and persisted")
+
 class UnifiedRunner:
+    # Components are built on first use, and their modules imported there too, so
+    # a subcommand only pays for (and only needs credentials for) what it touches:
+    # `ingest` never loads the Gemini client, `report` never loads an embedding model.
+
     def __init__(self):
         self.settings = Settings()
-        self.db_handler = DatabaseHandler()
-        self.bot_api = ChatbotAPI()
-        self.prompt_ingestor = PromptIngestor(self.db_handler)
-        self.evaluator = Evaluator(self.db_handler, self.bot_api)
-        self.router = LangGraphRouter(self.db_handler, self.bot_api)
-        self.cluster_engine = ClusterEngine(self.db_handler)
-        self.test_manager = TestManager(self.db_handler, self.bot_api)
-        self.visualizer = Visualizer()
+        self.run_id = None
+
+    @cached_property
+    def db_handler(self):
+        from db import DatabaseHandler
+        return DatabaseHandler()
+
+    @cached_property
+    def budget(self):
+        return BudgetTracker(self.db_handler)
+
+    @cached_property
+    def bot_api(self):
+        from bot_api import ChatbotAPI
+        return ChatbotAPI(budget=self.budget)
+
+    @cached_property
+    def prompt_ingestor(self):
+        from prompt_ingestor import PromptIngestor
+        return PromptIngestor(self.db_handler)
+
+    @cached_property
+    def evaluator(self):
+        from evaluator import Evaluator
+        return Evaluator(self.db_handler, self.bot_api)
+
+    @cached_property
+    def router(self):
+        from langgraph_pipeline import LangGraphRouter
+        return LangGraphRouter(self.db_handler, self.bot_api)
+
+    @cached_property
+    def cluster_engine(self):
+        from Tracker.cluster_engine import ClusterEngine
+        return ClusterEngine(self.db_handler)
+
+    @cached_property
+    def test_manager(self):
+        from test_manager import TestManager
+        return TestManager(self.db_handler, self.bot_api)
+
+    @cached_property
+    def visualizer(self):
+        from visualizer import Visualizer
+        return Visualizer()
 
     def ingest_and_run_redteam(self, redteam_source_paths):
         for path in redteam_source_paths:
             self.prompt_ingestor.ingest_from_file(path, 'redteam')
         self.run_evaluation_cycle('redteam', 100)
 
-    def run_evaluation_cycle(self, source, limit):
-        prompts = self.db_handler.fetch_prompts(source, limit)
-        for prompt_id, prompt_text in prompts:
-            response_text = self.bot_api.get_response(prompt_text)
-            response_id = self.db_handler.insert_response(prompt_id, response_text)
-            
-            initial_state = {"prompt_id": prompt_id, "prompt_text": prompt_text, "response_id": response_id, "response_text": response_text}
-            final_state = self.router.run(initial_state)
-            
-            self.evaluator.evaluate_response(prompt_id, prompt_text, response_id, final_state['response_text'])
-            logger.info(f"Processed and evaluated prompt {prompt_id}")
-
-    def cluster_and_analyze(self, time_window=None, limit=1000, method='auto'):
-        df_clustered = self.cluster_engine.cluster_and_save(time_window, limit, method)
+    def config_fingerprint(self, model_name=None):
+        # Identifies the bot + judge configuration; a response judged under the same
+        # fingerprint never needs to be regenerated. The judge templates are hashed
+        # as module constants, so `enqueue` needs no Gemini client or API key.
+        from evaluator import BATCH_ITEM_TEMPLATE, BATCH_PROMPT_TEMPLATE, JUDGE_PROMPT_TEMPLATE
+        payload = json.dumps([model_name or self.settings.gemini_model, self.settings.system_prompt or "", JUDGE_PROMPT_TEMPLATE, BATCH_PROMPT_TEMPLATE, BATCH_ITEM_TEMPLATE])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def run_evaluation_cycle(self, source, limit, concurrency=1, canonical_only=False, force=False):
+        # fetch -> generate -> route/guardrail -> evaluate -> persist, each stage with
+        # its own pool of `concurrency` workers and bounded queues between them.
+        # Unless `force` is set, prompts already judged under the current
+        # configuration are skipped, so an interrupted cycle can simply be rerun.
+        if force:
+            prompts = self.db_handler.fetch_prompts(source, limit, canonical_only=canonical_only)
+        else:
+            prompts = self.db_handler.fetch_pending_prompts(source, limit, self.config_fingerprint(), canonical_only=canonical_only)
+        return self._run_pipeline(prompts, concurrency, source=source, params={"limit": limit, "canonical_only": canonical_only, "force": force})
+
+    def _run_pipeline(self, prompts, concurrency=1, source=None, params=None):
+        self.start_run(source, params, concurrency)
+        try:
+            results = self.process_prompts(prompts, concurrency)
+        except BaseException:
+            self.finish_run("aborted")
+            raise
+        self.finish_run()
+        return results
+
+    def start_run(self, source=None, params=None, concurrency=1):
+        # Opens an eval_runs row and its budget scope. process_prompts adds to the
+        # run until finish_run closes it, so a queue worker keeps one run (and one
+        # per-run budget) for its whole lifetime rather than one per batch.
+        self.run_id = self.db_handler.start_eval_run(self.config_fingerprint(), source, dict(params or {}, concurrency=concurrency))
+        self.budget.start_run(self.run_id)
+        self.run_processed, self.run_errors = 0, 0
+        return self.run_id
+
+    def process_prompts(self, prompts, concurrency=1):
+        # Runs (prompt_id, prompt_text) pairs through the pipeline under the open
+        # run and returns the states that were persisted.
+        if self.budget.exceeded:
+            logger.warning(f"Evaluation run {self.run_id}: LLM budget exhausted; not starting {len(prompts)} prompts.")
+            return []
+        pipeline = StagedPipeline([
+            Stage("generate", self._generate_stage, concurrency),
+            Stage("route", self._route_stage, concurrency, batch_size=self.settings.judge_batch_size),
+            Stage("evaluate", self._evaluate_stage, concurrency),
+            Stage("persist", self._persist_stage, concurrency),
+        ])
+        # Out of budget: stop feeding prompts and let in-flight ones drain. Every
+        # persisted prompt is already a checkpoint, since reruns skip them.
+        self.budget.on_exceeded = pipeline.stop
+        try:
+            results = pipeline.run({"prompt_id": prompt_id, "prompt_text": prompt_text} for prompt_id, prompt_text in prompts)
+        finally:
+            self.budget.on_exceeded = None
+            self.run_processed += len(pipeline.results)
+            self.run_errors += pipeline.errors
+            self.budget.flush()
+        return results
+
+    def finish_run(self, status=None):
+        self.budget.flush()
+        usage = self.budget.summary()
+        status = status or ("budget_exceeded" if self.budget.exceeded else "finished")
+        self.db_handler.finish_eval_run(self.run_id, status, self.run_processed, self.run_errors, usage)
+        logger.info(f"Evaluation run {self.run_id} {status}: {self.run_processed} prompts processed, {self.run_errors} failed, {usage['prompt_tokens'] + usage['completion_tokens']} tokens (${usage['cost_usd']:.4f}).")
+        if "router" in self.__dict__:
+            self.router.log_timing_summary()
+
+    def run_sampled_evaluation(self, sources, margin=0.1, confidence=0.95, seed=0, concurrency=1, canonical_only=False):
+        # Evaluates a stratified random sample instead of the first N prompts and
+        # reports stratified means with bootstrap confidence intervals.
+        population = self.db_handler.fetch_prompt_strata(sources, canonical_only=canonical_only)
+        sampler = StratifiedSampler(margin=margin, confidence=confidence, seed=seed)
+        sample = sampler.plan(population)
+        stratum_of = {row[0]: key for key, rows in sample.items() for row in rows}
+        results = self._run_pipeline([(row[0], row[1]) for rows in sample.values() for row in rows], concurrency, source=",".join(sources), params={"sample": True, "margin": margin, "confidence": confidence, "seed": seed})
+
+        # Judge replies that failed to parse carry None scores and are left out.
+        stratum_scores = defaultdict(list)
+        for state in results:
+            scores = tuple(state["llm_eval"].get(metric) for metric in METRICS)
+            if None not in scores:
+                stratum_scores[stratum_of[state["prompt_id"]]].append(scores)
+        stratum_sizes = {key: len(rows) for key, rows in sampler.stratify(population).items()}
+        estimates = sampler.estimate(stratum_sizes, stratum_scores)
+        for metric, estimate in estimates.items():
+            logger.info(f"{metric}: {estimate['mean']:.3f} [{estimate['ci_low']:.3f}, {estimate['ci_high']:.3f}] ({confidence:.0%} CI, n={estimate['n']})")
+
+        report_path = os.path.join(self.settings.output_dir, "sample_estimate.json")
+        with open(report_path, "w") as f:
+            json.dump({"sources": list(sources), "margin": margin, "confidence": confidence, "seed": seed, "population": len(population), "strata": {f"{source}:{cluster_id}": len(rows) for (source, cluster_id), rows in sample.items()}, "estimates": estimates}, f, indent=2)
+        logger.info(f"Saved sample estimate to {report_path}")
+        return estimates
+
+    def _generate_stage(self, item):
+        with stage("generate"):
+            item["response_text"], item["model_name"] = self.bot_api.get_response(item["prompt_text"], system_prompt=self.settings.system_prompt, with_model=True)
+        return item
+
+    def _route_stage(self, items):
+        # Batched so the router can vectorise rule checks, pack judge calls and
+        # bulk-write failure_log rows. Routing runs on copies and responses are
+        # only inserted once it has succeeded, so when the pipeline retries a
+        # failed batch item by item, each item starts clean, nothing is left
+        # unscored and nothing is inserted twice. The stored text is the
+        # generated one, not a guardrail rewrite.
+        states = self.router.run_batch([dict(item) for item in items])
+        # Grouped by the model that answered, since a budget downgrade mid-run
+        # changes both model_version and fingerprint.
+        by_model = defaultdict(list)
+        for item, state in zip(items, states):
+            if "response_id" not in item:
+                by_model[item["model_name"]].append((item, state))
+        for model_name, group in by_model.items():
+            inserted = self.db_handler.insert_responses([(item["prompt_id"], item["response_text"]) for item, _ in group], model_version=model_name, run_id=self.run_id, fingerprint=self.config_fingerprint(model_name))
+            for (item, state), (response_id, created_at) in zip(group, inserted):
+                item["response_id"] = state["response_id"] = response_id
+                item["response_created_at"] = state["response_created_at"] = created_at
+        self.db_handler.insert_failures([(state["response_id"], routed_to, reason) for state in states for routed_to, reason in state.pop("failures", [])])
+        if self.settings.stream_on_insert:
+            self._fold_into_stream(states, [item["response_text"] for item in items])
+        return states
+
+    def _fold_into_stream(self, states, texts):
+        # Responses the guardrail or clinician-review nodes handled count as failures.
+        failure_nodes = {"safety_guardrail", "clinician_review"}
+        self.cluster_engine.fold_responses(
+            [state["response_id"] for state in states],
+            texts,
+            [state["response_created_at"] for state in states],
+            [bool(failure_nodes & set(state.get("route", []))) for state in states],
+        )
+
+    def _evaluate_stage(self, state):
+        state["rule_eval"], state["llm_eval"] = self.evaluator.score_state(state)
+        return state
+
+    def _persist_stage(self, state):
+        self.evaluator.persist_scores(state["prompt_id"], state["response_id"], state["rule_eval"], state["llm_eval"])
+        PROMPTS_PROCESSED.inc()
+        logger.info(f"Processed and evaluated prompt {state['prompt_id']}")
+        return state
+
+    def cluster_and_analyze(self, time_window=None, limit=1000, method='auto', refit=False):
+        df_clustered = self.cluster_engine.cluster_and_save(time_window, limit, method, refit=refit)
         if not df_clustered.empty:
             self.visualizer.plot_clusters(df_clustered)
             self.visualizer.plot_cluster_timeline(df_clustered)
             self.visualizer.plot_cluster_frequencies(df_clustered)
             self.visualizer.save_cluster_csv(df_clustered)
 
+    def stream_cluster(self, limit=10000, since=None, top=10):
+        macros = self.cluster_engine.cluster_stream(limit, since=since)
+        for macro in macros[:top]:
+            print({key: macro[key] for key in ("macro_id", "weight", "failure_weight", "failure_rate", "emerging")} | {"micro_clusters": len(macro["micro_clusters"])})
+        report_path = os.path.join(self.settings.output_dir, "stream_macro_clusters.json")
+        with open(report_path, "w") as f:
+            json.dump(macros, f, indent=2)
+        logger.info(f"Saved {len(macros)} macro-clusters to {report_path}")
+        return macros
+
+    def find_similar(self, response_id=None, text=None, k=10):
+        hits = self.cluster_engine.find_similar(response_id=response_id, text=text, k=k)
+        for hit_id, score, hit_text, created_at, failed in hits:
+            print({"response_id": hit_id, "similarity": round(score, 4), "failed": failed, "created_at": str(created_at), "text": hit_text[:200]})
+        return hits
+
     def run_psych_tests_sequential(self, test_ids, prompt_source):
+        self.run_psych_tests_parallel(test_ids, prompt_source, concurrency=1)
+
+    def run_psych_tests_parallel(self, test_ids, prompt_source, concurrency=4):
         prompts = self.db_handler.fetch_prompts(prompt_source, 10000) # Large limit
-        prompt_ids = [p[0] for p in prompts]
-        for test_id in test_ids:
-            self.test_manager.run_tests_on_prompts(test_id, prompt_ids)
+        self.budget.start_run()
+        self.test_manager.run_test_matrix(test_ids, [p[0] for p in prompts], concurrency)
+        self.budget.flush()
+        usage = self.budget.summary()
+        logger.info(f"Psych tests used {usage['prompt_tokens'] + usage['completion_tokens']} tokens (${usage['cost_usd']:.4f}).")
+
+    def report_scores(self, source=None, since=None, until=None, daily=False, rebuild=False, fingerprint=None):
+        if rebuild:
+            self.db_handler.rebuild_score_rollups(since)
+        if daily:
+            rows = self.db_handler.fetch_score_rollups(source, since, until, fingerprint=fingerprint)
+        else:
+            rows = self.db_handler.summarize_scores(source, since, until, fingerprint=fingerprint)
+        for row in rows:
+            print(dict(row._mapping))
+        return rows
@@ -1,5 +1,4 @@
 import logging
-import matplotlib.pyplot as plt
 import pandas as pd
 import os
 from settings import settings
@@ -7,11 +6,17 @@ from settings import settings
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _pyplot():
+    # matplotlib is only imported when something is actually plotted.
+    import matplotlib.pyplot as plt
+    return plt
+
 class Visualizer:
     def __init__(self):
         self.output_dir = settings.output_dir
 
     def plot_clusters(self, df: pd.DataFrame):
+        plt = _pyplot()
         plt.figure(figsize=(12, 8))
         scatter = plt.scatter(df['x'], df['y'], c=df['cluster_id'], cmap='viridis', s=50, alpha=0.7)
         plt.title('UMAP Projection of Embeddings, Colored by Cluster')
@@ -25,6 +30,7 @@ class Visualizer:
         plt.close()
 
     def plot_cluster_timeline(self, df: pd.DataFrame):
+        plt = _pyplot()
         df_sorted = df.sort_values('created_at')
         plt.figure(figsize=(15, 7))
         plt.plot(df_sorted['created_at'], df_sorted['cluster_id'], marker='o', linestyle='-')
@@ -38,6 +44,7 @@ class Visualizer:
         plt.close()
 
     def plot_cluster_frequencies(self, df: pd.DataFrame):
+        plt = _pyplot()
         plt.figure(figsize=(10, 6))
         df['cluster_id'].value_counts().sort_index().plot(kind='bar')
         plt.title('Cluster Frequencies')
@@ -0,0 +1,146 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+from collections import defaultdict
+from settings import settings
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class EvalWorker:
+    """Pulls evaluation jobs from the eval_jobs table and runs them through the
+    runner's staged pipeline.
+
+    Any number of workers, on any number of machines, can share one database:
+    claims use FOR UPDATE SKIP LOCKED so batches never overlap, and a
+    heartbeat thread renews the batch's lease while it is being processed. If
+    a worker dies, its lease lapses and the jobs are claimed again by others.
+    """
+
+    def __init__(self, runner, worker_id=None, batch_size=None, concurrency=1):
+        self.runner = runner
+        self.db_handler = runner.db_handler
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size or settings.worker_batch_size
+        self.concurrency = concurrency
+        self.lease_seconds = settings.job_lease_seconds
+        self.max_attempts = settings.job_max_attempts
+        self._stop = threading.Event()
+        self.processed = 0
+        self.failed = 0
+
+    def stop(self):
+        self._stop.set()
+
+    def _heartbeat(self, job_ids, done):
+        held = set(job_ids)
+        while not done.wait(settings.job_heartbeat_seconds):
+            try:
+                renewed = self.db_handler.renew_job_leases(self.worker_id, held, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"Worker {self.worker_id}: lease renewal failed: {e}")
+                continue
+            if renewed != held:
+                logger.warning(f"Worker {self.worker_id}: lost lease on jobs {sorted(held - renewed)}")
+                held = renewed
+
+    def run_batch(self, jobs):
+        jobs_by_prompt = defaultdict(list)
+        for job_id, prompt_id, _ in jobs:
+            jobs_by_prompt[prompt_id].append(job_id)
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=([job[0] for job in jobs], done), name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            results = self.runner.process_prompts([(prompt_id, prompt_text) for _, prompt_id, prompt_text in jobs], self.concurrency)
+        except Exception as e:
+            if self._budget_spent([job[0] for job in jobs]):
+                return
+            self.db_handler.fail_jobs(self.worker_id, [job[0] for job in jobs], str(e), self.max_attempts)
+            self.failed += len(jobs)
+            raise
+        finally:
+            done.set()
+            heartbeat.join()
+        completed = {state["prompt_id"] for state in results}
+        completed_jobs = [job_id for prompt_id in completed for job_id in jobs_by_prompt[prompt_id]]
+        unfinished_jobs = [job_id for prompt_id, job_ids in jobs_by_prompt.items() if prompt_id not in completed for job_id in job_ids]
+        self.db_handler.complete_jobs(self.worker_id, completed_jobs)
+        self.processed += len(completed_jobs)
+        if self._budget_spent(unfinished_jobs):
+            return
+        self.db_handler.fail_jobs(self.worker_id, unfinished_jobs, "dropped by evaluation pipeline; see worker log", self.max_attempts)
+        self.failed += len(unfinished_jobs)
+
+    def _budget_spent(self, job_ids):
+        # Jobs left over because the LLM budget ran out did nothing wrong: they go
+        # back to the queue without using an attempt, and this worker stops, since
+        # its run budget will not come back and the daily one only resets tomorrow.
+        if not self.runner.budget.exceeded:
+            return False
+        self.db_handler.release_jobs(self.worker_id, job_ids)
+        logger.warning(f"Worker {self.worker_id}: LLM budget exhausted; released {len(job_ids)} jobs and stopping.")
+        self.stop()
+        return True
+
+    def run(self, exit_when_idle=False):
+        # One eval_runs row covers every batch this worker processes.
+        self.runner.start_run(source="queue", params={"worker_id": self.worker_id}, concurrency=self.concurrency)
+        logger.info(f"Worker {self.worker_id} started (batch size {self.batch_size}, run {self.runner.run_id}).")
+        status = "aborted"
+        try:
+            while not self._stop.is_set():
+                self.db_handler.ensure_current_partitions()
+                jobs = self.db_handler.claim_jobs(self.worker_id, self.batch_size, self.lease_seconds, self.max_attempts)
+                if not jobs:
+                    if exit_when_idle:
+                        break
+                    self._stop.wait(settings.worker_poll_interval)
+                    continue
+                try:
+                    self.run_batch(jobs)
+                except Exception as e:
+                    logger.error(f"Worker {self.worker_id}: batch of {len(jobs)} jobs failed: {e}")
+            status = None
+        finally:
+            self.runner.finish_run(status)
+        logger.info(f"Worker {self.worker_id} stopped: {self.processed} jobs done, {self.failed} failed.")
+
+def _worker_main(batch_size, concurrency, exit_when_idle, metrics_port=None, index=0):
+    # Each process builds its own runner, so DB pools and API clients are never
+    # shared across a fork. Spawned children skip atexit, so metrics are dumped here.
+    from unified_runner import UnifiedRunner
+    if metrics_port:
+        registry.serve(metrics_port)
+    worker = EvalWorker(UnifiedRunner(), batch_size=batch_size, concurrency=concurrency)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.run(exit_when_idle=exit_when_idle)
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        if settings.metrics_dump:
+            registry.dump_json(os.path.join(settings.output_dir, f"metrics_worker_{index}.json"))
+
+def run_workers(workers=1, batch_size=None, concurrency=1, exit_when_idle=False, metrics_port=None):
+    # With several processes, worker i serves its metrics on metrics_port + i and
+    # dumps them (with METRICS_DUMP) to metrics_worker_<i>.json.
+    if workers == 1:
+        _worker_main(batch_size, concurrency, exit_when_idle, metrics_port)
+        return
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_worker_main, args=(batch_size, concurrency, exit_when_idle, metrics_port + i if metrics_port else None, i), name=f"eval-worker-{i}") for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()